@@ -0,0 +1,14 @@
+from db.sql_db import DB
+from llm.llm import LLM
+
+
+def main():
+    # Offline job, e.g. nightly: precomputes a recommendation for every user (see LLM.make_recommendations_for_all_users)
+    db = DB()
+    llm = LLM(db, load_model_data_on_start=True)
+
+    print(llm.make_recommendations_for_all_users())
+
+
+if __name__ == "__main__":
+    main()
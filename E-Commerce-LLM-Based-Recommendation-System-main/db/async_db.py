@@ -0,0 +1,127 @@
+from datetime import datetime
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+import constants
+from db.sql_db import DB, build_database_url, build_engine_options, apply_sqlite_storage_profile, is_unique_violation
+from db.sql_models import RecommendationFeedback
+from db.model_executor import ModelExecutor
+from db.ranking import reciprocal_rank_fusion
+from db.rating_summary import build_rating_increment_statements, build_rating_summary_statement, format_rating_summary
+
+
+class AsyncDB:
+    '''
+    Non-blocking counterpart of `DB` for the request path of the API server.
+
+    SQL runs on an async engine over the same database (aiosqlite, or asyncpg for PostgreSQL), vector search uses the store's async search (`AsyncQdrantClient` for Qdrant) and embedding runs
+    on the bounded `ModelExecutor`, so a request never blocks the event loop. Statement building, filters and fusion are
+    shared with `DB`, so both return identical results. Writes that are not on the request path (ingest, updates) stay on `DB`.
+    '''
+
+    def __init__(self, db: DB, model_executor: ModelExecutor):
+        self.db = db
+        self.model_executor = model_executor
+        database_url = build_database_url(self.db.database_location, use_async_driver=True)
+        self.engine = create_async_engine(database_url, **build_engine_options(database_url))
+        if self.engine.dialect.name == 'sqlite':
+            apply_sqlite_storage_profile(self.engine.sync_engine)
+
+    async def get_data(self, table: str, id: int, return_as_dict: bool = True) -> dict:
+        '''
+        Same as `DB.get_data`.
+        '''
+        statement = DB.build_get_data_statement(table, id)
+        if statement is None: # Not given correct table name
+            return None
+
+        async with AsyncSession(self.engine) as session:
+            data = (await session.exec(statement)).first()
+            if data:
+                if return_as_dict:
+                    return data.dict()
+                else:
+                    return data
+            return None
+
+    async def get_precomputed_recommendation(self, user_id: int) -> dict:
+        '''
+        Same as `DB.get_precomputed_recommendation`.
+        '''
+        async with AsyncSession(self.engine) as session:
+            precomputed_recommendation = (await session.exec(DB.build_precomputed_recommendation_statement(user_id))).first()
+            return precomputed_recommendation.dict() if precomputed_recommendation else None
+
+    async def record_recommendation_feedback(self, recommendation_id: int, user_id: int, rating: int) -> int:
+        '''
+        Same as `DB.record_recommendation_feedback`.
+        '''
+        recommendation_feedback: RecommendationFeedback = RecommendationFeedback(recommendation_id=recommendation_id, user_id=user_id, rating=rating)
+        async with AsyncSession(self.engine) as session:
+            try:
+                session.add(recommendation_feedback)
+                await session.flush()
+                for statement, parameters in build_rating_increment_statements(self.engine.dialect.name, rating, recommendation_feedback.created_at):
+                    await session.execute(statement, parameters)
+                await session.commit()
+                await session.refresh(recommendation_feedback)
+                return recommendation_feedback.recommendation_feedback_id
+            except IntegrityError as e:
+                if is_unique_violation(e): #Feedback already exists for recommendation
+                    await session.rollback()
+                    return None
+                else:
+                    raise
+
+    async def search_product(self, user_id: int = None, search_keyword: str = '', min_price: float = None, max_price: float = None, min_stock: int = None, return_as_dict: bool = True, use_vectore_search: bool = True, similarity_threshold: float=0.3, limit: int = None, offset: int = 0, return_scores: bool = False, record_history: bool = True):
+        '''
+        Same as `DB.search_product`.
+        '''
+        if user_id is not None and record_history:
+            self.db.record_search_history_buffered(user_id, search_keyword, block=False)  # Never waits on the event loop
+
+        limit = constants.SEARCH_DEFAULT_LIMIT if limit is None else limit
+        candidates_per_retriever = offset + limit
+
+        ranked_lists = []
+        weights = []
+
+        ### Using keyword search ###
+        tokenized_search_keyword: list = self.db.text_tokenizer.clean_text(search_keyword, stem=False)
+        statement = self.db.build_keyword_search_statement(tokenized_search_keyword, min_price, max_price, min_stock, candidates_per_retriever)
+        async with AsyncSession(self.engine) as session:
+            ranked_lists.append((await session.exec(statement)).all())
+        weights.append(constants.HYBRID_SEARCH_KEYWORD_WEIGHT)
+
+        ### Using semantic vectore search ###
+        if use_vectore_search:
+            search_query_embedding = await self.model_executor.run(self.db.text_embedder.generate_embedding, search_keyword)
+
+            ranked_lists.append(await self.db.product_vector_store.search_similar_products_async(
+                query_embedding=search_query_embedding,
+                k=candidates_per_retriever,
+                similarity_threshold=similarity_threshold,
+                payload_ranges=DB.build_vector_search_ranges(min_price, max_price, min_stock),
+            ))
+            weights.append(constants.HYBRID_SEARCH_VECTOR_WEIGHT)
+
+        ### Fusion and paging ###
+        fused_results = reciprocal_rank_fusion(ranked_lists, weights, k=constants.HYBRID_SEARCH_RRF_K)[offset:offset + limit]
+        async with AsyncSession(self.engine) as session:
+            products = (await session.exec(DB.build_products_by_ids_statement(fused_results))).all()
+
+        ### Search Result Return ###
+        return DB.format_search_results(products, fused_results, return_as_dict, return_scores)
+
+    async def summarize_recommendation_feedback_rating(self, since: datetime = None, until: datetime = None, granularity: str = None) -> dict:
+        '''
+        Same as `DB.summarize_recommendation_feedback_rating`.
+        '''
+        async with AsyncSession(self.engine) as session:
+            results = (await session.exec(build_rating_summary_statement(since, until, granularity))).all()
+            return format_rating_summary(results, granularity)
+
+    async def dispose(self):
+        await self.engine.dispose()
+        await self.db.product_vector_store.close_async_client()
@@ -0,0 +1,92 @@
+'''
+Recall vs latency of the product vector search, for picking HNSW and quantization settings.
+
+Run from the project root:
+    python -m db.benchmark_vector_search --hnsw-ef 32 64 128 256 --oversampling 1.0 2.0 4.0
+
+Queries are read from the `query` column of a CSV, or default to the names of random products. Every query is first
+searched exactly (full scan) as ground truth, then once per setting; for each setting it reports recall@k against the
+exact results and p50/p95/p99 latency. `--hnsw-ef` and `--oversampling` are per query settings; collection settings
+(QDRANT_HNSW_M, QDRANT_HNSW_EF_CONSTRUCT, QDRANT_QUANTIZATION, on-disk storage) are changed in constants, applied on the
+next connect, and compared by running the benchmark again once Qdrant has finished re-indexing.
+'''
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from sqlalchemy.sql import func
+from sqlmodel import Session, select
+
+import constants
+from db.sql_db import DB
+from db.sql_models import Product
+
+
+def load_queries(db: DB, queries_csv: str, num_queries: int) -> list:
+    if queries_csv is not None:
+        return pd.read_csv(queries_csv)['query'].dropna().astype(str).tolist()[:num_queries]
+    with Session(db.engine) as session:
+        return list(session.exec(select(Product.name).order_by(func.random()).limit(num_queries)).all())
+
+
+def percentile_ms(latencies: list, percentile: float) -> float:
+    return 1000 * float(np.percentile(latencies, percentile))
+
+
+def benchmark_setting(db: DB, query_embeddings: np.ndarray, exact_results: list, k: int, **search_params) -> dict:
+    latencies = []
+    recalls = []
+    for query_embedding, exact_ids in zip(query_embeddings, exact_results):
+        started_at = time.perf_counter()
+        ids = db.product_vector_store.search_similar_products(query_embedding, k=k, similarity_threshold=None, **search_params)
+        latencies.append(time.perf_counter() - started_at)
+        if exact_ids:
+            recalls.append(len(set(ids) & set(exact_ids)) / len(exact_ids))
+
+    return {
+        **{name: value for name, value in search_params.items() if value is not None},
+        f'recall@{k}': float(np.mean(recalls)) if recalls else float('nan'),
+        'p50_ms': percentile_ms(latencies, 50),
+        'p95_ms': percentile_ms(latencies, 95),
+        'p99_ms': percentile_ms(latencies, 99),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--queries-csv', default=None, help='CSV with a `query` column (default: names of random products)')
+    parser.add_argument('--num-queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--hnsw-ef', type=int, nargs='+', default=[16, 32, 64, 128, 256])
+    parser.add_argument('--oversampling', type=float, nargs='+', default=None, help='Qdrant with quantization only')
+    args = parser.parse_args()
+
+    db = DB()
+    db.product_vector_store.warmup()
+    queries = load_queries(db, args.queries_csv, args.num_queries)
+    query_embeddings = db.text_embedder.generate_embeddings(queries, use_cache=False)
+    print(f"Backend: {constants.VECTOR_STORE_BACKEND}, queries: {len(queries)}, k: {args.k}")
+    if constants.VECTOR_STORE_BACKEND == 'qdrant':
+        print(f"HNSW m={constants.QDRANT_HNSW_M} ef_construct={constants.QDRANT_HNSW_EF_CONSTRUCT} on_disk={constants.QDRANT_HNSW_ON_DISK}, "
+              f"vectors on_disk={constants.QDRANT_VECTORS_ON_DISK}, quantization={constants.QDRANT_QUANTIZATION}")
+
+    exact_results = [
+        db.product_vector_store.search_similar_products(query_embedding, k=args.k, similarity_threshold=None, exact=True)
+        for query_embedding in query_embeddings
+    ]
+
+    settings = [{'hnsw_ef': hnsw_ef} for hnsw_ef in args.hnsw_ef]
+    if args.oversampling and constants.VECTOR_STORE_BACKEND == 'qdrant' and constants.QDRANT_QUANTIZATION is not None:
+        settings = [
+            {**setting, 'oversampling': oversampling, 'rescore': rescore}
+            for setting in settings for oversampling in args.oversampling for rescore in (True, False)
+        ]
+
+    benchmark_setting(db, query_embeddings[:10], exact_results[:10], args.k, **settings[0])  # Warmup
+    results = [benchmark_setting(db, query_embeddings, exact_results, args.k, **setting) for setting in settings]
+    print(pd.DataFrame(results).to_string(index=False, float_format=lambda value: f'{value:.3f}'))
+    db.close()
+
+
+if __name__ == '__main__':
+    main()
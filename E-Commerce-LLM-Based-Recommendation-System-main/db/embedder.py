@@ -20,16 +20,85 @@
 
 
 
-from sentence_transformers import SentenceTransformer
+import re
+from typing import List
 import numpy as np
 
+import constants
+from db.cache import LRUCache
+from db.lazy import LazyResource
+
 class TextEmbedder:
 
     embedding_size = 384
 
     def __init__(self):
         self.model_name="all-MiniLM-L6-v2"
-        self.model = SentenceTransformer(self.model_name)
+        self.model_loader = LazyResource(self.load_model, name=f"embedding model '{self.model_name}'")
+        self.batch_size = constants.EMBEDDING_BATCH_SIZE
+        self.cache = LRUCache(max_size=constants.EMBEDDING_CACHE_SIZE, ttl_seconds=constants.EMBEDDING_CACHE_TTL_SECONDS)
+
+    def load_model(self):
+        from sentence_transformers import SentenceTransformer  # Importing pulls in torch, deferred with the model itself
+        return SentenceTransformer(self.model_name)
+
+    @property
+    def model(self):
+        return self.model_loader.get()
+
+    def warmup(self):
+        self._encode(['warmup'])  # Loads the model and runs one forward pass
+
+    @staticmethod
+    def normalize_text(text: str) -> str:
+        # all-MiniLM-L6-v2 is uncased, so case and repeated whitespace do not change the embedding
+        return re.sub(r'\s+', ' ', text).strip().lower()
+
+    def generate_embedding(self, text: str, use_cache: bool = True) -> np.ndarray:
+        return self.generate_embeddings([text], use_cache=use_cache)[0]
+
+    def generate_embeddings(self, texts: List[str], use_cache: bool = True) -> np.ndarray:
+        '''
+        Encodes texts in batches of `constants.EMBEDDING_BATCH_SIZE`.
+
+        Parameters:
+            - texts (list[str]): texts to encode
+            - use_cache (bool): look up / store embeddings in the query cache. Disable for one-off texts (e.g. product ingest) so they do not evict hot queries.
+
+        Returns:
+            - np.ndarray: C-contiguous float32 matrix of shape (len(texts), embedding_size)
+        '''
+        embeddings = np.empty((len(texts), self.embedding_size), dtype=np.float32)
+        if len(texts) == 0:
+            return embeddings
+
+        if not use_cache:
+            embeddings[:] = self._encode(texts)
+            return embeddings
+
+        missing = {}  # normalized text -> row indexes that need it
+        for i, text in enumerate(texts):
+            key = self.normalize_text(text)
+            cached = self.cache.get(key)
+            if cached is None:
+                missing.setdefault(key, []).append(i)
+            else:
+                embeddings[i] = cached
+
+        if missing:
+            keys = list(missing)
+            encoded = self._encode(keys)
+            for key, embedding in zip(keys, encoded):
+                embedding = embedding.copy()  # Do not keep the whole batch alive through one cached row
+                embedding.flags.writeable = False  # Shared between callers through the cache
+                self.cache.set(key, embedding)
+                embeddings[missing[key]] = embedding
+
+        return embeddings
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        encoded = self.model.encode(texts, batch_size=self.batch_size, convert_to_numpy=True, show_progress_bar=False)
+        return np.ascontiguousarray(encoded, dtype=np.float32)
 
-    def generate_embedding(self, text: str) -> np.ndarray:
-        return np.array(self.model.encode(text)).astype(np.float32)
\ No newline at end of file
+    def cache_stats(self) -> dict:
+        return self.cache.stats()
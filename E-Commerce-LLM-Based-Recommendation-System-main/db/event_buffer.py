@@ -0,0 +1,148 @@
+import time
+import queue
+import atexit
+import threading
+from sqlalchemy import insert
+from sqlalchemy.engine import Engine
+
+import constants
+
+
+class EventBuffer:
+    '''
+    Append-only write buffer for rows nobody reads back immediately (SearchHistory, Recommendation logging).
+
+    `append` only enqueues; a background thread writes the queued rows with one executemany per table every
+    `flush_interval_seconds` or as soon as `flush_batch_size` rows are waiting, so request latency never includes a commit.
+    The queue holds at most `max_queue_size` rows. When it is full `append` waits up to `put_timeout_seconds` for the
+    writer (not at all with `block=False`, for callers on the event loop) and then drops the row (counted in `stats()`),
+    so a stalled disk cannot grow memory or stall requests.
+    `flush()` waits until every row appended before it is committed, for reads that must see them. Remaining rows are
+    flushed by `close()`, which also runs at interpreter exit; rows appended after it are written synchronously.
+    '''
+
+    def __init__(self, engine: Engine, max_queue_size: int = None, flush_batch_size: int = None, flush_interval_seconds: float = None, put_timeout_seconds: float = None):
+        self.engine = engine
+        self.flush_batch_size = constants.EVENT_BUFFER_FLUSH_BATCH_SIZE if flush_batch_size is None else flush_batch_size
+        self.flush_interval_seconds = constants.EVENT_BUFFER_FLUSH_INTERVAL_SECONDS if flush_interval_seconds is None else flush_interval_seconds
+        self.put_timeout_seconds = constants.EVENT_BUFFER_PUT_TIMEOUT_SECONDS if put_timeout_seconds is None else put_timeout_seconds
+        self._queue = queue.Queue(maxsize=constants.EVENT_BUFFER_MAX_QUEUE_SIZE if max_queue_size is None else max_queue_size)
+        self._write_lock = threading.Lock()
+        self._closed = threading.Event()
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self._worker = threading.Thread(target=self._run, name='event-buffer', daemon=True)
+        self._worker.start()
+        atexit.register(self.close)
+
+    def append(self, table_model, row: dict, block: bool = True) -> bool:
+        '''
+        Queues one row for `table_model`. Returns False when the row was dropped because the buffer stayed full.
+        After `close()` the row is written at once instead.
+        '''
+        if self._closed.is_set():
+            return self._write([(table_model, row)]) == 1
+        try:
+            if block:
+                self._queue.put((table_model, row), timeout=self.put_timeout_seconds)
+            else:
+                self._queue.put_nowait((table_model, row))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        if self._closed.is_set():
+            self.flush()  # Closed while queueing, after the final flush of `close()` perhaps
+        return True
+
+    def flush(self):
+        '''
+        Writes every row appended before the call, including the batch the writer thread already took off the queue,
+        and returns once they are committed (or counted as failed in `stats()`).
+        '''
+        if self._worker.is_alive():
+            # Queued behind the rows appended so far, so the writer reaches it only after taking all of them
+            flush_request = threading.Event()
+            self._queue.put(flush_request)
+            while not flush_request.wait(timeout=0.1):
+                if not self._worker.is_alive():  # Stopped by `close()`, the drain below writes the rest
+                    break
+        while True:
+            events = self._drain(self.flush_batch_size)
+            if not events:
+                return
+            self._write(events)
+
+    def close(self):
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self._worker.join(timeout=self.flush_interval_seconds + 5)
+        self.flush()
+
+    def stats(self) -> dict:
+        return {
+            'queued': self._queue.qsize(),  # Including pending flush requests
+            'written': self.written,
+            'dropped': self.dropped,
+            'failed': self.failed,
+        }
+
+    def _drain(self, max_events: int) -> list:
+        events = []
+        while len(events) < max_events:
+            try:
+                events.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return events
+
+    def _run(self):
+        while not self._closed.is_set():
+            deadline = time.monotonic() + self.flush_interval_seconds
+            events = []
+            while len(events) < self.flush_batch_size and not self._closed.is_set():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    event = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                events.append(event)
+                if isinstance(event, threading.Event):
+                    break  # Flush request, write what was taken so far now
+            if events:
+                self._write(events)
+
+    def _write(self, events: list) -> int:
+        '''
+        Writes the rows among `events` in one transaction, then completes the flush requests among them.
+        '''
+        rows_by_table = {}
+        flush_requests = []
+        for event in events:
+            if isinstance(event, threading.Event):
+                flush_requests.append(event)
+            else:
+                table_model, row = event
+                rows_by_table.setdefault(table_model, []).append(row)
+        row_count = len(events) - len(flush_requests)
+
+        try:
+            if row_count == 0:
+                return 0
+            with self._write_lock:
+                try:
+                    with self.engine.begin() as connection:  # One transaction, one commit for the whole batch
+                        for table_model, rows in rows_by_table.items():
+                            connection.execute(insert(table_model), rows)
+                except Exception as e:
+                    self.failed += row_count
+                    print(f"Event buffer failed to write {row_count} rows: {e}")
+                    return 0
+            self.written += row_count
+            return row_count
+        finally:
+            for flush_request in flush_requests:
+                flush_request.set()
@@ -0,0 +1,159 @@
+from typing import List
+from sqlalchemy import text, table, column, func, literal_column
+from sqlalchemy.engine import Engine
+from sqlmodel import select
+
+from db.sql_models import Product
+from db.tokenizer import TextTokenizer
+
+PRODUCT_FTS_TABLE_NAME = 'product_fts'
+PRODUCT_SEARCH_DOCUMENT_INDEX_NAME = 'product_search_document_idx'
+# Text search configurations that strip diacritics: name -> (built-in configuration copied, dictionary after unaccent)
+POSTGRESQL_UNACCENT_TEXT_SEARCH_CONFIGS = {
+    'product_unaccent_simple': ('simple', 'simple'),
+    'product_unaccent_english': ('english', 'english_stem'),
+}
+
+# Lightweight handle on the FTS5 virtual table so it can be joined in SQLModel selects.
+# `rank` is FTS5's built-in BM25 score: lower (more negative) is a better match.
+product_fts = table(PRODUCT_FTS_TABLE_NAME, column('rowid'), column('rank'))
+
+
+class ProductKeywordIndex:
+    '''
+    Inverted index over `product.name` and `product.description` for keyword search.
+
+    - SQLite: FTS5 external-content table on `product` (no text is stored twice), kept in sync by triggers, so every write
+      path, including bulk inserts, updates it inside the same transaction. Ranked by BM25.
+    - PostgreSQL: GIN expression index on the product's tsvector, ranked by ts_rank.
+
+    Stemming and diacritics handling follow the TextTokenizer settings (FTS5 tokenizer / text search configuration);
+    the index is rebuilt when they change. The database applies them to query terms too. Diacritics are removed by
+    FTS5's `remove_diacritics 2` on SQLite and by the `unaccent` extension on PostgreSQL (it must be available to the
+    server, it ships with the contrib package).
+    '''
+
+    def __init__(self, engine: Engine, text_tokenizer: TextTokenizer):
+        self.engine = engine
+        self.dialect_name = engine.dialect.name
+        self.fts5_tokenizer = text_tokenizer.fts5_tokenizer
+        self.text_search_config = text_tokenizer.postgresql_text_search_config
+
+    def create_if_not_exists(self):
+        if self.dialect_name == 'postgresql':
+            self._create_postgresql_index_if_not_exists()
+        else:
+            self._create_fts5_table_if_not_exists()
+
+    def _create_postgresql_text_search_config_if_not_exists(self, connection):
+        if self.text_search_config not in POSTGRESQL_UNACCENT_TEXT_SEARCH_CONFIGS:
+            return
+        copied_config, dictionary = POSTGRESQL_UNACCENT_TEXT_SEARCH_CONFIGS[self.text_search_config]
+        connection.execute(text('CREATE EXTENSION IF NOT EXISTS unaccent'))
+        connection.execute(text(f'''
+            DO $$
+            BEGIN
+                IF NOT EXISTS (SELECT 1 FROM pg_ts_config WHERE cfgname = '{self.text_search_config}') THEN
+                    CREATE TEXT SEARCH CONFIGURATION {self.text_search_config} (COPY = {copied_config});
+                    ALTER TEXT SEARCH CONFIGURATION {self.text_search_config}
+                        ALTER MAPPING FOR hword, hword_part, word WITH unaccent, {dictionary};
+                END IF;
+            END
+            $$
+        '''))
+
+    def _create_postgresql_index_if_not_exists(self):
+        with self.engine.begin() as connection:
+            self._create_postgresql_text_search_config_if_not_exists(connection)
+            index_definition = connection.execute(
+                text("SELECT indexdef FROM pg_indexes WHERE indexname = :name"),
+                {'name': PRODUCT_SEARCH_DOCUMENT_INDEX_NAME},
+            ).scalar()
+            if index_definition is not None and f"'{self.text_search_config}'" not in index_definition:
+                print(f"Keyword index '{PRODUCT_SEARCH_DOCUMENT_INDEX_NAME}' uses another text search configuration. Rebuilding...")
+                connection.execute(text(f'DROP INDEX {PRODUCT_SEARCH_DOCUMENT_INDEX_NAME}'))
+            connection.execute(text(f'''
+                CREATE INDEX IF NOT EXISTS {PRODUCT_SEARCH_DOCUMENT_INDEX_NAME} ON product
+                USING GIN (to_tsvector('{self.text_search_config}', name || ' ' || coalesce(description, '')))
+            '''))
+
+    def _create_fts5_table_if_not_exists(self):
+        with self.engine.begin() as connection:
+            table_definition = connection.execute(
+                text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                {'name': PRODUCT_FTS_TABLE_NAME},
+            ).scalar()
+            if table_definition is not None:
+                if f"tokenize='{self.fts5_tokenizer}'" in table_definition:
+                    return
+                print(f"Keyword index '{PRODUCT_FTS_TABLE_NAME}' uses another tokenizer. Rebuilding...")
+                connection.execute(text(f'DROP TABLE {PRODUCT_FTS_TABLE_NAME}'))  # Triggers are recreated below
+                for suffix in ('ai', 'ad', 'au'):
+                    connection.execute(text(f'DROP TRIGGER IF EXISTS {PRODUCT_FTS_TABLE_NAME}_{suffix}'))
+            else:
+                print(f"Keyword index '{PRODUCT_FTS_TABLE_NAME}' not found. Creating...")
+
+            connection.execute(text(f'''
+                CREATE VIRTUAL TABLE {PRODUCT_FTS_TABLE_NAME} USING fts5(
+                    name, description, content='product', content_rowid='product_id', tokenize='{self.fts5_tokenizer}'
+                )
+            '''))
+            connection.execute(text(f'''
+                CREATE TRIGGER IF NOT EXISTS {PRODUCT_FTS_TABLE_NAME}_ai AFTER INSERT ON product BEGIN
+                    INSERT INTO {PRODUCT_FTS_TABLE_NAME}(rowid, name, description) VALUES (new.product_id, new.name, new.description);
+                END
+            '''))
+            connection.execute(text(f'''
+                CREATE TRIGGER IF NOT EXISTS {PRODUCT_FTS_TABLE_NAME}_ad AFTER DELETE ON product BEGIN
+                    INSERT INTO {PRODUCT_FTS_TABLE_NAME}({PRODUCT_FTS_TABLE_NAME}, rowid, name, description) VALUES ('delete', old.product_id, old.name, old.description);
+                END
+            '''))
+            # Only text changes touch the index; price/stock updates do not
+            connection.execute(text(f'''
+                CREATE TRIGGER IF NOT EXISTS {PRODUCT_FTS_TABLE_NAME}_au AFTER UPDATE OF name, description ON product BEGIN
+                    INSERT INTO {PRODUCT_FTS_TABLE_NAME}({PRODUCT_FTS_TABLE_NAME}, rowid, name, description) VALUES ('delete', old.product_id, old.name, old.description);
+                    INSERT INTO {PRODUCT_FTS_TABLE_NAME}(rowid, name, description) VALUES (new.product_id, new.name, new.description);
+                END
+            '''))
+            # Index the rows that existed before the table was created
+            connection.execute(text(f"INSERT INTO {PRODUCT_FTS_TABLE_NAME}({PRODUCT_FTS_TABLE_NAME}) VALUES ('rebuild')"))
+            print(f"Keyword index '{PRODUCT_FTS_TABLE_NAME}' created successfully.")
+
+    def build_search_statement(self, keywords: List[str], conditions: list, limit: int):
+        '''
+        Select of the ids of products matching any keyword (as a prefix) and all `conditions`, best match first.
+        '''
+        if self.dialect_name == 'postgresql':
+            # Must match the indexed expression exactly for the GIN index to be used
+            text_search_config = literal_column(f"'{self.text_search_config}'")
+            document = func.to_tsvector(text_search_config, Product.name + ' ' + func.coalesce(Product.description, ''))
+            query = func.to_tsquery(text_search_config, ' | '.join(f'{keyword}:*' for keyword in keywords))
+            return (
+                select(Product.product_id)
+                .where(document.op('@@')(query), *conditions)
+                .order_by(func.ts_rank(document, query).desc())
+                .limit(limit)
+            )
+
+        return (
+            select(Product.product_id)
+            .join(product_fts, product_fts.c.rowid == Product.product_id)
+            .where(self.match_clause(keywords), *conditions)
+            .order_by(product_fts.c.rank)
+            .limit(limit)
+        )
+
+    @staticmethod
+    def build_match_expression(keywords: List[str]) -> str:
+        '''
+        Builds an FTS5 MATCH expression that matches any of the keywords, each as a prefix ("lap" matches "laptop").
+        Keywords are quoted so FTS5 operators in user input are treated as plain text.
+        '''
+        quoted_keywords = ['"{}"*'.format(keyword.replace('"', '""')) for keyword in keywords]
+        return ' OR '.join(quoted_keywords)
+
+    @staticmethod
+    def match_clause(keywords: List[str]):
+        return text(f"{PRODUCT_FTS_TABLE_NAME} MATCH :match_expression").bindparams(
+            match_expression=ProductKeywordIndex.build_match_expression(keywords)
+        )
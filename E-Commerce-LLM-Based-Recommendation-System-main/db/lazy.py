@@ -0,0 +1,37 @@
+import threading
+from typing import Callable
+
+
+class LazyResource:
+    '''
+    Expensive resource (model, client, word list) created on first use instead of at import or construction time.
+
+    Creation runs once even when several threads ask for the resource at the same time; the others wait for it.
+    A failed creation is not cached, so the next `get` retries (e.g. once Qdrant is reachable).
+
+    Parameters:
+        - load (callable): creates and returns the resource
+        - name (str): used in log messages
+    '''
+
+    def __init__(self, load: Callable, name: str):
+        self.load = load
+        self.name = name
+        self._resource = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    def get(self):
+        if self._loaded:  # Fast path without the lock once loaded
+            return self._resource
+        with self._lock:
+            if not self._loaded:
+                print(f"Loading {self.name}...")
+                self._resource = self.load()
+                self._loaded = True
+                print(f"Loaded {self.name}.")
+        return self._resource
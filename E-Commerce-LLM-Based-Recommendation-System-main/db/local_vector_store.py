@@ -0,0 +1,452 @@
+import os
+import json
+import shutil
+import asyncio
+import threading
+from contextlib import contextmanager
+import numpy as np
+
+import constants
+from db.embedder import TextEmbedder
+from db.lazy import LazyResource
+from db.vector_store import VectorStore
+
+try:
+    import hnswlib
+except ImportError:  # Optional: without it every search is an exact scan
+    hnswlib = None
+
+try:
+    import fcntl
+except ImportError:  # Not on Windows, where writers are only serialized within one process
+    fcntl = None
+
+INITIAL_CAPACITY = 1024
+
+
+class LocalVectorStore(VectorStore):
+    '''
+    In-process vector store persisted under `constants.QDRANT_STORAGE_PATH/<collection_name>`: no server, no network hop.
+
+    Files:
+        - vectors.f32: memory-mapped float32 matrix of the L2-normalized embeddings, one row per point
+        - ids.i64: point id of every row
+        - payload.f64: memory-mapped float64 matrix with one column per payload schema field, NaN when unset
+        - meta.json: number of rows, capacity, field order, version (incremented by every vector write) and the version
+          of the last write that overwrote existing rows
+        - write.lock: flock held by the process writing
+        - hnsw.bin / hnsw.json: HNSW graph of large collections and the write version it was built at
+
+    Collections below `constants.LOCAL_VECTOR_STORE_HNSW_THRESHOLD` points are searched exactly with one matrix-vector
+    product. Larger ones use an HNSW index when hnswlib is installed: it returns
+    `constants.LOCAL_VECTOR_STORE_HNSW_OVERSAMPLING * k` neighbours which are then filtered on the payload columns, and
+    when the filters leave fewer than k the search falls back to the exact scan, so filtered results stay complete.
+
+    Writes are serialized across threads and processes (API server, batch job, bulk ingest and dataset builder may share
+    a collection): a writer holds an flock on write.lock and first reloads meta.json, so it appends after the rows other
+    processes wrote. Searches pick up such rows as soon as meta.json changed. An existing id is overwritten in place, a
+    new id is appended. Only the payload fields of the schema are stored, as they are only used for filtering.
+    '''
+
+    def __init__(self, collection_name: str, payload_schema: dict = None):
+        self.collection_name = collection_name
+        self.payload_schema = {} if payload_schema is None else payload_schema
+        self.payload_fields = list(self.payload_schema)
+        self.embedding_size = TextEmbedder.embedding_size
+        self.storage_path = os.path.join(constants.QDRANT_STORAGE_PATH, collection_name)
+        self.write_lock = threading.RLock()
+        self.write_lock_depth = 0
+        self.write_lock_file = None
+        self.meta_signature = None  # (inode, mtime) of the meta.json last read or written
+        self.store_loader = LazyResource(self.load, name=f"local vector collection '{collection_name}'")
+        self.hnsw_lock = threading.Lock()
+        self.hnsw_index = None  # hnswlib.Index covering the rows as of `hnsw_version`
+        self.hnsw_version = None
+        self.hnsw_dirty_rows = set()  # Rows written since `hnsw_version`
+        self.hnsw_needs_rebuild = False  # Too many rows changed to add them one by one
+
+    ### Storage ###
+
+    def load(self) -> bool:
+        os.makedirs(self.storage_path, exist_ok=True)
+        self.acquire_file_lock()  # Another process may be creating or growing the files
+        try:
+            meta = self.read_meta(force=True) or {'count': 0, 'capacity': INITIAL_CAPACITY, 'version': 0, 'payload_fields': self.payload_fields, 'embedding_size': self.embedding_size}
+            if meta['payload_fields'] != self.payload_fields or meta['embedding_size'] != self.embedding_size:
+                raise ValueError(f"Local vector collection '{self.collection_name}' was created with another payload schema or embedding size, delete it and reindex")
+
+            self.count = meta['count']
+            self.version = meta['version']
+            self.overwrite_version = meta.get('overwrite_version', 0)
+            self.map_files(meta['capacity'])
+            self.row_by_id = {int(id): row for row, id in enumerate(self.ids[:self.count])}
+        finally:
+            self.release_file_lock()
+        print(f"Local vector collection '{self.collection_name}' loaded with {self.count} points.")
+        if hnswlib is None and self.count >= constants.LOCAL_VECTOR_STORE_HNSW_THRESHOLD:
+            print(f"WARNING: hnswlib is not installed, so the {self.count} points of '{self.collection_name}' are searched by exact scans. pip install hnswlib")
+        return True
+
+    def read_meta(self, force: bool = False) -> dict:
+        '''
+        Returns:
+            - contents of meta.json, or None when it does not exist or (unless `force`) is unchanged since last read or written
+        '''
+        meta_path = os.path.join(self.storage_path, 'meta.json')
+        try:
+            stat = os.stat(meta_path)
+        except FileNotFoundError:
+            return None
+        signature = (stat.st_ino, stat.st_mtime_ns)  # Replaced atomically, so every write is a new inode
+        if not force and signature == self.meta_signature:
+            return None
+        with open(meta_path) as f:
+            meta = json.load(f)
+        self.meta_signature = signature
+        return meta
+
+    def reload_meta(self):
+        '''
+        Picks up rows and capacity written by other processes since this one last read or wrote meta.json. Call with
+        `write_lock` held.
+        '''
+        meta = self.read_meta()
+        if meta is None or meta['version'] == self.version:
+            return
+        recreated = meta['count'] < self.count  # Deleted and written again, the mapped files are gone
+        if recreated or meta['capacity'] != self.capacity:
+            self.map_files(meta['capacity'])
+        if recreated:
+            self.row_by_id = {}
+            first_new_row = 0
+        else:
+            first_new_row = self.count
+        self.row_by_id.update({int(id): row for row, id in enumerate(self.ids[first_new_row:meta['count']], first_new_row)})
+        overwritten = recreated or meta.get('overwrite_version', 0) > self.version
+        if hnswlib is not None and not self.hnsw_needs_rebuild:
+            if overwritten:  # Which rows changed is not recorded, only that some did
+                self.hnsw_needs_rebuild = True
+                self.hnsw_dirty_rows = set()
+            else:
+                self.hnsw_dirty_rows.update(range(first_new_row, meta['count']))
+        self.count = meta['count']
+        self.version = meta['version']
+        self.overwrite_version = meta.get('overwrite_version', 0)
+
+    def acquire_file_lock(self):
+        self.write_lock_file = open(os.path.join(self.storage_path, 'write.lock'), 'a')
+        if fcntl is not None:
+            fcntl.flock(self.write_lock_file, fcntl.LOCK_EX)
+
+    def release_file_lock(self):
+        if fcntl is not None:
+            fcntl.flock(self.write_lock_file, fcntl.LOCK_UN)
+        self.write_lock_file.close()
+        self.write_lock_file = None
+
+    @contextmanager
+    def exclusive_write(self):
+        '''
+        Holds `write_lock` and the inter-process file lock, with the rows of other processes reloaded. Reentrant.
+        '''
+        self.store_loader.get()
+        with self.write_lock:
+            if self.write_lock_depth == 0:
+                self.acquire_file_lock()
+            self.write_lock_depth += 1
+            try:
+                self.reload_meta()
+                yield
+            finally:
+                self.write_lock_depth -= 1
+                if self.write_lock_depth == 0:
+                    self.release_file_lock()
+
+    def map_files(self, capacity: int):
+        self.capacity = capacity
+        self.vectors = self.open_memmap('vectors.f32', np.float32, (capacity, self.embedding_size))
+        self.ids = self.open_memmap('ids.i64', np.int64, (capacity,))
+        self.payloads = self.open_memmap('payload.f64', np.float64, (capacity, max(len(self.payload_fields), 1)))
+
+    def open_memmap(self, file_name: str, dtype, shape: tuple) -> np.memmap:
+        path = os.path.join(self.storage_path, file_name)
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        with open(path, 'ab'):  # Creates a missing file
+            pass
+        if os.path.getsize(path) < size:
+            with open(path, 'r+b') as f:
+                f.truncate(size)  # Only ever grows; new rows are zeros until written
+        return np.memmap(path, dtype=dtype, mode='r+', shape=shape)
+
+    def save_meta(self):
+        for array in (self.vectors, self.ids, self.payloads):
+            array.flush()  # Data reaches the files before the count that makes it visible
+        meta = {'count': self.count, 'capacity': self.capacity, 'version': self.version, 'overwrite_version': self.overwrite_version, 'payload_fields': self.payload_fields, 'embedding_size': self.embedding_size}
+        meta_path = os.path.join(self.storage_path, 'meta.json')
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(meta_path + '.tmp', meta_path)  # Atomic, a crash leaves the old or the new meta
+        stat = os.stat(meta_path)
+        self.meta_signature = (stat.st_ino, stat.st_mtime_ns)
+
+    def snapshot(self) -> tuple:
+        '''
+        Consistent (count, vectors, ids, payloads) views for a search, without holding the lock during the search.
+        Rows written by other processes are included once their meta.json is written (after their data).
+        '''
+        self.store_loader.get()
+        with self.write_lock:
+            self.reload_meta()
+            return self.count, self.vectors[:self.count], self.ids[:self.count], self.payloads[:self.count]
+
+    def upsert(self, ids: list, embeddings: np.ndarray, payloads: list = None):
+        self.store_loader.get()
+        embeddings = np.array(embeddings, dtype=np.float32).reshape(len(ids), self.embedding_size)
+        embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)  # Cosine similarity becomes a dot product
+        payload_matrix = self.build_payload_matrix(payloads, len(ids))  # Like Qdrant, an upsert replaces the whole payload
+
+        with self.exclusive_write():
+            next_row = self.count
+            new_rows = {}
+            rows = np.empty(len(ids), dtype=np.int64)
+            for i, id in enumerate(ids):
+                id = int(id)
+                row = self.row_by_id.get(id, new_rows.get(id))
+                if row is None:
+                    row = new_rows[id] = next_row
+                    next_row += 1
+                rows[i] = row
+
+            if next_row > self.capacity:
+                self.flush_and_grow(next_row)
+            self.vectors[rows] = embeddings
+            self.ids[rows] = np.asarray(ids, dtype=np.int64)
+            self.payloads[rows] = payload_matrix
+            self.row_by_id.update(new_rows)
+            self.count = next_row
+            self.version += 1
+            if len(new_rows) < len(ids):
+                self.overwrite_version = self.version
+            if hnswlib is not None and not self.hnsw_needs_rebuild:
+                self.hnsw_dirty_rows.update(rows.tolist())
+                if len(self.hnsw_dirty_rows) > constants.LOCAL_VECTOR_STORE_HNSW_THRESHOLD:  # Cheaper to rebuild than to track
+                    self.hnsw_needs_rebuild = True
+                    self.hnsw_dirty_rows = set()
+            self.save_meta()
+
+    def flush_and_grow(self, min_capacity: int):
+        for array in (self.vectors, self.ids, self.payloads):
+            array.flush()
+        # Searches still holding the old views keep reading valid (smaller) mappings
+        self.map_files(max(min_capacity, self.capacity * 2))
+
+    def build_payload_matrix(self, payloads: list, size: int) -> np.ndarray:
+        payload_matrix = np.full((size, max(len(self.payload_fields), 1)), np.nan, dtype=np.float64)
+        for i, payload in enumerate(payloads or []):
+            for j, field_name in enumerate(self.payload_fields):
+                value = (payload or {}).get(field_name)
+                if value is not None:
+                    payload_matrix[i, j] = value
+        return payload_matrix
+
+    ### VectorStore ###
+
+    def warmup(self):
+        count, _, _, _ = self.snapshot()
+        self.get_hnsw_index(count)
+
+    def delete_collection(self):
+        with self.write_lock:
+            self.vectors = self.ids = self.payloads = None
+            shutil.rmtree(self.storage_path, ignore_errors=True)
+            self.meta_signature = None
+            self.store_loader = LazyResource(self.load, name=f"local vector collection '{self.collection_name}'")
+            with self.hnsw_lock:
+                self.hnsw_index = None
+                self.hnsw_version = None
+                self.hnsw_dirty_rows = set()
+                self.hnsw_needs_rebuild = False
+        print(f"Collection '{self.collection_name}' deleted successfully.")
+
+    def record_embedding_into_collection(self, id: int, embedding: np.ndarray, payload: dict = None):
+        self.upsert([id], embedding, [payload])
+
+    def set_payload(self, id: int, payload: dict) -> bool:
+        with self.exclusive_write():
+            row = self.row_by_id.get(int(id))
+            if row is None:
+                return False
+            for j, field_name in enumerate(self.payload_fields):
+                if field_name in payload:
+                    self.payloads[row, j] = np.nan if payload[field_name] is None else payload[field_name]
+            self.save_meta()  # Vectors are unchanged, so the version and the HNSW index stay valid
+        return True
+
+    def record_embeddings_batch(self, ids: list, embeddings: np.ndarray, payloads: list = None, batch_size: int = None, parallel: int = None, wait: bool = True) -> list:
+        '''
+        Same as `QdrantDatabase.record_embeddings_batch`. Batches are written one after the other (`parallel` is ignored,
+        writes to one file are serialized anyway) and are always completed when this returns.
+        '''
+        batch_size = constants.QDRANT_UPSERT_BATCH_SIZE if batch_size is None else batch_size
+        ids = list(ids)
+        if len(ids) != len(embeddings):
+            raise ValueError(f"Got {len(ids)} ids for {len(embeddings)} embeddings")
+
+        batch_statuses = []
+        for batch_index, start in enumerate(range(0, len(ids), batch_size)):
+            end = start + batch_size
+            try:
+                self.upsert(ids[start:end], embeddings[start:end], None if payloads is None else payloads[start:end])
+                batch_statuses.append({'batch': batch_index, 'size': len(ids[start:end]), 'status': 'completed', 'error': None})
+            except Exception as e:
+                batch_statuses.append({'batch': batch_index, 'size': len(ids[start:end]), 'status': 'failed', 'error': str(e)})
+        return batch_statuses
+
+    def load_all_embeddings(self, payload_ranges: dict = None, page_size: int = 1000):
+        _, vectors, ids, payloads = self.snapshot()
+        mask = self.build_payload_mask(payloads, payload_ranges)
+        if mask is None:
+            return np.array(ids), np.array(vectors)  # Copies, callers may modify them
+        return ids[mask], vectors[mask]
+
+    def retrieve_embeddings(self, ids: list):
+        self.store_loader.get()
+        with self.write_lock:  # Rows are stable while the lock is held, an upsert cannot move or overwrite them
+            self.reload_meta()
+            found = [(int(id), self.row_by_id[int(id)]) for id in ids if int(id) in self.row_by_id]
+            rows = np.array([row for _, row in found], dtype=np.int64)
+            embeddings = np.array(self.vectors[rows]).reshape(len(found), self.embedding_size)
+        return np.array([id for id, _ in found], dtype=np.int64), embeddings
+
+    def search_similar_products(self, query_embedding: np.ndarray, k: int = 50, similarity_threshold: float = 0.3, payload_ranges: dict = None, return_scores: bool = False, hnsw_ef: int = None, exact: bool = False) -> list:
+        count, vectors, ids, payloads = self.snapshot()
+        if count == 0 or k <= 0:
+            return []
+        query = np.asarray(query_embedding, dtype=np.float32).ravel()
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+        mask = self.build_payload_mask(payloads, payload_ranges)
+
+        rows, scores = None, None
+        hnsw_index = None if exact else self.get_hnsw_index(count)
+        if hnsw_index is not None:
+            rows, scores = self.search_hnsw(hnsw_index, query, k, similarity_threshold, count, mask, hnsw_ef)
+        if rows is None:
+            rows, scores = self.search_exact(vectors, query, k, similarity_threshold, mask)
+
+        point_ids = ids[rows].tolist()
+        return list(zip(point_ids, scores.tolist())) if return_scores else point_ids
+
+    async def search_similar_products_async(self, query_embedding: np.ndarray, k: int = 50, similarity_threshold: float = 0.3, payload_ranges: dict = None, return_scores: bool = False, hnsw_ef: int = None, exact: bool = False) -> list:
+        '''
+        Small collections are searched inline (a single sub-millisecond matrix-vector product); large ones on a worker
+        thread so an exact fallback scan cannot stall the event loop.
+        '''
+        if self.store_loader.loaded and self.count < constants.LOCAL_VECTOR_STORE_HNSW_THRESHOLD:
+            return self.search_similar_products(query_embedding, k, similarity_threshold, payload_ranges, return_scores, hnsw_ef, exact)
+        return await asyncio.to_thread(self.search_similar_products, query_embedding, k, similarity_threshold, payload_ranges, return_scores, hnsw_ef, exact)
+
+    ### Search ###
+
+    def build_payload_mask(self, payloads: np.ndarray, payload_ranges: dict = None) -> np.ndarray:
+        '''
+        Boolean row mask of the inclusive payload ranges, or None without any bound. Unset (NaN) values never match.
+        '''
+        mask = None
+        for field_name, (lower, upper) in (payload_ranges or {}).items():
+            if lower is None and upper is None:
+                continue
+            if field_name not in self.payload_fields:
+                return np.zeros(len(payloads), dtype=bool)  # Not stored, so no point has it
+            column = payloads[:, self.payload_fields.index(field_name)]
+            condition = np.ones(len(payloads), dtype=bool)
+            if lower is not None:
+                condition &= column >= lower
+            if upper is not None:
+                condition &= column <= upper
+            mask = condition if mask is None else mask & condition
+        return mask
+
+    @staticmethod
+    def search_exact(vectors: np.ndarray, query: np.ndarray, k: int, similarity_threshold: float, mask: np.ndarray = None) -> tuple:
+        scores = vectors @ query
+        if mask is not None:
+            scores = np.where(mask, scores, -np.inf)
+        k = min(k, len(scores))
+        top_rows = np.argpartition(-scores, k - 1)[:k]
+        top_rows = top_rows[np.argsort(-scores[top_rows], kind='stable')]
+        keep = scores[top_rows] > -np.inf
+        if similarity_threshold is not None:
+            keep &= scores[top_rows] >= similarity_threshold
+        top_rows = top_rows[keep]
+        return top_rows, scores[top_rows]
+
+    def search_hnsw(self, hnsw_index, query: np.ndarray, k: int, similarity_threshold: float, count: int, mask: np.ndarray = None, hnsw_ef: int = None) -> tuple:
+        '''
+        Returns (rows, scores), or (None, None) when filtering left fewer than k neighbours that an exact scan could find.
+        '''
+        query_k = min(count, k * constants.LOCAL_VECTOR_STORE_HNSW_OVERSAMPLING)
+        with self.hnsw_lock:
+            hnsw_index.set_ef(max(constants.LOCAL_VECTOR_STORE_HNSW_EF_SEARCH if hnsw_ef is None else hnsw_ef, query_k))
+            labels, distances = hnsw_index.knn_query(query, k=query_k)
+        rows = labels[0].astype(np.int64)
+        scores = 1.0 - distances[0]  # Inner product space: distance = 1 - cosine similarity for normalized vectors
+
+        keep = (rows < count) if mask is None else (rows < count) & mask[np.minimum(rows, count - 1)]
+        if similarity_threshold is not None:
+            keep &= scores >= similarity_threshold
+        rows, kept_scores = rows[keep][:k], scores[keep][:k]
+
+        # Fewer than k: either all remaining points are below the threshold (neighbours come best first), or the filter
+        # removed too many of the approximate neighbours and only the exact scan finds the rest
+        beyond_threshold = similarity_threshold is not None and len(scores) > 0 and scores[-1] < similarity_threshold
+        if len(rows) < k and query_k < count and not beyond_threshold:
+            return None, None
+        return rows, kept_scores.astype(np.float32)
+
+    def get_hnsw_index(self, count: int):
+        '''
+        HNSW index for collections of at least `constants.LOCAL_VECTOR_STORE_HNSW_THRESHOLD` points, else None.
+
+        Loaded from disk when it matches the stored write version, otherwise built from the vectors and saved. Later
+        writes are added incrementally (hnswlib replaces the vector of an existing label) before the next search.
+        '''
+        if hnswlib is None or count < constants.LOCAL_VECTOR_STORE_HNSW_THRESHOLD:
+            return None
+
+        with self.write_lock:
+            version, vectors, dirty_rows, needs_rebuild = self.version, self.vectors[:self.count], sorted(self.hnsw_dirty_rows), self.hnsw_needs_rebuild
+            self.hnsw_dirty_rows = set()
+            self.hnsw_needs_rebuild = False
+
+        with self.hnsw_lock:
+            if self.hnsw_index is None or needs_rebuild:
+                self.hnsw_index = self.load_or_build_hnsw_index(version, vectors)
+            elif self.hnsw_version != version and dirty_rows:
+                if len(vectors) > self.hnsw_index.get_max_elements():
+                    self.hnsw_index.resize_index(max(len(vectors), 2 * self.hnsw_index.get_max_elements()))
+                self.hnsw_index.add_items(np.asarray(vectors[dirty_rows]), np.asarray(dirty_rows, dtype=np.int64))
+            self.hnsw_version = version
+            return self.hnsw_index
+
+    def load_or_build_hnsw_index(self, version: int, vectors: np.ndarray):
+        index_path = os.path.join(self.storage_path, 'hnsw.bin')
+        index_meta_path = os.path.join(self.storage_path, 'hnsw.json')
+        hnsw_index = hnswlib.Index(space='ip', dim=self.embedding_size)
+
+        if os.path.exists(index_meta_path):
+            with open(index_meta_path) as f:
+                if json.load(f)['version'] == version:
+                    hnsw_index.load_index(index_path, max_elements=len(vectors))
+                    return hnsw_index
+
+        print(f"Building HNSW index over {len(vectors)} points of '{self.collection_name}'...")
+        hnsw_index.init_index(
+            max_elements=len(vectors),
+            M=constants.LOCAL_VECTOR_STORE_HNSW_M,
+            ef_construction=constants.LOCAL_VECTOR_STORE_HNSW_EF_CONSTRUCTION,
+        )
+        hnsw_index.add_items(np.asarray(vectors), np.arange(len(vectors), dtype=np.int64))
+        hnsw_index.save_index(index_path)
+        with open(index_meta_path, 'w') as f:
+            json.dump({'version': version}, f)
+        return hnsw_index
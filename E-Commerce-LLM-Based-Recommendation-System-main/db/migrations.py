@@ -0,0 +1,173 @@
+import sys
+from typing import Callable, List
+from sqlalchemy import text, insert
+from sqlalchemy.engine import Engine, Connection
+from sqlalchemy.sql import func
+from sqlmodel import SQLModel, select
+
+from db.sql_models import Product, SearchHistory, Recommendation, RecommendationFeedback, SchemaMigration, RecommendationFeedbackRatingCount, RecommendationFeedbackRatingBucket
+from db.rating_summary import rebuild_rating_summary
+
+
+class Migration:
+    '''
+    One versioned, idempotent schema change.
+
+    Parameters:
+        - version (int): strictly increasing across MIGRATIONS
+        - description (str)
+        - upgrade (callable): upgrade(connection), runs inside the transaction that also records the version
+    '''
+
+    def __init__(self, version: int, description: str, upgrade: Callable[[Connection], None]):
+        self.version = version
+        self.description = description
+        self.upgrade = upgrade
+
+
+def create_model_indexes(connection: Connection, index_names: List[str]):
+    '''
+    Creates the named indexes declared in the models' `__table_args__` unless they already exist.
+    New databases get them from `create_all`, existing databases get them from here.
+    '''
+    indexes = {index.name: index for table in SQLModel.metadata.tables.values() for index in table.indexes}
+    for index_name in index_names:
+        indexes[index_name].create(connection, checkfirst=True)
+
+
+def create_rating_summary(connection: Connection):
+    RecommendationFeedbackRatingCount.__table__.create(connection, checkfirst=True)
+    RecommendationFeedbackRatingBucket.__table__.create(connection, checkfirst=True)
+    rebuild_rating_summary(connection)
+
+
+MIGRATIONS = [
+    Migration(1, 'Secondary indexes on hot filter and foreign key columns', lambda connection: create_model_indexes(connection, [
+        'ix_searchhistory_user_id_created_at',
+        'ix_product_stock_price',
+        'ix_product_category_id',
+        'ix_recommendation_user_id_created_at',
+        'ix_recommendationfeedback_rating',
+        'ix_recommendationfeedback_user_id',
+    ])),
+    Migration(2, 'Incremental rating summary tables, backfilled from existing feedback', create_rating_summary),
+]
+
+
+class SchemaMigrator:
+    '''
+    Brings an existing database up to the schema of the models.
+
+    `create_all` only creates missing tables, so anything added to an existing table (indexes, columns, backfills) is a
+    Migration. Applied versions are recorded in the `schemamigration` table; each migration and its record commit together.
+    '''
+
+    def __init__(self, engine: Engine, migrations: List[Migration] = None):
+        self.engine = engine
+        self.migrations = sorted(MIGRATIONS if migrations is None else migrations, key=lambda migration: migration.version)
+
+    def current_version(self) -> int:
+        with self.engine.connect() as connection:
+            return connection.execute(select(func.max(SchemaMigration.version))).scalar() or 0
+
+    def pending_migrations(self) -> List[Migration]:
+        current_version = self.current_version()
+        return [migration for migration in self.migrations if migration.version > current_version]
+
+    def migrate(self) -> List[int]:
+        '''
+        Applies the pending migrations in version order.
+
+        Returns:
+            - list of the applied versions
+        '''
+        SchemaMigration.__table__.create(self.engine, checkfirst=True)
+        applied_versions = []
+        for migration in self.pending_migrations():
+            print(f"Applying schema migration {migration.version}: {migration.description}")
+            with self.engine.begin() as connection:
+                migration.upgrade(connection)
+                connection.execute(insert(SchemaMigration).values(version=migration.version, description=migration.description))
+            applied_versions.append(migration.version)
+        return applied_versions
+
+
+def build_hot_query_statements() -> dict:
+    '''
+    Representative statements of the request path with the index each one should use.
+
+    Returns:
+        - dict name -> (statement, expected index name)
+    '''
+    return {
+        'user search history': (
+            select(SearchHistory.query)
+            .where(SearchHistory.user_id == 1)
+            .order_by(SearchHistory.created_at.desc(), SearchHistory.search_id.desc())
+            .limit(20),
+            'ix_searchhistory_user_id_created_at',
+        ),
+        'in-stock price range': (
+            select(Product.product_id).where(Product.stock >= 1, Product.price >= 10.0, Product.price <= 100.0),
+            'ix_product_stock_price',
+        ),
+        'products of category': (
+            select(Product.product_id).where(Product.category_id == 1),
+            'ix_product_category_id',
+        ),
+        'user recommendations': (
+            select(Recommendation.recommendation_id)
+            .where(Recommendation.user_id == 1)
+            .order_by(Recommendation.created_at.desc()),
+            'ix_recommendation_user_id_created_at',
+        ),
+        'rating summary': (
+            select(RecommendationFeedback.rating, func.count(RecommendationFeedback.rating)).group_by(RecommendationFeedback.rating),
+            'ix_recommendationfeedback_rating',
+        ),
+        'user feedbacks': (
+            select(RecommendationFeedback.recommendation_feedback_id).where(RecommendationFeedback.user_id == 1),
+            'ix_recommendationfeedback_user_id',
+        ),
+    }
+
+
+def check_query_plans(engine: Engine) -> dict:
+    '''
+    Explains every hot query and checks that its plan uses the expected index.
+
+    PostgreSQL's planner prefers sequential scans on small tables, so there a missing index in the plan only means
+    something on production-sized data.
+
+    Returns:
+        - dict name -> (uses expected index (bool), plan text)
+    '''
+    explain = 'EXPLAIN QUERY PLAN' if engine.dialect.name == 'sqlite' else 'EXPLAIN'
+    results = {}
+    with engine.connect() as connection:
+        for name, (statement, index_name) in build_hot_query_statements().items():
+            compiled_statement = statement.compile(dialect=engine.dialect, compile_kwargs={'literal_binds': True})
+            rows = connection.execute(text(f'{explain} {compiled_statement}')).all()
+            plan = '\n'.join(str(row[-1]) for row in rows)  # Last column is the plan detail in both dialects
+            results[name] = (index_name in plan, plan)
+    return results
+
+
+if __name__ == '__main__':
+    # python -m db.migrations: migrates the configured database and verifies the query plans of the hot queries
+    from sqlmodel import create_engine
+    import constants
+    from db.sql_db import build_database_url, build_engine_options, apply_sqlite_storage_profile
+
+    database_url = build_database_url(constants.SQL_DB_PATH)
+    engine = create_engine(database_url, **build_engine_options(database_url))
+    if engine.dialect.name == 'sqlite':
+        apply_sqlite_storage_profile(engine)
+    SQLModel.metadata.create_all(engine)
+    print(f"Applied migrations: {SchemaMigrator(engine).migrate()}")
+
+    failed = False
+    for name, (uses_index, plan) in check_query_plans(engine).items():
+        failed |= not uses_index
+        print(f"[{'OK' if uses_index else 'MISSING INDEX'}] {name}\n    {plan}")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,31 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import constants
+
+
+class ModelExecutor:
+    '''
+    Bounded thread pool for blocking model work (SentenceTransformer encoding, T5 generation) called from async endpoints.
+
+    `max_workers` caps how many model calls run at once; `max_pending` caps how many may wait for a worker. Callers beyond that
+    wait on a semaphore inside the event loop instead of piling up unbounded work in the pool queue.
+    '''
+
+    def __init__(self, max_workers: int = None, max_pending: int = None):
+        self.max_workers = constants.MODEL_EXECUTOR_MAX_WORKERS if max_workers is None else max_workers
+        self.max_pending = constants.MODEL_EXECUTOR_MAX_PENDING if max_pending is None else max_pending
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='model')
+        self._semaphore = None  # Created lazily, it must belong to the running event loop
+
+    async def run(self, fn, *args, **kwargs):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_workers + self.max_pending)
+
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, functools.partial(fn, *args, **kwargs))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
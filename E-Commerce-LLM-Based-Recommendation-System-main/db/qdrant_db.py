@@ -1,37 +1,142 @@
 import os
-import spacy
 import numpy as np
-from qdrant_client import QdrantClient
-from qdrant_client.models import PointStruct, VectorParams, Distance
+from concurrent.futures import ThreadPoolExecutor
+from qdrant_client import QdrantClient, AsyncQdrantClient
+from qdrant_client.models import PointStruct, VectorParams, Distance, Batch, Filter, FieldCondition, Range, PayloadSchemaType
+from qdrant_client.models import HnswConfigDiff, VectorParamsDiff, SearchParams, QuantizationSearchParams, Disabled
+from qdrant_client.models import ScalarQuantization, ScalarQuantizationConfig, ScalarType, ProductQuantization, ProductQuantizationConfig, CompressionRatio
 from qdrant_client.http.exceptions import UnexpectedResponse
 
 from db.embedder import TextEmbedder
+from db.lazy import LazyResource
+from db.vector_store import VectorStore
 import constants
 
-class QdrantDatabase:
+class QdrantDatabase(VectorStore):
+    '''
+    VectorStore backed by the Qdrant server at `constants.QDRANT_URL`.
 
-    def __init__(self, collection_name: str):
+    Index and storage settings come from constants: HNSW graph (`QDRANT_HNSW_M`, `QDRANT_HNSW_EF_CONSTRUCT`), on-disk
+    vectors / graph, and optional int8 scalar or product quantization. With quantization, searches run on the compressed
+    vectors (kept in RAM) for `QDRANT_SEARCH_OVERSAMPLING * k` candidates and rescore them with the original vectors.
+    Settings changed in constants are applied to an existing collection on connect; Qdrant rebuilds it in the background.
+    Use `python -m db.benchmark_vector_search` to pick them.
+    '''
+
+    def __init__(self, collection_name: str, payload_schema: dict = None):
         self.db_location = constants.QDRANT_STORAGE_PATH
         self.collection_name = collection_name
-        self.client = QdrantClient("http://localhost:6333")  # Connect to the Qdrant instance
+        self.payload_schema = {} if payload_schema is None else payload_schema
+        # Connected on first use, so constructing the database neither blocks on nor fails without a running Qdrant
+        self.client_loader = LazyResource(self.connect, name=f"Qdrant collection '{collection_name}'")
+        self.async_client_loader = LazyResource(lambda: AsyncQdrantClient(constants.QDRANT_URL), name='async Qdrant client')
+
+    def connect(self) -> QdrantClient:
+        client = QdrantClient(constants.QDRANT_URL)  # Connect to the Qdrant instance
         # self.delete_collection() # degub
-        self.create_collection_if_not_exists()
+        self.create_collection_if_not_exists(client)
+        self.update_collection_config_if_changed(client)
+        self.create_payload_indexes_if_not_exist(client)
+        return client
+
+    @property
+    def client(self) -> QdrantClient:
+        return self.client_loader.get()
+
+    @property
+    def async_client(self) -> AsyncQdrantClient:
+        self.client_loader.get()  # Same instance, used from the event loop; the sync connection makes sure the collection exists
+        return self.async_client_loader.get()
+
+    def warmup(self):
+        self.client_loader.get()
+
+    async def close_async_client(self):
+        if self.async_client_loader.loaded:
+            await self.async_client.close()
 
-    def create_collection_if_not_exists(self):
+    def create_collection_if_not_exists(self, client: QdrantClient):
         try:
             # Check if the collection already exists
-            self.client.get_collection(self.collection_name)
+            client.get_collection(self.collection_name)
             print(f"Collection '{self.collection_name}' already exists.")
         except Exception as e:
             if "Not found" in str(e):
                 print(f"Collection '{self.collection_name}' not found. Creating...")
-                self.client.create_collection(
+                client.create_collection(
                     collection_name=self.collection_name,
-                    vectors_config=VectorParams(size=TextEmbedder.embedding_size, distance=Distance.COSINE),  # Adjust size and distance as needed
+                    vectors_config=VectorParams(size=TextEmbedder.embedding_size, distance=Distance.COSINE, on_disk=constants.QDRANT_VECTORS_ON_DISK),
+                    hnsw_config=self.build_hnsw_config(),
+                    quantization_config=self.build_quantization_config(),
                 )
                 print(f"Collection '{self.collection_name}' created successfully.")
             else:
                 raise e
+
+    def update_collection_config_if_changed(self, client: QdrantClient):
+        '''
+        Applies HNSW, on-disk and quantization settings from constants to an existing collection when they differ.
+        '''
+        config = client.get_collection(self.collection_name).config
+        hnsw_config = self.build_hnsw_config()
+        quantization_config = self.build_quantization_config()
+
+        hnsw_changed = (config.hnsw_config.m, config.hnsw_config.ef_construct, bool(config.hnsw_config.on_disk)) != (hnsw_config.m, hnsw_config.ef_construct, hnsw_config.on_disk)
+        vectors_changed = bool(config.params.vectors.on_disk) != constants.QDRANT_VECTORS_ON_DISK
+        quantization_changed = self.describe_quantization_config(config.quantization_config) != self.describe_quantization_config(quantization_config)
+        if not (hnsw_changed or vectors_changed or quantization_changed):
+            return
+
+        print(f"Updating index settings of collection '{self.collection_name}' (rebuilt by Qdrant in the background)...")
+        client.update_collection(
+            collection_name=self.collection_name,
+            vectors_config={'': VectorParamsDiff(on_disk=constants.QDRANT_VECTORS_ON_DISK)} if vectors_changed else None,  # '' is the unnamed vector
+            hnsw_config=hnsw_config if hnsw_changed else None,
+            quantization_config=(Disabled.DISABLED if quantization_config is None else quantization_config) if quantization_changed else None,
+        )
+
+    @staticmethod
+    def build_hnsw_config() -> HnswConfigDiff:
+        return HnswConfigDiff(m=constants.QDRANT_HNSW_M, ef_construct=constants.QDRANT_HNSW_EF_CONSTRUCT, on_disk=constants.QDRANT_HNSW_ON_DISK)
+
+    @staticmethod
+    def build_quantization_config():
+        if constants.QDRANT_QUANTIZATION is None:
+            return None
+        if constants.QDRANT_QUANTIZATION == 'scalar':
+            return ScalarQuantization(scalar=ScalarQuantizationConfig(
+                type=ScalarType.INT8,
+                quantile=constants.QDRANT_SCALAR_QUANTIZATION_QUANTILE,
+                always_ram=constants.QDRANT_QUANTIZATION_ALWAYS_RAM,
+            ))
+        if constants.QDRANT_QUANTIZATION == 'product':
+            return ProductQuantization(product=ProductQuantizationConfig(
+                compression=CompressionRatio(constants.QDRANT_PRODUCT_QUANTIZATION_COMPRESSION),
+                always_ram=constants.QDRANT_QUANTIZATION_ALWAYS_RAM,
+            ))
+        raise ValueError(f"Unknown QDRANT_QUANTIZATION '{constants.QDRANT_QUANTIZATION}', expected None, 'scalar' or 'product'")
+
+    @staticmethod
+    def describe_quantization_config(quantization_config) -> tuple:
+        '''
+        Comparable summary of a quantization config (as sent or as reported by Qdrant).
+        '''
+        if isinstance(quantization_config, ScalarQuantization):
+            return ('scalar', quantization_config.scalar.quantile, bool(quantization_config.scalar.always_ram))
+        if isinstance(quantization_config, ProductQuantization):
+            return ('product', str(quantization_config.product.compression.value), bool(quantization_config.product.always_ram))
+        return (None,)
+
+    def create_payload_indexes_if_not_exist(self, client: QdrantClient):
+        indexed_fields = client.get_collection(self.collection_name).payload_schema
+        for field_name, field_schema in self.payload_schema.items():
+            if field_name not in indexed_fields:
+                client.create_payload_index(
+                    collection_name=self.collection_name,
+                    field_name=field_name,
+                    field_schema=PayloadSchemaType(field_schema),
+                )
+                print(f"Payload index on '{field_name}' created for collection '{self.collection_name}'.")
             
     def delete_collection(self):
         try:
@@ -42,42 +147,188 @@ class QdrantDatabase:
         except Exception as e:
             print(f"Failed to delete collection '{self.collection_name}': {e}")
 
-    def record_embedding_into_collection(self, id: int, embedding: np.ndarray):        
+    def record_embedding_into_collection(self, id: int, embedding: np.ndarray, payload: dict = None):        
         point = PointStruct(
             id=id,
             vector=embedding.tolist(),  # Convert the numpy array to a list
-            # payload={"name": name, "category": category, "description": description}  # Optional metadata
+            payload=payload,  # Filterable metadata, see PRODUCT_PAYLOAD_SCHEMA
         )
 
         self.client.upsert(collection_name=self.collection_name, points=[point])
 
-    def search_similar_products(self, query_embedding: np.ndarray, k: int = 50, similarity_threshold: float = 0.3):
+    def set_payload(self, id: int, payload: dict) -> bool:
+        '''
+        Overwrites the given payload keys of one point without touching its vector.
+        '''
+        try:
+            self.client.set_payload(collection_name=self.collection_name, payload=payload, points=[id])
+        except UnexpectedResponse as e:
+            if e.status_code == 404:  # No point with this id
+                return False
+            raise
+        return True
+
+    def record_embeddings_batch(self, ids: list, embeddings: np.ndarray, payloads: list = None, batch_size: int = None, parallel: int = None, wait: bool = True) -> list:
+        '''
+        Upserts many points. `embeddings` row i belongs to `ids[i]`.
+
+        The matrix is split into batches of `batch_size` rows which are sent concurrently by `parallel` workers.
+        Each batch is converted to a list in one call inside its worker and sent without pydantic re-validation,
+        so there is no per-row Python work on the caller's thread.
+
+        Parameters:
+            - ids (list): point ids
+            - embeddings (np.ndarray): float32 matrix of shape (len(ids), embedding_size)
+            - payloads (list[dict]): optional payload per point
+            - batch_size (int): points per request (default `constants.QDRANT_UPSERT_BATCH_SIZE`)
+            - parallel (int): concurrent requests (default `constants.QDRANT_UPSERT_PARALLEL`)
+            - wait (bool): wait until Qdrant has applied each batch. With False a batch is acknowledged once it is queued.
+
+        Returns:
+            - list of dict, one per batch in order: {'batch': index, 'size': points, 'status': 'acknowledged' | 'completed' | 'failed', 'error': str | None}
+        '''
+        batch_size = constants.QDRANT_UPSERT_BATCH_SIZE if batch_size is None else batch_size
+        parallel = constants.QDRANT_UPSERT_PARALLEL if parallel is None else parallel
+
+        ids = list(ids)
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if len(ids) != len(embeddings):
+            raise ValueError(f"Got {len(ids)} ids for {len(embeddings)} embeddings")
+
+        batch_starts = range(0, len(ids), batch_size)
+
+        def upsert_batch(batch_index: int, start: int) -> dict:
+            end = start + batch_size
+            batch = Batch.model_construct(
+                ids=ids[start:end],
+                vectors=embeddings[start:end].tolist(),
+                payloads=None if payloads is None else payloads[start:end],
+            )
+            try:
+                result = self.client.upsert(collection_name=self.collection_name, points=batch, wait=wait)
+                return {'batch': batch_index, 'size': len(batch.ids), 'status': str(result.status.value), 'error': None}
+            except Exception as e:
+                return {'batch': batch_index, 'size': len(batch.ids), 'status': 'failed', 'error': str(e)}
+
+        if parallel <= 1 or len(batch_starts) <= 1:
+            return [upsert_batch(i, start) for i, start in enumerate(batch_starts)]
+
+        with ThreadPoolExecutor(max_workers=parallel) as executor:
+            return list(executor.map(upsert_batch, range(len(batch_starts)), batch_starts))
+
+    def load_all_embeddings(self, payload_ranges: dict = None, page_size: int = 1000):
+        '''
+        Reads every point (optionally filtered like `search_similar_products`) with its vector, for offline matrix scoring.
+
+        Returns:
+            - (ids, embeddings): int64 array of point ids and float32 matrix of shape (len(ids), embedding_size)
+        '''
+        ids = []
+        vectors = []
+        offset = None
+        while True:
+            points, offset = self.client.scroll(
+                collection_name=self.collection_name,
+                scroll_filter=self.build_range_filter(payload_ranges),
+                limit=page_size,
+                offset=offset,
+                with_payload=False,
+                with_vectors=True,
+            )
+            for point in points:
+                ids.append(point.id)
+                vectors.append(point.vector)
+            if offset is None:
+                break
+
+        embeddings = np.array(vectors, dtype=np.float32).reshape(len(vectors), TextEmbedder.embedding_size)
+        return np.array(ids, dtype=np.int64), embeddings
+
+    def retrieve_embeddings(self, ids: list):
+        '''
+        Vectors of the given points in one request, without their payloads. Qdrant does not keep the request order, so
+        the points are put back in it.
+        '''
+        points = self.client.retrieve(collection_name=self.collection_name, ids=list(ids), with_payload=False, with_vectors=True)
+        vector_by_id = {int(point.id): point.vector for point in points}
+        found_ids = [int(id) for id in ids if int(id) in vector_by_id]
+        embeddings = np.array([vector_by_id[id] for id in found_ids], dtype=np.float32).reshape(len(found_ids), TextEmbedder.embedding_size)
+        return np.array(found_ids, dtype=np.int64), embeddings
+
+    def search_similar_products(self, query_embedding: np.ndarray, k: int = 50, similarity_threshold: float = 0.3, payload_ranges: dict = None, return_scores: bool = False, hnsw_ef: int = None, exact: bool = False, oversampling: float = None, rescore: bool = None):
         """
         Search for the top k most similar products based on a query.
         
-        :param query: The query string to search for similar products.
-        :param k: The number of similar products to retrieve (default: 5).
-        :return: A list of similar products with metadata.
+        :param query_embedding: The embedding of the query to search for similar products.
+        :param k: The number of similar products to retrieve (default: 50).
+        :param similarity_threshold: Only include results above this similarity score.
+        :param payload_ranges: Inclusive payload filters applied inside Qdrant, e.g. {"price": (10.0, None), "stock": (1, None)}.
+            None bounds are open. Only points passing every range are counted towards k.
+        :param return_scores: Return (id, cosine similarity) pairs instead of ids.
+        :param hnsw_ef: Size of the HNSW candidate list for this query (default `constants.QDRANT_SEARCH_HNSW_EF`). Higher is slower and more accurate.
+        :param exact: Full scan without the HNSW index, e.g. as ground truth for benchmarks.
+        :param oversampling: With quantization, candidates fetched per result for rescoring (default `constants.QDRANT_SEARCH_OVERSAMPLING`).
+        :param rescore: With quantization, rescore candidates with the original vectors (default `constants.QDRANT_SEARCH_RESCORE`).
+        :return: A list of similar product ids, most similar first.
         """
 
         # Search for the most similar products
-        results = self.client.search(
+        search_params = self.build_search_params(hnsw_ef, exact, oversampling, rescore)
+        results = self.client.search(**self.build_search_request(query_embedding, k, similarity_threshold, payload_ranges, search_params))
+        return self.parse_search_results(results, return_scores)
+
+    async def search_similar_products_async(self, query_embedding: np.ndarray, k: int = 50, similarity_threshold: float = 0.3, payload_ranges: dict = None, return_scores: bool = False, hnsw_ef: int = None, exact: bool = False, oversampling: float = None, rescore: bool = None):
+        """
+        Non-blocking variant of `search_similar_products` for use inside the event loop.
+        """
+        search_params = self.build_search_params(hnsw_ef, exact, oversampling, rescore)
+        results = await self.async_client.search(**self.build_search_request(query_embedding, k, similarity_threshold, payload_ranges, search_params))
+        return self.parse_search_results(results, return_scores)
+
+    def build_search_request(self, query_embedding: np.ndarray, k: int, similarity_threshold: float, payload_ranges: dict, search_params: SearchParams = None) -> dict:
+        return dict(
             collection_name=self.collection_name,
             query_vector=query_embedding.tolist(),
+            query_filter=self.build_range_filter(payload_ranges),
+            search_params=search_params,
             limit=k,
             score_threshold=similarity_threshold,  # Only include results above this similarity score
-            # with_payload=True  # Include metadata in the results
+            with_payload=False,
         )
-        
+
+    @staticmethod
+    def build_search_params(hnsw_ef: int = None, exact: bool = False, oversampling: float = None, rescore: bool = None) -> SearchParams:
+        '''
+        With `exact` the quantized vectors are ignored as well, so the full scan scores the original vectors (ground truth).
+        '''
+        quantization = None
+        if constants.QDRANT_QUANTIZATION is not None and exact:
+            quantization = QuantizationSearchParams(ignore=True, rescore=False)
+        elif constants.QDRANT_QUANTIZATION is not None:
+            quantization = QuantizationSearchParams(
+                ignore=False,
+                rescore=constants.QDRANT_SEARCH_RESCORE if rescore is None else rescore,
+                oversampling=constants.QDRANT_SEARCH_OVERSAMPLING if oversampling is None else oversampling,
+            )
+        return SearchParams(
+            hnsw_ef=constants.QDRANT_SEARCH_HNSW_EF if hnsw_ef is None else hnsw_ef,
+            exact=exact,
+            quantization=quantization,
+        )
+
+    @staticmethod
+    def parse_search_results(results: list, return_scores: bool) -> list:
         similar_products = []
         for result in results:
-            print(result)
-            similar_products.append(result.id)
-            # payload = result.payload
-            # similar_products.append({
-            #     "product_id": product_id,
-            #     "name": payload["name"],
-            #     "description": payload["description"]
-            # })
+            similar_products.append((result.id, result.score) if return_scores else result.id)
 
         return similar_products
+
+    @staticmethod
+    def build_range_filter(payload_ranges: dict = None) -> Filter:
+        conditions = [
+            FieldCondition(key=field_name, range=Range(gte=lower, lte=upper))
+            for field_name, (lower, upper) in (payload_ranges or {}).items()
+            if lower is not None or upper is not None
+        ]
+        return Filter(must=conditions) if conditions else None
@@ -0,0 +1,98 @@
+from typing import Hashable, List
+import numpy as np
+
+import constants
+
+
+def reciprocal_rank_fusion(ranked_lists: List[List[Hashable]], weights: List[float] = None, k: int = 60) -> List[tuple]:
+    '''
+    Merges several ranked id lists into one ranking with (weighted) reciprocal rank fusion.
+
+    An id at 0-based position `rank` in list i contributes `weights[i] / (k + rank + 1)`; contributions of the same id are summed.
+    Rank-based fusion needs no calibration between retrievers, so BM25 and cosine scores can be combined as they are.
+
+    Parameters:
+        - ranked_lists (list[list]): ids ordered best first, one list per retriever. Duplicates within a list count once, at their best rank.
+        - weights (list[float]): weight per list (default 1.0 each)
+        - k (int): smoothing constant, larger values flatten the gap between top and lower ranks
+
+    Returns:
+        - list of (id, score) ordered by score descending, ties broken by first appearance
+    '''
+    weights = [1.0] * len(ranked_lists) if weights is None else weights
+    if len(weights) != len(ranked_lists):
+        raise ValueError(f"Got {len(weights)} weights for {len(ranked_lists)} ranked lists")
+
+    scores = {}  # Insertion ordered, which makes the sort below stable on first appearance
+    for ranked_ids, weight in zip(ranked_lists, weights):
+        seen = set()
+        for rank, id in enumerate(ranked_ids):
+            if id in seen:
+                continue
+            seen.add(id)
+            scores[id] = scores.get(id, 0.0) + weight / (k + rank + 1)
+
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+def top_k_by_similarity(query_embeddings: np.ndarray, item_embeddings: np.ndarray, k: int, max_block_elements: int = None) -> tuple:
+    '''
+    Top k items of every query by dot product (cosine similarity when both sides are L2-normalized), best first.
+
+    Queries are scored in blocks so the (queries, items) similarity matrix held at once stays below `max_block_elements`
+    (default `constants.SIMILARITY_BLOCK_MAX_ELEMENTS`), whatever the catalog size.
+
+    Returns:
+        - (indexes, similarities): int64 item indexes and float32 similarities, both of shape (len(query_embeddings), k)
+    '''
+    max_block_elements = constants.SIMILARITY_BLOCK_MAX_ELEMENTS if max_block_elements is None else max_block_elements
+    k = min(k, len(item_embeddings))
+    indexes = np.empty((len(query_embeddings), k), dtype=np.int64)
+    similarities = np.empty((len(query_embeddings), k), dtype=np.float32)
+    if k == 0:
+        return indexes, similarities
+
+    block_size = max(1, max_block_elements // len(item_embeddings))
+    for start in range(0, len(query_embeddings), block_size):
+        block_similarities = query_embeddings[start:start + block_size] @ item_embeddings.T
+        top_indexes = np.argpartition(-block_similarities, k - 1, axis=1)[:, :k]
+        top_similarities = np.take_along_axis(block_similarities, top_indexes, axis=1)
+        order = np.argsort(-top_similarities, axis=1)
+        indexes[start:start + block_size] = np.take_along_axis(top_indexes, order, axis=1)
+        similarities[start:start + block_size] = np.take_along_axis(top_similarities, order, axis=1)
+    return indexes, similarities
+
+
+def blend_user_embedding(profile_embedding: np.ndarray, history_embeddings: np.ndarray, history_weight: float, history_decay: float) -> np.ndarray:
+    '''
+    User embedding for scoring products: the profile embedding blended with recent search query embeddings.
+
+    Queries are weighted by recency, each older query `history_decay` times the next newer one, and together make up
+    `history_weight` of the blend. Inputs need not be normalized; each row is L2-normalized before blending.
+
+    Parameters:
+        - profile_embedding (np.ndarray): shape (embedding_size,)
+        - history_embeddings (np.ndarray): shape (queries, embedding_size), oldest first; may have no rows
+
+    Returns:
+        - L2-normalized float32 vector of shape (embedding_size,)
+    '''
+    def normalize(embeddings: np.ndarray) -> np.ndarray:
+        return embeddings / np.maximum(np.linalg.norm(embeddings, axis=-1, keepdims=True), 1e-12)
+
+    user_embedding = normalize(np.asarray(profile_embedding, dtype=np.float32))
+    if len(history_embeddings) > 0 and history_weight > 0:
+        recency_weights = history_decay ** np.arange(len(history_embeddings) - 1, -1, -1, dtype=np.float32)  # Newest query weighs 1
+        history_embedding = normalize((recency_weights / recency_weights.sum()) @ normalize(np.asarray(history_embeddings, dtype=np.float32)))
+        user_embedding = (1 - history_weight) * user_embedding + history_weight * history_embedding
+    return normalize(user_embedding).astype(np.float32)
+
+
+def is_decisive(similarities: list, min_score: float, min_margin: float) -> bool:
+    '''
+    Whether the best of the similarities (sorted best first) clears `min_score` and leads the runner-up by at least
+    `min_margin`, i.e. a reranker is unlikely to pick anything else.
+    '''
+    if len(similarities) == 0 or similarities[0] < min_score:
+        return False
+    return len(similarities) == 1 or similarities[0] - similarities[1] >= min_margin
@@ -0,0 +1,141 @@
+from datetime import datetime
+from sqlalchemy import delete, insert, literal_column
+from sqlalchemy.engine import Connection
+from sqlalchemy.dialects import sqlite, postgresql
+from sqlalchemy.sql import func
+from sqlmodel import select
+
+from db.sql_models import RecommendationFeedback, RecommendationFeedbackRatingCount, RecommendationFeedbackRatingBucket
+
+RATING_BUCKET_GRANULARITIES = ('hour', 'day')
+
+
+def truncate_to_bucket(timestamp: datetime, granularity: str) -> datetime:
+    '''
+    Start of the hour or day bucket that contains `timestamp`.
+    '''
+    if granularity == 'hour':
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    if granularity == 'day':
+        return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+    raise ValueError(f"Unknown granularity '{granularity}', expected one of {RATING_BUCKET_GRANULARITIES}")
+
+
+def build_counter_upsert_statement(dialect_name: str, table_model, index_elements: list):
+    '''
+    INSERT ... ON CONFLICT DO UPDATE that adds the inserted `feedback_count` to the stored one, for the given dialect.
+    '''
+    dialect_insert = postgresql.insert if dialect_name == 'postgresql' else sqlite.insert
+    statement = dialect_insert(table_model)
+    return statement.on_conflict_do_update(
+        index_elements=index_elements,
+        set_={'feedback_count': table_model.__table__.c.feedback_count + statement.excluded.feedback_count},
+    )
+
+
+def build_rating_increment_statements(dialect_name: str, rating: int, created_at: datetime, increment: int = 1) -> list:
+    '''
+    Statements, with their parameters, that count one feedback in the running total and in its hour and day buckets.
+    Executed in the transaction that inserts the feedback, so the summary never disagrees with the feedback table.
+
+    Returns:
+        - list of (statement, parameters)
+    '''
+    total_statement = build_counter_upsert_statement(dialect_name, RecommendationFeedbackRatingCount, ['rating'])
+    bucket_statement = build_counter_upsert_statement(dialect_name, RecommendationFeedbackRatingBucket, ['granularity', 'bucket_start', 'rating'])
+    bucket_rows = [
+        {'granularity': granularity, 'bucket_start': truncate_to_bucket(created_at, granularity), 'rating': rating, 'feedback_count': increment}
+        for granularity in RATING_BUCKET_GRANULARITIES
+    ]
+    return [
+        (total_statement, {'rating': rating, 'feedback_count': increment}),
+        (bucket_statement, bucket_rows),
+    ]
+
+
+def build_rating_summary_statement(since: datetime = None, until: datetime = None, granularity: str = None):
+    '''
+    Select of the rating summary. Reads only the counter tables, so its cost does not grow with the number of feedbacks.
+
+    - No window and no granularity: the running totals, rows (rating, count).
+    - A window without granularity: hourly buckets summed over the window, rows (rating, count).
+    - A granularity: one row per bucket and rating inside the (optional) window, rows (bucket_start, rating, count).
+
+    The window is aligned to buckets: `since` is rounded down to its bucket, buckets starting at or after `until` are excluded.
+    '''
+    if since is None and until is None and granularity is None:
+        return select(RecommendationFeedbackRatingCount.rating, RecommendationFeedbackRatingCount.feedback_count)
+
+    bucket_granularity = 'hour' if granularity is None else granularity
+    conditions = [RecommendationFeedbackRatingBucket.granularity == bucket_granularity]
+    if since is not None:
+        conditions.append(RecommendationFeedbackRatingBucket.bucket_start >= truncate_to_bucket(since, bucket_granularity))
+    if until is not None:
+        conditions.append(RecommendationFeedbackRatingBucket.bucket_start < until)
+
+    if granularity is None:
+        return (
+            select(RecommendationFeedbackRatingBucket.rating, func.sum(RecommendationFeedbackRatingBucket.feedback_count))
+            .where(*conditions)
+            .group_by(RecommendationFeedbackRatingBucket.rating)
+        )
+    return (
+        select(RecommendationFeedbackRatingBucket.bucket_start, RecommendationFeedbackRatingBucket.rating, RecommendationFeedbackRatingBucket.feedback_count)
+        .where(*conditions)
+        .order_by(RecommendationFeedbackRatingBucket.bucket_start, RecommendationFeedbackRatingBucket.rating)
+    )
+
+
+def format_rating_summary(rows: list, granularity: str = None) -> dict:
+    '''
+    Returns:
+        - dict rating -> count, or with a granularity dict bucket start (ISO format) -> {rating -> count}
+    '''
+    if granularity is None:
+        return {rating: int(count) for rating, count in rows if count}
+
+    summary = {}
+    for bucket_start, rating, count in rows:
+        if count:
+            summary.setdefault(bucket_start.isoformat(), {})[rating] = count
+    return summary
+
+
+def rebuild_rating_summary(connection: Connection):
+    '''
+    Recomputes the counter tables from the feedback table (one aggregate per granularity). Used by the schema migration
+    that introduced them; afterwards they are maintained incrementally.
+    '''
+    connection.execute(delete(RecommendationFeedbackRatingCount))
+    connection.execute(delete(RecommendationFeedbackRatingBucket))
+
+    totals = connection.execute(
+        select(RecommendationFeedback.rating, func.count(RecommendationFeedback.rating)).group_by(RecommendationFeedback.rating)
+    ).all()
+    if totals:
+        connection.execute(insert(RecommendationFeedbackRatingCount), [{'rating': rating, 'feedback_count': count} for rating, count in totals])
+
+    for granularity in RATING_BUCKET_GRANULARITIES:
+        # Literals instead of bound parameters, so the selected and grouped expressions are identical
+        if connection.dialect.name == 'postgresql':
+            bucket_start = func.date_trunc(literal_column(f"'{granularity}'"), RecommendationFeedback.created_at)
+        else:
+            bucket_format = '%Y-%m-%d %H:00:00' if granularity == 'hour' else '%Y-%m-%d 00:00:00'
+            bucket_start = func.strftime(literal_column(f"'{bucket_format}'"), RecommendationFeedback.created_at)
+        bucket_start = bucket_start.label('bucket_start')
+        buckets = connection.execute(
+            select(bucket_start, RecommendationFeedback.rating, func.count(RecommendationFeedback.rating))
+            .group_by(bucket_start, RecommendationFeedback.rating)
+        ).all()
+        rows = [
+            {
+                'granularity': granularity,
+                # SQLite returns text; re-insert as datetime so stored keys match the ones written by the incremental path
+                'bucket_start': datetime.fromisoformat(start) if isinstance(start, str) else start,
+                'rating': rating,
+                'feedback_count': count,
+            }
+            for start, rating, count in buckets
+        ]
+        if rows:
+            connection.execute(insert(RecommendationFeedbackRatingBucket), rows)
@@ -1,40 +1,131 @@
 import os
-from datetime import datetime
+import json
+import time
+import threading
+from datetime import datetime, timedelta
+from itertools import islice
 import pandas as pd
-from typing import Dict
+from typing import Dict, Iterable
+import numpy as np
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy import select, or_
+from sqlalchemy import select, insert, delete, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.dialects import sqlite, postgresql
 from sqlalchemy.sql import func
 from sqlmodel import SQLModel, create_engine, Session, select
 
 import constants
-from db.sql_models import User, Category, Product, SearchHistory, Recommendation, RecommendationFeedback
-from db.qdrant_db import QdrantDatabase
+from db.sql_models import User, Category, Product, SearchHistory, Recommendation, RecommendationFeedback, PrecomputedRecommendation, BulkIngestProgress
+from db.vector_store import create_vector_store, PRODUCT_PAYLOAD_SCHEMA
 from db.embedder import TextEmbedder
 from db.tokenizer import TextTokenizer
+from db.keyword_index import ProductKeywordIndex
+from db.ranking import reciprocal_rank_fusion
+from db.cache import LRUCache
+from db.user_context import UserContext
+from db.event_buffer import EventBuffer
+from db.migrations import SchemaMigrator
+from db.rating_summary import build_rating_increment_statements, build_rating_summary_statement, format_rating_summary
+
+def build_database_url(database_location: str, use_async_driver: bool = False) -> str:
+    '''
+    SQLAlchemy URL of the storage backend: `constants.SQL_DATABASE_URL` (e.g. PostgreSQL) when set, else the SQLite file.
+    '''
+    if constants.SQL_DATABASE_URL is None:
+        return f"sqlite+aiosqlite:///{database_location}" if use_async_driver else f"sqlite:///{database_location}"
+
+    url = make_url(constants.SQL_DATABASE_URL)
+    if use_async_driver and url.get_backend_name() == 'postgresql':
+        url = url.set(drivername='postgresql+asyncpg')
+    return url.render_as_string(hide_password=False)
+
+
+def build_engine_options(database_url: str) -> dict:
+    '''
+    Keyword arguments for create_engine / create_async_engine according to the storage profile in constants.
+    '''
+    options = {
+        'echo': constants.SQL_ECHO,
+        'pool_pre_ping': True,
+    }
+    if make_url(database_url).get_backend_name() == 'sqlite':
+        # Connections are shared by the API's thread pools; SQLite's own locking (busy timeout) serializes writers
+        options['connect_args'] = {'check_same_thread': False, 'timeout': constants.SQLITE_BUSY_TIMEOUT_MS / 1000}
+    options['pool_size'] = constants.SQL_POOL_SIZE
+    options['max_overflow'] = constants.SQL_POOL_MAX_OVERFLOW
+    return options
+
+
+def apply_sqlite_storage_profile(engine):
+    '''
+    Sets the SQLite PRAGMAs of the storage profile on every new pooled connection: WAL journal (readers do not block the writer),
+    synchronous=NORMAL (no fsync per commit in WAL mode, still crash safe), memory-mapped reads and a larger page cache.
+    '''
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA journal_mode={constants.SQLITE_JOURNAL_MODE}")
+        cursor.execute(f"PRAGMA synchronous={constants.SQLITE_SYNCHRONOUS}")
+        cursor.execute(f"PRAGMA mmap_size={constants.SQLITE_MMAP_SIZE}")
+        cursor.execute(f"PRAGMA cache_size=-{constants.SQLITE_CACHE_SIZE_KB}")  # Negative value is in KiB
+        cursor.execute(f"PRAGMA busy_timeout={constants.SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
+
+
+def is_unique_violation(error: IntegrityError) -> bool:
+    message = str(error.orig)
+    return "UNIQUE constraint failed" in message or "duplicate key value violates unique constraint" in message
+
 
 class DB:
 
     def __init__(self, database_location: str = None):
         self.database_location = constants.SQL_DB_PATH if database_location is None else database_location
         self.engine = None
+        self.keyword_index = None
+        self.event_buffer = None
         self.text_embedder = TextEmbedder()
-        self.qdrant_product_database = QdrantDatabase(collection_name=constants.QDRANT_PRODUCT_COLLECTION_NAME)
+        self.product_vector_store = create_vector_store(collection_name=constants.QDRANT_PRODUCT_COLLECTION_NAME, payload_schema=PRODUCT_PAYLOAD_SCHEMA)
         self.text_tokenizer = TextTokenizer()
+        self.user_context_cache = LRUCache(max_size=constants.USER_CONTEXT_CACHE_SIZE, ttl_seconds=constants.USER_CONTEXT_CACHE_TTL_SECONDS)
+        self.catalog_version = 0  # Bumped on every product change, invalidates cached recommendation candidates
+        self.product_embedding_index = None  # (catalog_version, product ids, normalized embeddings)
+        self.product_embedding_index_lock = threading.Lock()
         self.initialize_database()
         
     def initialize_database(self):
         if self.engine is None:
-            os.makedirs(os.path.dirname(self.database_location), exist_ok=True)
+            database_url = build_database_url(self.database_location)
+            self.engine = create_engine(database_url, **build_engine_options(database_url))
 
-            sqlite_url = f"sqlite:///{self.database_location}"
-            self.engine = create_engine(sqlite_url, echo=True)
-            
-            if os.path.exists(self.database_location):
-                pass
-            else:
-                print("Database does not exist. Initializing...")
-                SQLModel.metadata.create_all(self.engine)
+            if self.engine.dialect.name == 'sqlite':
+                os.makedirs(os.path.dirname(self.database_location), exist_ok=True)
+                apply_sqlite_storage_profile(self.engine)
+                if not os.path.exists(self.database_location):
+                    print("Database does not exist. Initializing...")
+            SQLModel.metadata.create_all(self.engine)  # Only creates missing tables, so new tables reach existing databases
+            SchemaMigrator(self.engine).migrate()  # Changes to existing tables (indexes, columns, backfills)
+
+            self.keyword_index = ProductKeywordIndex(self.engine, self.text_tokenizer)
+            self.keyword_index.create_if_not_exists()
+            self.event_buffer = EventBuffer(self.engine)
+
+    def warmup(self):
+        '''
+        Loads what the first search would otherwise load on demand: stopwords, the embedding model (with one forward pass)
+        and the vector store (Qdrant connection or local index).
+        '''
+        self.text_tokenizer.clean_text('warmup')
+        self.text_embedder.warmup()
+        self.product_vector_store.warmup()
+
+    def close(self):
+        '''
+        Flushes buffered writes. Call on shutdown.
+        '''
+        if self.event_buffer is not None:
+            self.event_buffer.close()
             
     def record_user(self, email: str, profile_description: str):
         user: User = User(email=email, profile_description=profile_description)
@@ -56,6 +147,10 @@ class DB:
                 user.updated_at = datetime.now()
                 session.commit()
                 session.refresh(user)
+            # Profile changed, the offline recommendation no longer reflects it
+            session.execute(delete(PrecomputedRecommendation).where(PrecomputedRecommendation.user_id == user_id))
+            session.commit()
+        self.user_context_cache.delete(user_id)
  
     def record_category(self, name: str, description: str):
         category: Category = Category(name=name, description=description)
@@ -87,42 +182,271 @@ class DB:
         
         product_category_str = self.get_data(table='Category', id=category_id)['name']
 
-        product_text = f'Product name is {name} and category is {product_category_str}. Description: {description}'
-        product_embedding = self.text_embedder.generate_embedding(product_text)
+        product_text = self.build_product_text(name, product_category_str, description)
+        product_embedding = self.text_embedder.generate_embedding(product_text, use_cache=False)
 
-        self.qdrant_product_database.record_embedding_into_collection(
+        self.product_vector_store.record_embedding_into_collection(
             id=product.product_id, 
-            embedding=product_embedding
+            embedding=product_embedding,
+            payload=self.build_product_payload(product.category_id, product.price, product.stock),
+        )
+        self.catalog_version += 1
+
+    @staticmethod
+    def build_product_payload(category_id: int, price: float, stock: int) -> dict:
+        '''
+        Product fields mirrored into the vector collection so searches can filter inside the vector store. Keep in sync with PRODUCT_PAYLOAD_SCHEMA.
+        '''
+        return {'category_id': category_id, 'price': price, 'stock': stock}
+
+    @staticmethod
+    def build_product_text(name: str, category_name: str, description: str) -> str:
+        return f'Product name is {name} and category is {category_name}. Description: {description}'
+
+    def bulk_record_products(self, products: Iterable, chunk_size: int = None, ingest_name: str = None) -> dict:
+        '''
+        Streaming catalog ingest. Rows are consumed in chunks; every chunk is embedded in one batch, inserted with one
+        executemany and upserted into the vector store with one request. Embedding runs before and the vector upsert
+        after the short insert transaction, so other writers are not blocked while the chunk is embedded or sent over
+        the network.
+
+        Parameters:
+            - products (iterable): rows as dicts with keys category_id, name, description, price, stock
+              or as tuples in that order. Consumed lazily, so generators over large files are fine.
+            - chunk_size (int): rows per chunk (default `constants.BULK_INGEST_CHUNK_SIZE`)
+            - ingest_name (str): key of the progress row in `BulkIngestProgress` (default `constants.BULK_INGEST_NAME`).
+              The row is written in the same transaction as each chunk insert, so it always matches the committed
+              products. When it exists the input offset it records is skipped and products it records as inserted but
+              not yet indexed are indexed first, so re-running the same input after a crash resumes where it stopped
+              without inserting duplicates. The row is deleted once the whole input is ingested.
+
+        Returns:
+            - dict with inserted row count, elapsed seconds and rows per second
+        '''
+        chunk_size = constants.BULK_INGEST_CHUNK_SIZE if chunk_size is None else chunk_size
+        ingest_name = constants.BULK_INGEST_NAME if ingest_name is None else ingest_name
+
+        rows_done, pending_product_ids = self._load_bulk_ingest_progress(ingest_name)
+        if pending_product_ids:
+            print(f"Indexing {len(pending_product_ids)} products inserted before the interruption.")
+            self._index_products(pending_product_ids)
+            self._save_bulk_ingest_progress(ingest_name, rows_done, [])
+        products = iter(products)
+        if rows_done:
+            print(f"Resuming bulk product ingest after {rows_done} rows.")
+            for _ in islice(products, rows_done):
+                pass
+
+        with Session(self.engine) as session:
+            category_names = {category.category_id: category.name for category in session.exec(select(Category)).all()}
+
+        statement = insert(Product).returning(Product.product_id, sort_by_parameter_order=True)
+        inserted = 0
+        started_at = time.perf_counter()
+        while True:
+            chunk = [self._product_row(product) for product in islice(products, chunk_size)]
+            if not chunk:
+                break
+
+            product_texts = [
+                self.build_product_text(row['name'], category_names[row['category_id']], row['description'])
+                for row in chunk
+            ]
+            product_embeddings = self.text_embedder.generate_embeddings(product_texts, use_cache=False)
+
+            rows_done += len(chunk)
+            with Session(self.engine) as session:  # Write transaction spans the insert only
+                product_ids = list(session.execute(statement, chunk).scalars())
+                # Progress commits with the rows, ids pending until their vectors are in. The input offset is explicit,
+                # so concurrent inserts by other writers do not shift where a resume starts.
+                self._save_bulk_ingest_progress(ingest_name, rows_done, product_ids, session=session)
+                session.commit()
+
+            self._raise_on_failed_batches(
+                self.product_vector_store.record_embeddings_batch(
+                    product_ids,
+                    product_embeddings,
+                    payloads=[self.build_product_payload(row['category_id'], row['price'], row['stock']) for row in chunk],
+                )
+            )
+            self._save_bulk_ingest_progress(ingest_name, rows_done, [])
+
+            self.catalog_version += 1
+            inserted += len(chunk)
+
+            elapsed = time.perf_counter() - started_at
+            print(f"Bulk product ingest: {rows_done} rows done ({inserted / elapsed:.0f} rows/s)")
+
+        with Session(self.engine) as session:
+            session.execute(delete(BulkIngestProgress).where(BulkIngestProgress.ingest_name == ingest_name))
+            session.commit()
+
+        elapsed = time.perf_counter() - started_at
+        return {
+            'inserted': inserted,
+            'elapsed_seconds': elapsed,
+            'rows_per_second': inserted / elapsed if elapsed > 0 else 0.0,
+        }
+
+    def reindex_products(self, chunk_size: int = None, wait: bool = False) -> dict:
+        '''
+        Re-embeds every product and upserts the vectors and payloads into the product collection, e.g. after changing the
+        embedding model or to backfill filter payloads of points written before they existed.
+        Products are read in primary key order one chunk at a time, so memory stays bounded.
+
+        Returns:
+            - dict with reindexed product count, elapsed seconds and products per second
+        '''
+        chunk_size = constants.BULK_INGEST_CHUNK_SIZE if chunk_size is None else chunk_size
+
+        with Session(self.engine) as session:
+            category_names = {category.category_id: category.name for category in session.exec(select(Category)).all()}
+
+        reindexed = 0
+        last_product_id = 0
+        started_at = time.perf_counter()
+        while True:
+            with Session(self.engine) as session:
+                statement = (
+                    select(Product.product_id, Product.category_id, Product.name, Product.description, Product.price, Product.stock)
+                    .where(Product.product_id > last_product_id)
+                    .order_by(Product.product_id)
+                    .limit(chunk_size)
+                )
+                rows = session.exec(statement).all()
+            if not rows:
+                break
+
+            self._index_product_rows(rows, category_names, wait=wait)
+            self.catalog_version += 1
+            reindexed += len(rows)
+            last_product_id = rows[-1][0]
+            elapsed = time.perf_counter() - started_at
+            print(f"Product reindex: {reindexed} products done ({reindexed / elapsed:.0f} products/s)")
+
+        elapsed = time.perf_counter() - started_at
+        return {
+            'reindexed': reindexed,
+            'elapsed_seconds': elapsed,
+            'products_per_second': reindexed / elapsed if elapsed > 0 else 0.0,
+        }
+
+    def _index_products(self, product_ids: list):
+        '''
+        Embeds the given products and upserts them into the vector store.
+        '''
+        with Session(self.engine) as session:
+            category_names = {category.category_id: category.name for category in session.exec(select(Category)).all()}
+            statement = (
+                select(Product.product_id, Product.category_id, Product.name, Product.description, Product.price, Product.stock)
+                .where(Product.product_id.in_(product_ids))
+                .order_by(Product.product_id)
+            )
+            rows = session.exec(statement).all()
+        if rows:
+            self._index_product_rows(rows, category_names)
+            self.catalog_version += 1
+
+    def _index_product_rows(self, rows: list, category_names: dict, wait: bool = True):
+        '''
+        Parameters:
+            - rows (list): (product_id, category_id, name, description, price, stock) tuples
+        '''
+        product_texts = [self.build_product_text(name, category_names[category_id], description) for _, category_id, name, description, _, _ in rows]
+        product_embeddings = self.text_embedder.generate_embeddings(product_texts, use_cache=False)
+        product_ids = [row[0] for row in rows]
+        product_payloads = [self.build_product_payload(category_id, price, stock) for _, category_id, _, _, price, stock in rows]
+        self._raise_on_failed_batches(
+            self.product_vector_store.record_embeddings_batch(product_ids, product_embeddings, payloads=product_payloads, wait=wait)
         )
 
+    @staticmethod
+    def _raise_on_failed_batches(batch_statuses: list):
+        failed = [status for status in batch_statuses if status['status'] == 'failed']
+        if failed:
+            raise RuntimeError(f"{len(failed)} of {len(batch_statuses)} vector upsert batches failed: {failed[0]['error']}")
+
+    @staticmethod
+    def _product_row(product) -> dict:
+        if not isinstance(product, dict):
+            category_id, name, description, price, stock = product
+            product = {'category_id': category_id, 'name': name, 'description': description, 'price': price, 'stock': stock}
+        now = datetime.now()
+        return {
+            'category_id': product['category_id'],
+            'name': product['name'],
+            'description': product.get('description'),
+            'price': product['price'],
+            'stock': product.get('stock', 0),
+            'created_at': now,
+            'updated_at': now,
+        }
+
+    def _load_bulk_ingest_progress(self, ingest_name: str):
+        '''
+        Returns:
+            - (input rows already inserted, ids of inserted products whose vectors may not be upserted yet)
+        '''
+        with Session(self.engine) as session:
+            progress = session.get(BulkIngestProgress, ingest_name)
+            if progress is None:
+                return 0, []
+            return progress.rows_done, json.loads(progress.pending_product_ids)
+
+    def _save_bulk_ingest_progress(self, ingest_name: str, rows_done: int, pending_product_ids: list, session: Session = None):
+        '''
+        Upserts the progress row. Inside the given session it is left to the caller's commit, so it lands atomically
+        with the rows it describes; without one it commits on its own.
+        '''
+        if session is None:
+            with Session(self.engine) as session:
+                self._save_bulk_ingest_progress(ingest_name, rows_done, pending_product_ids, session=session)
+                session.commit()
+            return
+        progress = session.get(BulkIngestProgress, ingest_name) or BulkIngestProgress(ingest_name=ingest_name)
+        progress.rows_done = rows_done
+        progress.pending_product_ids = json.dumps(pending_product_ids)
+        progress.updated_at = datetime.now()
+        session.add(progress)
+
     def update_product(self, product_id: int = None, new_category_id: int = None, new_name: str = None, new_description: str = None, new_price: float = None, new_stock: int = None):
         with Session(self.engine) as session:
             statement = select(Product).where(Product.product_id == product_id)
             product: Product = session.exec(statement).first()
-            if product:
-                if new_category_id is not None:
-                    product.category_id = new_category_id
-                if new_name is not None:
-                    product.name = new_name
-                if new_description is not None:
-                    product.description = new_description
-                if new_price is not None:
-                    product.price = new_price
-                if new_stock is not None:
-                    product.stock = new_stock
-                product.created_at = product.created_at
-                product.updated_at = datetime.now()
-                session.commit()
-                session.refresh(product)
+            if product is None:
+                return
+            if new_category_id is not None:
+                product.category_id = new_category_id
+            if new_name is not None:
+                product.name = new_name
+            if new_description is not None:
+                product.description = new_description
+            if new_price is not None:
+                product.price = new_price
+            if new_stock is not None:
+                product.stock = new_stock
+            product.created_at = product.created_at
+            product.updated_at = datetime.now()
+            session.commit()
+            session.refresh(product)
+
+        product_payload = self.build_product_payload(product.category_id, product.price, product.stock)
+        self.catalog_version += 1
+
+        if new_category_id is None and new_name is None and new_description is None:
+            # Only price/stock changed, the embedding text is the same. Products not indexed yet get their vector below.
+            if self.product_vector_store.set_payload(id=product.product_id, payload=product_payload):
+                return
 
         product_category_str = self.get_data(table='Category', id=product.category_id)['name']
 
-        product_text = f'Product name is {new_name} and category is {product_category_str}. Description: {new_description}'
-        product_embedding = self.text_embedder.generate_embedding(product_text)
+        product_text = self.build_product_text(product.name, product_category_str, product.description)
+        product_embedding = self.text_embedder.generate_embedding(product_text, use_cache=False)
 
-        self.qdrant_product_database.record_embedding_into_collection(
+        self.product_vector_store.record_embedding_into_collection(
             id=product.product_id, 
-            embedding=product_embedding
+            embedding=product_embedding,
+            payload=product_payload,
         )
  
     def record_search_history(self, user_id: int, query: str) -> int:
@@ -131,7 +455,80 @@ class DB:
             session.add(query)
             session.commit()
             session.refresh(query)
+        self.note_search_history(user_id, query.query)
         return query.search_id
+
+    def record_search_history_buffered(self, user_id: int, query: str, block: bool = True):
+        '''
+        Like `record_search_history` but only queues the row for the background writer; no commit on the caller's path and no id returned.
+        With `block=False` (for callers on the event loop) a full buffer drops the row at once instead of waiting for the writer.
+        '''
+        self.event_buffer.append(SearchHistory, {'user_id': user_id, 'query': query, 'created_at': datetime.now()}, block=block)
+        self.note_search_history(user_id, query)
+
+    def note_search_history(self, user_id: int, query: str):
+        '''
+        Keeps a cached user context in step with a newly recorded search.
+        '''
+        user_context: UserContext = self.user_context_cache.get(user_id)
+        if user_context is not None:
+            user_context.add_search_query(query)
+
+    def get_user_context(self, user_id: int) -> UserContext:
+        '''
+        Returns the cached UserContext (profile and bounded recent search history) of the user, loading it on a miss.
+
+        Returns:
+            - UserContext, or None when the user does not exist
+        '''
+        user_context: UserContext = self.user_context_cache.get(user_id)
+        if user_context is not None:
+            return user_context
+
+        if self.event_buffer is not None:
+            self.event_buffer.flush()  # Searches still buffered belong in the history read below
+        with Session(self.engine) as session:
+            user = session.exec(select(User).where(User.user_id == user_id)).first()
+            if user is None:
+                return None
+            statement = (
+                select(SearchHistory.query)
+                .where(SearchHistory.user_id == user_id)
+                .order_by(SearchHistory.created_at.desc(), SearchHistory.search_id.desc())
+                .limit(constants.USER_HISTORY_WINDOW)
+            )
+            recent_search_history = list(reversed(session.exec(statement).all()))
+
+        user_context = UserContext(user_id, user.profile_description, recent_search_history, history_window=constants.USER_HISTORY_WINDOW)
+        self.user_context_cache.set(user_id, user_context)
+        return user_context
+
+    def get_recommendation_candidates(self, user_context: UserContext) -> list:
+        '''
+        Candidate products for recommending to the user: hybrid search over the profile description. The list and the
+        profile embedding are cached on the context and recomputed only after the catalog changed.
+
+        Returns:
+            - list of (Product, score) pairs, best first
+        '''
+        catalog_version = self.catalog_version
+        if user_context.has_fresh_candidates(catalog_version):
+            return user_context.candidates
+
+        profile_description = user_context.profile_description or ''
+        if user_context.profile_embedding is None:
+            user_context.profile_embedding = self.text_embedder.generate_embedding(profile_description)
+
+        user_context.candidates = self.search_product(
+            search_keyword=profile_description,
+            query_embedding=user_context.profile_embedding,
+            use_vectore_search=True,
+            similarity_threshold=0.3,
+            return_as_dict=False,
+            return_scores=True,
+        )
+        user_context.candidates_catalog_version = catalog_version
+        return user_context.candidates
  
     def record_recommendation(self, user_id: int, product_id: int, score: float = 1) -> int:
         recommendation: Recommendation = Recommendation(user_id=user_id, product_id=product_id, score=score)
@@ -141,16 +538,194 @@ class DB:
             session.refresh(recommendation)
         return recommendation.recommendation_id
  
+    def record_recommendations_batch(self, recommendations: list) -> list:
+        '''
+        Inserts many recommendations with one executemany.
+
+        Parameters:
+            - recommendations (list): (user_id, product_id, score) tuples
+
+        Returns:
+            - list of recommendation ids in input order
+        '''
+        if not recommendations:
+            return []
+        now = datetime.now()
+        rows = [
+            {'user_id': user_id, 'product_id': product_id, 'score': score, 'created_at': now}
+            for user_id, product_id, score in recommendations
+        ]
+        statement = insert(Recommendation).returning(Recommendation.recommendation_id, sort_by_parameter_order=True)
+        with Session(self.engine) as session:
+            recommendation_ids = list(session.execute(statement, rows).scalars())
+            session.commit()
+        return recommendation_ids
+
+    def save_precomputed_recommendations(self, precomputed_recommendations: list):
+        '''
+        Replaces the stored offline recommendation of each given user.
+
+        Parameters:
+            - precomputed_recommendations (list): (user_id, recommendation_id, product_id) tuples
+        '''
+        if not precomputed_recommendations:
+            return
+        now = datetime.now()
+        rows = [
+            {'user_id': user_id, 'recommendation_id': recommendation_id, 'product_id': product_id, 'created_at': now}
+            for user_id, recommendation_id, product_id in precomputed_recommendations
+        ]
+        statement = self.build_upsert_statement(PrecomputedRecommendation, index_elements=['user_id'], update_columns=['recommendation_id', 'product_id', 'created_at'])
+        with Session(self.engine) as session:
+            session.execute(statement, rows)
+            session.commit()
+
+    def get_precomputed_recommendation(self, user_id: int) -> dict:
+        '''
+        Returns the user's offline recommendation if one younger than `constants.PRECOMPUTED_RECOMMENDATION_MAX_AGE_HOURS` exists, else None.
+        '''
+        with Session(self.engine) as session:
+            precomputed_recommendation = session.exec(self.build_precomputed_recommendation_statement(user_id)).first()
+            return precomputed_recommendation.dict() if precomputed_recommendation else None
+
+    @staticmethod
+    def build_precomputed_recommendation_statement(user_id: int):
+        oldest_allowed = datetime.now() - timedelta(hours=constants.PRECOMPUTED_RECOMMENDATION_MAX_AGE_HOURS)
+        return select(PrecomputedRecommendation).where(
+            PrecomputedRecommendation.user_id == user_id,  # Primary key lookup
+            PrecomputedRecommendation.created_at >= oldest_allowed,
+        )
+
+    def build_upsert_statement(self, table_model, index_elements: list, update_columns: list):
+        '''
+        INSERT ... ON CONFLICT (index_elements) DO UPDATE for the engine's dialect.
+        '''
+        dialect_insert = postgresql.insert if self.engine.dialect.name == 'postgresql' else sqlite.insert
+        statement = dialect_insert(table_model)
+        return statement.on_conflict_do_update(
+            index_elements=index_elements,
+            set_={column: statement.excluded[column] for column in update_columns},
+        )
+
+    def iter_users(self, chunk_size: int):
+        '''
+        Yields lists of (user_id, profile_description) in user id order, reading one chunk at a time (keyset pagination).
+        '''
+        last_user_id = 0
+        while True:
+            with Session(self.engine) as session:
+                statement = (
+                    select(User.user_id, User.profile_description)
+                    .where(User.user_id > last_user_id)
+                    .order_by(User.user_id)
+                    .limit(chunk_size)
+                )
+                users = session.exec(statement).all()
+            if not users:
+                return
+            yield users
+            last_user_id = users[-1][0]
+
+    def iter_positive_feedback_examples(self, chunk_size: int, since_feedback_id: int = None, min_rating: int = None):
+        '''
+        Yields lists of (recommendation_feedback_id, user_id, profile_description, product_id, product_name) of feedbacks
+        rated at least `min_rating` (default `constants.FINE_TUNING_DATASET_MIN_RATING`), in feedback id order.
+
+        One join (feedback -> recommendation -> product, feedback -> user) per chunk with keyset pagination, so any number
+        of feedbacks is read in bounded memory. `since_feedback_id` skips feedbacks up to that id, for incremental exports.
+        '''
+        min_rating = constants.FINE_TUNING_DATASET_MIN_RATING if min_rating is None else min_rating
+        last_feedback_id = 0 if since_feedback_id is None else since_feedback_id
+        while True:
+            statement = (
+                select(RecommendationFeedback.recommendation_feedback_id, User.user_id, User.profile_description, Product.product_id, Product.name)
+                .select_from(RecommendationFeedback)
+                .join(Recommendation, Recommendation.recommendation_id == RecommendationFeedback.recommendation_id)
+                .join(Product, Product.product_id == Recommendation.product_id)
+                .join(User, User.user_id == RecommendationFeedback.user_id)
+                .where(RecommendationFeedback.rating >= min_rating, RecommendationFeedback.recommendation_feedback_id > last_feedback_id)
+                .order_by(RecommendationFeedback.recommendation_feedback_id)
+                .limit(chunk_size)
+            )
+            with Session(self.engine) as session:
+                examples = session.exec(statement).all()
+            if not examples:
+                return
+            yield examples
+            last_feedback_id = examples[-1][0]
+
+    def get_recent_search_histories(self, user_ids: list, window: int = None) -> dict:
+        '''
+        The last `window` (default `constants.USER_HISTORY_WINDOW`) search queries of many users in one query.
+
+        Returns:
+            - dict user_id -> list of queries, oldest first
+        '''
+        window = constants.USER_HISTORY_WINDOW if window is None else window
+        recency_rank = func.row_number().over(
+            partition_by=SearchHistory.user_id,
+            order_by=(SearchHistory.created_at.desc(), SearchHistory.search_id.desc()),
+        ).label('recency_rank')
+        ranked_history = (
+            select(SearchHistory.user_id, SearchHistory.query, recency_rank)
+            .where(SearchHistory.user_id.in_(user_ids))
+            .subquery()
+        )
+        statement = (
+            select(ranked_history.c.user_id, ranked_history.c.query)
+            .where(ranked_history.c.recency_rank <= window)
+            .order_by(ranked_history.c.user_id, ranked_history.c.recency_rank.desc())
+        )
+        histories = {user_id: [] for user_id in user_ids}
+        with Session(self.engine) as session:
+            for user_id, query in session.exec(statement).all():
+                histories[user_id].append(query)
+        return histories
+
+    def get_product_embedding_index(self):
+        '''
+        In-stock product embeddings as an in-memory matrix for NumPy scoring, L2-normalized so a dot product is the cosine
+        similarity. Loaded from the vector store once and reloaded only after the catalog changed.
+
+        Returns:
+            - (product_ids, embeddings): int64 array and float32 matrix of shape (len(product_ids), embedding_size)
+        '''
+        with self.product_embedding_index_lock:
+            catalog_version = self.catalog_version
+            if self.product_embedding_index is None or self.product_embedding_index[0] != catalog_version:
+                product_ids, embeddings = self.product_vector_store.load_all_embeddings(
+                    payload_ranges=self.build_vector_search_ranges(None, None, None)
+                )
+                norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+                embeddings /= np.maximum(norms, 1e-12)
+                self.product_embedding_index = (catalog_version, product_ids, embeddings)
+            return self.product_embedding_index[1], self.product_embedding_index[2]
+
+    def get_product_embeddings(self, product_ids: list):
+        '''
+        L2-normalized embeddings of the given products only, read from the vector store by id. For scoring the
+        candidates of a request; whole-catalog scoring uses `get_product_embedding_index`.
+
+        Returns:
+            - (product_ids, embeddings): int64 array of the products found, in request order, and float32 matrix
+        '''
+        product_ids, embeddings = self.product_vector_store.retrieve_embeddings(product_ids)
+        embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        return product_ids, embeddings
+
     def record_recommendation_feedback(self, recommendation_id: int, user_id: int, rating: int) -> int:
         recommendation_feedback: RecommendationFeedback = RecommendationFeedback(recommendation_id=recommendation_id, user_id=user_id, rating=rating)
         with Session(self.engine) as session:
             try:
                 session.add(recommendation_feedback)
-                session.commit()
+                session.flush()  # Raises on a duplicate before the summary is touched
+                for statement, parameters in build_rating_increment_statements(self.engine.dialect.name, rating, recommendation_feedback.created_at):
+                    session.execute(statement, parameters)
+                session.commit()  # Feedback and rating summary commit together
                 session.refresh(recommendation_feedback)
                 return recommendation_feedback.recommendation_feedback_id
             except IntegrityError as e:
-                if "UNIQUE constraint failed" in str(e.orig): #Feedback already exists for recommendation
+                if is_unique_violation(e): #Feedback already exists for recommendation
                     session.rollback()  # Rollback the transaction to keep the session clean
                     return None
                 else:
@@ -173,20 +748,10 @@ class DB:
         Returns:
             dict if data found else None
         '''
-        mapping = {
-            "User": select(User).where(User.user_id == id),
-            "Category": select(Category).where(Category.category_id == id),
-            "Product": select(Product).where(Product.product_id == id),
-            "SearchHistory": select(SearchHistory).where(SearchHistory.search_id == id),
-            "Recommendation": select(Recommendation).where(Recommendation.recommendation_id == id),
-            "RecommendationFeedback": select(RecommendationFeedback).where(RecommendationFeedback.recommendation_feedback_id == id)
-        }
-
-        if table not in mapping: # Not given correct table name
+        statement = self.build_get_data_statement(table, id)
+        if statement is None: # Not given correct table name
             return None 
         
-        statement = mapping[table]
-        
         with Session(self.engine) as session:
             data = session.exec(statement).first()
             if data:
@@ -195,94 +760,136 @@ class DB:
                 else:
                     return data
             return None
+
+    @staticmethod
+    def build_get_data_statement(table: str, id: int):
+        mapping = {
+            "User": select(User).where(User.user_id == id),
+            "Category": select(Category).where(Category.category_id == id),
+            "Product": select(Product).where(Product.product_id == id),
+            "SearchHistory": select(SearchHistory).where(SearchHistory.search_id == id),
+            "Recommendation": select(Recommendation).where(Recommendation.recommendation_id == id),
+            "RecommendationFeedback": select(RecommendationFeedback).where(RecommendationFeedback.recommendation_feedback_id == id)
+        }
+
+        return mapping.get(table)
         
-    def search_product(self, user_id: int = None, search_keyword: str = '', min_price: float = None, max_price: float = None, min_stock: int = None, return_as_dict: bool = True, use_vectore_search: bool = True, similarity_threshold: float=0.3):
-        if user_id is not None:
-            self.record_search_history(user_id, search_keyword)
+    def search_product(self, user_id: int = None, search_keyword: str = '', min_price: float = None, max_price: float = None, min_stock: int = None, return_as_dict: bool = True, use_vectore_search: bool = True, similarity_threshold: float=0.3, limit: int = None, offset: int = 0, return_scores: bool = False, query_embedding: np.ndarray = None, record_history: bool = True):
+        '''
+        Hybrid product search. Keyword (BM25 over the FTS index) and vector (cosine over the vector store) candidates are retrieved with the
+        same price/stock filters, merged by product id with weighted reciprocal rank fusion and paged with limit/offset.
 
-        search_results = []
+        Parameters:
+            - limit (int): page size (default `constants.SEARCH_DEFAULT_LIMIT`)
+            - offset (int): number of fused results to skip
+            - return_scores (bool): return (product, fused score) pairs instead of products
+            - query_embedding (np.ndarray): precomputed embedding of `search_keyword`
+            - record_history (bool): record the query as search history of `user_id` (buffered). Internal searches opt out.
+
+        Returns:
+            - list of products (dict or Product), best match first
+        '''
+        if user_id is not None and record_history:
+            self.record_search_history_buffered(user_id, search_keyword)
+
+        limit = constants.SEARCH_DEFAULT_LIMIT if limit is None else limit
+        candidates_per_retriever = offset + limit  # Deep enough for every id on the requested page
+
+        ranked_lists = []
+        weights = []
 
         ### Using keyword search ###
+        tokenized_search_keyword: list = self.text_tokenizer.clean_text(search_keyword, stem=False)  # The keyword index stems query terms itself
+        statement = self.build_keyword_search_statement(tokenized_search_keyword, min_price, max_price, min_stock, candidates_per_retriever)
         with Session(self.engine) as session:
-            tokenized_search_keyword: list = self.text_tokenizer.clean_text(search_keyword)
+            ranked_lists.append(session.exec(statement).all())
+        weights.append(constants.HYBRID_SEARCH_KEYWORD_WEIGHT)
 
-            conditions = []
+        ### Using semantic vectore search ###
+        if use_vectore_search:
+            search_query_embedding = self.text_embedder.generate_embedding(search_keyword) if query_embedding is None else query_embedding
 
-            keyword_conditions = []
-            for keyword in tokenized_search_keyword:
-                keyword_conditions.extend(
-                    [
-                        Product.name.ilike(f"%{keyword}%"),
-                        Product.description.ilike(f"%{keyword}%")
-                    ]
-                )
-            
-            if keyword_conditions:
-                conditions.append(or_(*keyword_conditions))
-            
-            if min_price is not None:
-                conditions.append(
-                    Product.price >= min_price
-                )
+            # Price/stock filters run inside the vector store, so every one of the k hits is eligible
+            ranked_lists.append(self.product_vector_store.search_similar_products(
+                query_embedding=search_query_embedding,
+                k=candidates_per_retriever,
+                similarity_threshold=similarity_threshold,
+                payload_ranges=self.build_vector_search_ranges(min_price, max_price, min_stock),
+            ))
+            weights.append(constants.HYBRID_SEARCH_VECTOR_WEIGHT)
 
-            if max_price is not None:
-                conditions.append(
-                    Product.price <= max_price
-                )
+        ### Fusion and paging ###
+        fused_results = reciprocal_rank_fusion(ranked_lists, weights, k=constants.HYBRID_SEARCH_RRF_K)[offset:offset + limit]
+        with Session(self.engine) as session:
+            products = session.exec(self.build_products_by_ids_statement(fused_results)).all()
 
-            if min_stock is None:
-                conditions.append(
-                    Product.stock > 0  # Ensure that the product has stock greater than 0
-                )
-            else:
-                conditions.append(
-                    Product.stock > min_stock
-                )
-            
-            statement = select(Product).where(
-                *conditions,  # Unpack the list of conditions
+        ### Search Result Return ###
+        return self.format_search_results(products, fused_results, return_as_dict, return_scores)
+
+    def build_keyword_search_statement(self, tokenized_search_keyword: list, min_price: float, max_price: float, min_stock: int, limit: int):
+        '''
+        Select of keyword candidate product ids, best match first (BM25 on SQLite, ts_rank on PostgreSQL). Without keywords every product passing the filters is a
+        candidate (in id order), which keeps empty queries and empty profiles browsable.
+        '''
+        conditions = [
+            Product.stock >= max(min_stock or 0, 1)  # Ensure that the product has stock greater than 0
+        ]
+
+        if min_price is not None:
+            conditions.append(
+                Product.price >= min_price
             )
-            results = session.exec(statement).all()
-            search_results.extend(results)
 
-        ### Using semantic vectore search ###
-        if use_vectore_search:
-            search_query_embedding = self.text_embedder.generate_embedding(search_keyword)
+        if max_price is not None:
+            conditions.append(
+                Product.price <= max_price
+            )
 
-            products_search_result_ids: list = self.qdrant_product_database.search_similar_products(query_embedding=search_query_embedding, similarity_threshold=similarity_threshold)
-            with Session(self.engine) as session:
-                statement = select(Product).filter(Product.product_id.in_(products_search_result_ids))
-                products = session.exec(statement).all()
-
-            for product in products:
-                stock_requirement_met = False
-                if min_stock: # when stock given
-                    if (product.stock >= min_stock) and (product.stock > 0): 
-                        stock_requirement_met = True
-                else:
-                    if product.stock > 0: # Ensure that the product has stock greater than 0
-                        stock_requirement_met = True
-                
-                if stock_requirement_met:
-                    if (min_price is None or product.price >= min_price) and (max_price is None or product.price <= max_price):
-                        # filtered_products.append(product)
-                        if product not in search_results:
-                            search_results.append(product)
+        if not tokenized_search_keyword:
+            return select(Product.product_id).where(*conditions).order_by(Product.product_id).limit(limit)
 
-        ### Search Result Return ###
-        if return_as_dict:
-            return [product.dict() for product in search_results]
-        else:
-            return [product for product in search_results]
+        # Index-backed lookup
+        return self.keyword_index.build_search_statement(tokenized_search_keyword, conditions, limit)
+
+    @staticmethod
+    def build_vector_search_ranges(min_price: float, max_price: float, min_stock: int) -> dict:
+        return {
+            'price': (min_price, max_price),
+            'stock': (max(min_stock or 0, 1), None),  # Ensure that the product has stock greater than 0
+        }
+
+    @staticmethod
+    def build_products_by_ids_statement(fused_results: list):
+        return select(Product).where(Product.product_id.in_([product_id for product_id, _ in fused_results]))
+
+    @staticmethod
+    def format_search_results(products: list, fused_results: list, return_as_dict: bool, return_scores: bool) -> list:
+        '''
+        Orders fetched products by fused score and shapes them as search_product returns them.
+        '''
+        products_by_id = {product.product_id: product for product in products}
+        search_results = []
+        for product_id, score in fused_results:
+            product = products_by_id.get(product_id)
+            if product is None: # Deleted between retrieval and fetch
+                continue
+            if return_as_dict:
+                product = product.dict()
+            search_results.append((product, score) if return_scores else product)
+        return search_results
+
+    def summarize_recommendation_feedback_rating(self, since: datetime = None, until: datetime = None, granularity: str = None) -> dict:
+        '''
+        Number of feedbacks per rating, read from the incrementally maintained summary tables instead of scanning the feedbacks.
 
-    def summarize_recommendation_feedback_rating(self) -> dict:
+        Parameters:
+            - since, until (datetime): optional window, aligned to hour buckets (or to `granularity` buckets)
+            - granularity (str): 'hour' or 'day' to get one summary per bucket instead of totals
+
+        Returns:
+            - dict rating -> count, or with a granularity dict bucket start (ISO format) -> {rating -> count}
+        '''
         with Session(self.engine) as session:
-            statement = (
-                select(RecommendationFeedback.rating, func.count(RecommendationFeedback.rating))
-                .group_by(RecommendationFeedback.rating)
-            )
+            results = session.exec(build_rating_summary_statement(since, until, granularity)).all()
 
-            results = session.exec(statement).all()
-            results_dict = {result[0]:result[1] for result in results}
-        
-        return results_dict
\ No newline at end of file
+        return format_rating_summary(results, granularity)
@@ -1,4 +1,5 @@
 import os
+from sqlalchemy import Index
 from sqlmodel import Field, SQLModel, Relationship
 from pydantic import conint
 from typing import List, Optional
@@ -29,6 +30,11 @@ class Category(SQLModel, table=True):
 
 
 class Product(SQLModel, table=True):
+    __table_args__ = (
+        Index('ix_product_stock_price', 'stock', 'price'),  # In-stock and price range filters of search
+        Index('ix_product_category_id', 'category_id'),
+    )
+
     product_id: int = Field(default=None, primary_key=True)
     category_id: int = Field(foreign_key="category.category_id", nullable=False)
     name: str = Field(nullable=False)
@@ -44,6 +50,10 @@ class Product(SQLModel, table=True):
 
 
 class SearchHistory(SQLModel, table=True):
+    __table_args__ = (
+        Index('ix_searchhistory_user_id_created_at', 'user_id', 'created_at'),  # Recent history of a user
+    )
+
     search_id: int = Field(default=None, primary_key=True)
     user_id: int = Field(foreign_key="user.user_id", nullable=False)
     query: str = Field(nullable=False)
@@ -54,6 +64,10 @@ class SearchHistory(SQLModel, table=True):
 
 
 class Recommendation(SQLModel, table=True):
+    __table_args__ = (
+        Index('ix_recommendation_user_id_created_at', 'user_id', 'created_at'),
+    )
+
     recommendation_id: int = Field(default=None, primary_key=True)
     user_id: int = Field(foreign_key="user.user_id", nullable=False)
     product_id: int = Field(foreign_key="product.product_id", nullable=False)
@@ -67,6 +81,11 @@ class Recommendation(SQLModel, table=True):
 
 
 class RecommendationFeedback(SQLModel, table=True):
+    __table_args__ = (
+        Index('ix_recommendationfeedback_rating', 'rating'),  # Rating summary and fine-tuning export
+        Index('ix_recommendationfeedback_user_id', 'user_id'),
+    )
+
     recommendation_feedback_id: int = Field(default=None, primary_key=True)
     recommendation_id: int = Field(foreign_key="recommendation.recommendation_id", nullable=False, unique=True)
     user_id: int = Field(foreign_key="user.user_id", nullable=False)
@@ -78,3 +97,38 @@ class RecommendationFeedback(SQLModel, table=True):
     user: Optional[User] = Relationship(back_populates="feedbacks")
 
 
+class PrecomputedRecommendation(SQLModel, table=True):
+    # Latest offline (batch job) recommendation per user, served by /recommend_product without inference
+    user_id: int = Field(foreign_key="user.user_id", primary_key=True)
+    recommendation_id: int = Field(foreign_key="recommendation.recommendation_id", nullable=False)
+    product_id: int = Field(foreign_key="product.product_id", nullable=False)
+    created_at: datetime = Field(default_factory=datetime.now)
+
+
+class SchemaMigration(SQLModel, table=True):
+    # One row per applied migration of db/migrations.py
+    version: int = Field(primary_key=True)
+    description: str = Field(nullable=False)
+    applied_at: datetime = Field(default_factory=datetime.now)
+
+
+class BulkIngestProgress(SQLModel, table=True):
+    # Resume point of an interrupted `DB.bulk_record_products`, written in the transaction of each chunk insert
+    ingest_name: str = Field(primary_key=True)
+    rows_done: int = Field(default=0, nullable=False)
+    pending_product_ids: str = Field(default='[]', nullable=False)  # JSON list of inserted products not yet in the vector store
+    updated_at: datetime = Field(default_factory=datetime.now)
+
+
+class RecommendationFeedbackRatingCount(SQLModel, table=True):
+    # Running number of feedbacks per rating, maintained with every feedback write (see db/rating_summary.py)
+    rating: int = Field(primary_key=True)
+    feedback_count: int = Field(default=0, nullable=False)
+
+
+class RecommendationFeedbackRatingBucket(SQLModel, table=True):
+    # Same counts per hour and per day, for windowed summaries
+    granularity: str = Field(primary_key=True)
+    bucket_start: datetime = Field(primary_key=True)
+    rating: int = Field(primary_key=True)
+    feedback_count: int = Field(default=0, nullable=False)
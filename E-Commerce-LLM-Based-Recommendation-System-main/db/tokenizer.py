@@ -1,28 +1,105 @@
 import re
-import nltk
-from nltk.corpus import stopwords
+import unicodedata
+from functools import lru_cache
+from typing import List
+
+import constants
+from db.lazy import LazyResource
+from db.stopwords import ENGLISH_STOPWORDS
+
+NON_ALPHANUMERIC_PATTERN = re.compile(r'[^a-z0-9\s]')
+QUERY_SEPARATOR = '\x1e'  # Whitespace to the regex, so it survives cleaning and splits a joined batch back into queries
+
+
+def load_stopwords() -> frozenset:
+    '''
+    English stopwords from a locally installed NLTK corpus when there is one, else the bundled copy. Never downloads.
+    '''
+    try:
+        from nltk.corpus import stopwords
+        return frozenset(stopwords.words('english'))
+    except (ImportError, LookupError):  # NLTK or its corpus not installed, e.g. on air-gapped nodes
+        return ENGLISH_STOPWORDS
+
+
+def load_stemmer():
+    '''
+    Porter stemmer in its original form, the algorithm of SQLite FTS5's `porter` tokenizer, so stems equal indexed terms.
+    Returns None when NLTK is not installed.
+    '''
+    try:
+        from nltk.stem.porter import PorterStemmer
+    except ImportError:
+        print("NLTK is not installed, terms are not stemmed.")
+        return None
+    return lru_cache(maxsize=constants.TEXT_STEM_CACHE_SIZE)(PorterStemmer(mode=PorterStemmer.ORIGINAL_ALGORITHM).stem)
 
 
 class TextTokenizer:
+    '''
+    Turns search text into keyword terms: optional Unicode normalization (NFKD, diacritics removed), lowercase, only
+    letters and digits kept, stopwords removed, optional Porter stemming.
+
+    The same settings configure the keyword index (`fts5_tokenizer`, `postgresql_text_search_config`): FTS5 removes
+    diacritics with `remove_diacritics 2` and PostgreSQL with `unaccent` in a custom text search configuration, so
+    "cafe" finds "Café" on both. The database tokenizers split words on their own rules and keep characters this class
+    drops, so only the terms themselves, not the splitting, are guaranteed to match.
+
+    Parameters:
+        - stemming (bool): default `constants.TEXT_STEMMING_ENABLED`
+        - unicode_normalization (bool): default `constants.TEXT_UNICODE_NORMALIZATION_ENABLED`
+    '''
+
+    def __init__(self, stemming: bool = None, unicode_normalization: bool = None):
+        self.stemming = constants.TEXT_STEMMING_ENABLED if stemming is None else stemming
+        self.unicode_normalization = constants.TEXT_UNICODE_NORMALIZATION_ENABLED if unicode_normalization is None else unicode_normalization
+        self.stop_words = LazyResource(load_stopwords, name='stopwords')
+        self.stemmer = LazyResource(load_stemmer, name='stemmer')
+
+    @property
+    def fts5_tokenizer(self) -> str:
+        remove_diacritics = 2 if self.unicode_normalization else 0
+        return f"{'porter ' if self.stemming else ''}unicode61 remove_diacritics {remove_diacritics}"
+
+    @property
+    def postgresql_text_search_config(self) -> str:
+        '''
+        The built-in 'simple' / 'english' configurations keep diacritics, so with unicode normalization this is a copy
+        of them running `unaccent` first (see `POSTGRESQL_UNACCENT_TEXT_SEARCH_CONFIGS` in db/keyword_index.py).
+        '''
+        text_search_config = 'english' if self.stemming else 'simple'
+        return f'product_unaccent_{text_search_config}' if self.unicode_normalization else text_search_config
+
+    def clean_text(self, query: str, stem: bool = None) -> list:
+        '''
+        Keyword terms of one query.
+
+        Parameters:
+            - stem (bool): overrides the tokenizer's stemming. The keyword index stems query terms itself, so searches pass False.
+        '''
+        return self.clean_batch([query], stem=stem)[0]
+
+    def clean_batch(self, queries: List[str], stem: bool = None) -> List[list]:
+        '''
+        Keyword terms of many queries, e.g. for batch recommendation or search history analysis. Normalization,
+        lowercasing and character filtering run once over all queries joined together instead of once per query.
+
+        Returns:
+            - list with the list of terms of each query
+        '''
+        if not queries:
+            return []
+        stem = self.stemming if stem is None else stem
+
+        text = QUERY_SEPARATOR.join(query.replace(QUERY_SEPARATOR, ' ') for query in queries)
+        if self.unicode_normalization:
+            text = ''.join(character for character in unicodedata.normalize('NFKD', text) if not unicodedata.combining(character))
+        text = NON_ALPHANUMERIC_PATTERN.sub('', text.lower())
 
-    def __init__(self):
-        self.ensure_model_downloaded()
-
-    def ensure_model_downloaded(self):
-        nltk.download('stopwords')
-
-    def clean_text(self, query: str) -> list:
-        # Remove special characters, keep only letters and spaces
-        cleaned_query = re.sub(r'[^A-Za-z0-9\s]', '', query)
-        
-        # Tokenize the query (split by spaces)
-        words = cleaned_query.split()
-        
-        # Convert to lowercase
-        words = [word.lower() for word in words]
-        
-        # Optionally remove stopwords (common words like 'the', 'is', etc.)
-        stop_words = set(stopwords.words('english'))
-        filtered_words = [word for word in words if word not in stop_words]
-        
-        return filtered_words
\ No newline at end of file
+        stop_words = self.stop_words.get()
+        stemmer = self.stemmer.get() if stem else None
+        cleaned_queries = []
+        for cleaned_query in text.split(QUERY_SEPARATOR):
+            words = [word for word in cleaned_query.split() if word not in stop_words]
+            cleaned_queries.append([stemmer(word) for word in words] if stemmer is not None else words)
+        return cleaned_queries
@@ -0,0 +1,29 @@
+from collections import deque
+from typing import List
+import numpy as np
+
+
+class UserContext:
+    '''
+    Cached per-user features for the recommendation hot path.
+
+    Parameters:
+        - user_id (int)
+        - profile_description (str)
+        - recent_search_history (list[str]): most recent queries, oldest first, at most `history_window` of them
+        - history_window (int): bound on the kept history
+    '''
+
+    def __init__(self, user_id: int, profile_description: str, recent_search_history: List[str], history_window: int):
+        self.user_id = user_id
+        self.profile_description = profile_description
+        self.recent_search_history = deque(recent_search_history, maxlen=history_window)
+        self.profile_embedding: np.ndarray = None  # Filled on first use
+        self.candidates: list = None  # (Product, score) pairs, best first
+        self.candidates_catalog_version: int = None  # Catalog version the candidates were computed against
+
+    def add_search_query(self, query: str):
+        self.recent_search_history.append(query)  # deque drops the oldest query once the window is full
+
+    def has_fresh_candidates(self, catalog_version: int) -> bool:
+        return self.candidates is not None and self.candidates_catalog_version == catalog_version
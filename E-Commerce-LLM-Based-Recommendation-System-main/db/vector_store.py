@@ -0,0 +1,114 @@
+from abc import ABC, abstractmethod
+import numpy as np
+
+import constants
+
+# Payload fields stored with every product point, indexed so searches can filter on them
+PRODUCT_PAYLOAD_SCHEMA = {
+    'price': 'float',
+    'stock': 'integer',
+    'category_id': 'integer',
+}
+
+
+class VectorStore(ABC):
+    '''
+    Interface of the product embedding store used by `DB` and `AsyncDB`.
+
+    Backends (selected with `constants.VECTOR_STORE_BACKEND`, see `create_vector_store`):
+        - "qdrant": `QdrantDatabase`, a Qdrant server
+        - "local": `LocalVectorStore`, an in-process memory-mapped index under `constants.QDRANT_STORAGE_PATH`
+
+    Similarity is cosine. `payload_ranges` filters are dicts field -> (lower, upper), inclusive, None bounds open, and
+    only points passing every range count towards k. Backends must implement every abstract method, so a missing one
+    fails when the store is created.
+    '''
+
+    @abstractmethod
+    def warmup(self):
+        '''
+        Connects / loads the index ahead of the first request.
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_collection(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def record_embedding_into_collection(self, id: int, embedding: np.ndarray, payload: dict = None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_payload(self, id: int, payload: dict) -> bool:
+        '''
+        Overwrites the given payload keys of one point without touching its vector.
+
+        Returns:
+            - False when the point does not exist (nothing is written), so the caller can upsert it with its vector
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def record_embeddings_batch(self, ids: list, embeddings: np.ndarray, payloads: list = None, batch_size: int = None, parallel: int = None, wait: bool = True) -> list:
+        '''
+        Upserts many points. `embeddings` row i belongs to `ids[i]`.
+
+        Returns:
+            - list of dict, one per batch in order: {'batch': index, 'size': points, 'status': 'acknowledged' | 'completed' | 'failed', 'error': str | None}
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def load_all_embeddings(self, payload_ranges: dict = None, page_size: int = 1000):
+        '''
+        Returns:
+            - (ids, embeddings): int64 array of point ids and float32 matrix of shape (len(ids), embedding_size)
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def retrieve_embeddings(self, ids: list):
+        '''
+        Vectors of the given points only, for scoring a few candidates without loading the collection.
+
+        Returns:
+            - (ids, embeddings): int64 array of the ids found, in request order (missing ones are left out), and float32
+              matrix of shape (len(ids), embedding_size)
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def search_similar_products(self, query_embedding: np.ndarray, k: int = 50, similarity_threshold: float = 0.3, payload_ranges: dict = None, return_scores: bool = False, hnsw_ef: int = None, exact: bool = False) -> list:
+        '''
+        `hnsw_ef` overrides the HNSW candidate list size of the backend for this query; `exact` scans all points
+        (ground truth for recall measurements).
+
+        Returns:
+            - list of the k most similar point ids above `similarity_threshold` ((id, score) pairs with `return_scores`), most similar first
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    async def search_similar_products_async(self, query_embedding: np.ndarray, k: int = 50, similarity_threshold: float = 0.3, payload_ranges: dict = None, return_scores: bool = False, hnsw_ef: int = None, exact: bool = False) -> list:
+        '''
+        Non-blocking variant of `search_similar_products` for use inside the event loop.
+        '''
+        raise NotImplementedError
+
+    async def close_async_client(self):
+        pass
+
+
+def create_vector_store(collection_name: str, payload_schema: dict = None) -> VectorStore:
+    '''
+    Vector store of the backend configured in `constants.VECTOR_STORE_BACKEND`. Backend modules are imported here, so
+    the local backend works without qdrant-client installed.
+    '''
+    if constants.VECTOR_STORE_BACKEND == 'qdrant':
+        from db.qdrant_db import QdrantDatabase
+        return QdrantDatabase(collection_name=collection_name, payload_schema=payload_schema)
+    if constants.VECTOR_STORE_BACKEND == 'local':
+        from db.local_vector_store import LocalVectorStore
+        return LocalVectorStore(collection_name=collection_name, payload_schema=payload_schema)
+    raise ValueError(f"Unknown VECTOR_STORE_BACKEND '{constants.VECTOR_STORE_BACKEND}', expected 'qdrant' or 'local'")
@@ -0,0 +1,72 @@
+import os
+
+import constants
+
+SUPPORTED_BACKENDS = ('torch', 'torch-int8', 'onnx')
+
+
+def load_model(backend: str, model_path: str, device):
+    '''
+    Loads the fine-tuned T5 for inference with the given backend. Every backend supports `generate` with the same arguments.
+
+    Parameters:
+        - backend (str):
+            - "torch": fp32 PyTorch model (reference)
+            - "torch-int8": PyTorch model with dynamic int8 quantization of all Linear layers, CPU only
+            - "onnx": ONNX Runtime export of the model, CPU only. Needs `optimum[onnxruntime]`. The export is written to
+              `constants.LLM_ONNX_SAVE_PATH` on first use and loaded from there afterwards.
+        - model_path (str): directory of the fine-tuned model
+        - device (torch.device): device for the "torch" backend
+    '''
+    if backend not in SUPPORTED_BACKENDS:
+        raise ValueError(f"Unknown inference backend '{backend}', expected one of {SUPPORTED_BACKENDS}")
+    # Imported here, so importing the app does not pull in torch before the model is loaded
+    import torch
+    from transformers import T5ForConditionalGeneration
+
+    if backend == 'torch':
+        model = T5ForConditionalGeneration.from_pretrained(model_path)
+        model.to(device)
+        model.eval()
+        return model
+
+    if backend == 'torch-int8':
+        model = T5ForConditionalGeneration.from_pretrained(model_path)
+        model.eval()
+        # Weights are stored as int8, activations are quantized on the fly; quantized kernels are CPU only
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    try:
+        from optimum.onnxruntime import ORTModelForSeq2SeqLM
+    except ImportError as e:
+        raise ImportError("The 'onnx' inference backend needs optimum with ONNX Runtime: pip install optimum[onnxruntime]") from e
+
+    onnx_path = constants.LLM_ONNX_SAVE_PATH
+    if os.path.isdir(onnx_path):
+        return ORTModelForSeq2SeqLM.from_pretrained(onnx_path)
+
+    print(f"ONNX export not found at '{onnx_path}'. Exporting '{model_path}'...")
+    model = ORTModelForSeq2SeqLM.from_pretrained(model_path, export=True)
+    model.save_pretrained(onnx_path)
+    print(f"ONNX export saved to '{onnx_path}'.")
+    return model
+
+
+def load_tokenizer(tokenizer_path: str):
+    '''
+    Tokenizer of the fine-tuned T5. Inference and training data builders share it, so both tokenize prompts to the
+    same ids (`legacy=False` fixes the handling of text after special tokens, as the model was fine-tuned with).
+    '''
+    from transformers import T5Tokenizer  # Importing pulls in torch, deferred with the model itself
+    return T5Tokenizer.from_pretrained(tokenizer_path, legacy=False)
+
+
+def backend_device(backend: str):
+    '''
+    Returns:
+        - torch.device the backend runs on
+    '''
+    import torch
+    if backend == 'torch' and torch.cuda.is_available():
+        return torch.device("cuda")
+    return torch.device("cpu")
@@ -0,0 +1,119 @@
+import time
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Callable, List
+
+
+class InferenceQueueFullError(RuntimeError):
+    pass
+
+
+class _InferenceRequest:
+
+    def __init__(self, item):
+        self.item = item
+        self.future = Future()
+        self.enqueued_at = time.perf_counter()
+
+
+class InferenceBatcher:
+    '''
+    Dynamic micro-batching in front of a batch inference function.
+
+    Concurrent callers submit single items; a worker thread takes the first waiting item, keeps collecting for up to
+    `max_wait_ms` or until `max_batch_size` items are gathered, runs `run_batch` once on the whole batch and hands every
+    caller its own output. At most `max_queue_size` items may wait, further submissions fail fast with InferenceQueueFullError.
+
+    Parameters:
+        - run_batch (callable): list of items -> list of outputs in the same order
+        - max_batch_size (int): items per `run_batch` call
+        - max_wait_ms (float): how long the first item of a batch waits for company
+        - max_queue_size (int): bound on waiting items
+    '''
+
+    def __init__(self, run_batch: Callable[[list], list], max_batch_size: int, max_wait_ms: float, max_queue_size: int):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_ms / 1000
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._metrics_lock = threading.Lock()
+        self._reset_metrics()
+        self._worker = threading.Thread(target=self._run, name='inference-batcher', daemon=True)
+        self._worker.start()
+
+    def submit(self, item) -> Future:
+        request = _InferenceRequest(item)
+        try:
+            self._queue.put_nowait(request)
+        except queue.Full:
+            with self._metrics_lock:
+                self._rejected += 1
+            raise InferenceQueueFullError(f"Inference queue is full ({self._queue.maxsize} requests waiting)")
+        return request.future
+
+    def infer(self, item, timeout: float = None):
+        return self.submit(item).result(timeout=timeout)
+
+    def _collect_batch(self) -> List[_InferenceRequest]:
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait_seconds
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            started_at = time.perf_counter()
+            try:
+                outputs = self.run_batch([request.item for request in batch])
+                for request, output in zip(batch, outputs):
+                    request.future.set_result(output)
+            except Exception as e:
+                for request in batch:
+                    request.future.set_exception(e)
+            finished_at = time.perf_counter()
+            self._record_batch(batch, started_at, finished_at)
+
+    def _reset_metrics(self):
+        self._requests = 0
+        self._batches = 0
+        self._rejected = 0
+        self._max_batch_size_seen = 0
+        self._batch_size_counts = {}
+        self._queue_time_total = 0.0
+        self._queue_time_max = 0.0
+        self._inference_time_total = 0.0
+
+    def _record_batch(self, batch: List[_InferenceRequest], started_at: float, finished_at: float):
+        queue_times = [started_at - request.enqueued_at for request in batch]
+        with self._metrics_lock:
+            self._requests += len(batch)
+            self._batches += 1
+            self._max_batch_size_seen = max(self._max_batch_size_seen, len(batch))
+            self._batch_size_counts[len(batch)] = self._batch_size_counts.get(len(batch), 0) + 1
+            self._queue_time_total += sum(queue_times)
+            self._queue_time_max = max(self._queue_time_max, max(queue_times))
+            self._inference_time_total += finished_at - started_at
+
+    def metrics(self) -> dict:
+        with self._metrics_lock:
+            return {
+                'queue_depth': self._queue.qsize(),
+                'requests': self._requests,
+                'rejected_requests': self._rejected,
+                'batches': self._batches,
+                'avg_batch_size': self._requests / self._batches if self._batches else 0.0,
+                'max_batch_size': self._max_batch_size_seen,
+                'batch_size_counts': dict(sorted(self._batch_size_counts.items())),
+                'avg_queue_time_ms': 1000 * self._queue_time_total / self._requests if self._requests else 0.0,
+                'max_queue_time_ms': 1000 * self._queue_time_max,
+                'avg_batch_inference_time_ms': 1000 * self._inference_time_total / self._batches if self._batches else 0.0,
+            }
@@ -0,0 +1,112 @@
+'''
+Parity and speed check of the LLM inference backends against the fp32 PyTorch model.
+
+Run from the project root:
+    python -m llm.benchmark_backends --prompts-csv ./llm/dataset/fine_tuning.csv --backends torch-int8 onnx
+
+Prompts are read from the `input` column of a CSV written by `LLM.generate_dataset_for_llm_fine_tuning`; without a CSV a
+few built-in prompts are used. For every backend it reports the share of prompts whose output is identical to the fp32
+output, single-prompt latency (p50/p95) and batched throughput.
+'''
+import time
+import argparse
+import statistics
+import pandas as pd
+import torch
+from transformers import T5Tokenizer
+
+import constants
+from llm.backends import SUPPORTED_BACKENDS, load_model, backend_device
+from llm.llm import LLM
+
+SAMPLE_PROMPTS = [
+    ("I love gaming and books.", "Laptop,Video Games,Gaming Mouse", {1: "Laptop", 2: "PlayStation 5", 3: "Novel Book", 4: "Gaming Chair"}),
+    ("I love cooking and traveling.", "Cookbook,Suitcase", {5: "Cookbook", 6: "Travel Pillow", 7: "Chef Knife", 8: "Suitcase"}),
+    ("I love gym equipment and sports.", "Dumbbells,Yoga Mat,Football", {9: "Treadmill", 10: "Dumbbells", 11: "Protein Powder", 12: "Tennis Racket"}),
+    ("I love musical instruments and movies.", "Guitar,Headphones", {13: "Acoustic Guitar", 14: "Piano", 15: "Projector", 16: "Bluetooth Speaker"}),
+]
+
+
+def build_sample_prompts() -> list:
+    return [LLM.engineer_prompt(profile, history, candidates) for profile, history, candidates in SAMPLE_PROMPTS]
+
+
+def generate(model, tokenizer, device, prompts: list) -> list:
+    inputs = tokenizer(prompts, return_tensors="pt", padding=True).to(device)
+    with torch.no_grad():
+        outputs = model.generate(
+            inputs['input_ids'],
+            attention_mask=inputs['attention_mask'],
+            max_length=constants.LLM_MAX_OUTPUT_LENGTH,
+            num_beams=5,
+            early_stopping=True,
+        )
+    return tokenizer.batch_decode(outputs, skip_special_tokens=True)
+
+
+def benchmark_backend(backend: str, tokenizer, prompts: list, batch_size: int, reference_outputs: list = None) -> dict:
+    device = backend_device(backend)
+    model = load_model(backend, constants.LLM_FINE_TUNED_SAVE_PATH, device)
+
+    generate(model, tokenizer, device, prompts[:1])  # Warmup
+
+    latencies = []
+    outputs = []
+    for prompt in prompts:
+        started_at = time.perf_counter()
+        outputs.extend(generate(model, tokenizer, device, [prompt]))
+        latencies.append(time.perf_counter() - started_at)
+
+    started_at = time.perf_counter()
+    for start in range(0, len(prompts), batch_size):
+        generate(model, tokenizer, device, prompts[start:start + batch_size])
+    batched_elapsed = time.perf_counter() - started_at
+
+    latencies.sort()
+    result = {
+        'backend': backend,
+        'p50_latency_ms': 1000 * statistics.median(latencies),
+        'p95_latency_ms': 1000 * latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))],
+        f'throughput_batch{batch_size}_prompts_per_s': len(prompts) / batched_elapsed,
+        'outputs': outputs,
+    }
+    if reference_outputs is not None:
+        matches = sum(output.strip().lower() == reference.strip().lower() for output, reference in zip(outputs, reference_outputs))
+        result['parity_with_fp32'] = matches / len(prompts)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--prompts-csv', default=None, help="CSV with an 'input' column of prompts")
+    parser.add_argument('--max-prompts', type=int, default=100)
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--backends', nargs='+', default=['torch-int8', 'onnx'], choices=SUPPORTED_BACKENDS)
+    parser.add_argument('--min-parity', type=float, default=0.95, help="Exit with an error if a backend agrees with fp32 on fewer prompts")
+    args = parser.parse_args()
+
+    if args.prompts_csv:
+        prompts = pd.read_csv(args.prompts_csv, nrows=args.max_prompts)['input'].tolist()
+    else:
+        prompts = build_sample_prompts()
+
+    tokenizer = T5Tokenizer.from_pretrained(constants.LLM_FINE_TUNED_TOKENIZER_PATH, legacy=False)
+
+    reference = benchmark_backend('torch', tokenizer, prompts, args.batch_size)
+    results = [reference] + [
+        benchmark_backend(backend, tokenizer, prompts, args.batch_size, reference_outputs=reference['outputs'])
+        for backend in args.backends if backend != 'torch'
+    ]
+
+    print(f"{len(prompts)} prompts")
+    for result in results:
+        result.pop('outputs')
+        print(', '.join(f'{key}: {value:.3f}' if isinstance(value, float) else f'{key}: {value}' for key, value in result.items()))
+
+    failing = [result['backend'] for result in results[1:] if result['parity_with_fp32'] < args.min_parity]
+    if failing:
+        raise SystemExit(f"Parity below {args.min_parity:.0%} for: {', '.join(failing)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+from typing import Dict, List
+
+
+class CandidateTrie:
+    '''
+    Prefix trie over the token ids of candidate product names, used to restrict generation to exactly those names.
+
+    Each name is tokenized without special tokens and terminated with EOS, so a finished beam always spells one whole
+    candidate name and maps back to its product id without any string comparison.
+
+    Parameters:
+        - candidate_token_ids (dict): product_id -> token ids of the name (without EOS)
+        - eos_token_id (int): token that ends every sequence
+    '''
+
+    def __init__(self, candidate_token_ids: Dict[int, List[int]], eos_token_id: int):
+        self.eos_token_id = eos_token_id
+        self.root = {}
+        self.max_length = 0
+        for product_id, token_ids in candidate_token_ids.items():
+            node = self.root
+            for token_id in list(token_ids) + [eos_token_id]:
+                node = node.setdefault(token_id, {})
+            node.setdefault(None, product_id)  # Leaf marker; with duplicate names the first (best ranked) product wins
+            self.max_length = max(self.max_length, len(token_ids) + 1)
+
+    def allowed_next_tokens(self, prefix: List[int]) -> List[int]:
+        node = self.root
+        for token_id in prefix:
+            if token_id == self.eos_token_id and None in node.get(token_id, {}):
+                return [self.eos_token_id]  # Finished beam, only padding follows
+            node = node.get(token_id)
+            if node is None:
+                return [self.eos_token_id]  # Cannot happen while decoding is constrained, end the beam safely
+        return [token_id for token_id in node if token_id is not None]
+
+    def match(self, token_ids: List[int]):
+        '''
+        Returns the product id spelled by `token_ids` (EOS terminated, trailing padding ignored) or None.
+        '''
+        node = self.root
+        for token_id in token_ids:
+            node = node.get(token_id)
+            if node is None:
+                return None
+            if token_id == self.eos_token_id:
+                return node.get(None)
+        return None
+
+
+def score_candidates(model, encoder_input_ids: 'torch.Tensor', encoder_attention_mask: 'torch.Tensor', candidate_token_ids: List[List[int]], eos_token_id: int, pad_token_id: int) -> 'torch.Tensor':
+    '''
+    Scores every candidate by the model's mean per-token log-likelihood of generating it for one prompt.
+
+    The prompt is encoded once and its encoder states are shared by all candidates, then a single batched decoder pass
+    scores all candidates together. Mean instead of summed log-probability avoids favouring short names.
+
+    Parameters:
+        - model: T5ForConditionalGeneration (PyTorch backends)
+        - encoder_input_ids, encoder_attention_mask (torch.Tensor): tokenized prompt of shape (1, prompt_length)
+        - candidate_token_ids (list[list[int]]): token ids of each candidate name without EOS
+
+    Returns:
+        - torch.Tensor of shape (len(candidate_token_ids),)
+    '''
+    import torch  # Deferred with the model, see llm/backends.py
+    label_sequences = [list(token_ids) + [eos_token_id] for token_ids in candidate_token_ids]
+    max_length = max(len(labels) for labels in label_sequences)
+    labels = torch.full((len(label_sequences), max_length), -100, dtype=torch.long, device=encoder_input_ids.device)
+    for i, sequence in enumerate(label_sequences):
+        labels[i, :len(sequence)] = torch.tensor(sequence, dtype=torch.long)
+
+    with torch.no_grad():
+        encoder_hidden_states = model.get_encoder()(input_ids=encoder_input_ids, attention_mask=encoder_attention_mask).last_hidden_state
+        decoder_input_ids = model._shift_right(labels.masked_fill(labels == -100, pad_token_id))
+        outputs = model(
+            encoder_outputs=(encoder_hidden_states.expand(len(label_sequences), -1, -1),),
+            attention_mask=encoder_attention_mask.expand(len(label_sequences), -1),
+            decoder_input_ids=decoder_input_ids,
+        )
+
+    log_probs = torch.log_softmax(outputs.logits.float(), dim=-1)
+    label_mask = labels != -100
+    token_log_probs = log_probs.gather(-1, labels.clamp(min=0).unsqueeze(-1)).squeeze(-1) * label_mask
+    return token_log_probs.sum(dim=-1) / label_mask.sum(dim=-1)
@@ -0,0 +1,270 @@
+'''
+Tokenized fine-tuning dataset: prompts and targets are tokenized once and stored as memory-mapped shards, so training
+runs read token ids instead of re-tokenizing the CSV every time.
+
+Run from the project root:
+    python -m llm.dataset_builder            # appends the feedback received since the last build
+    python -m llm.dataset_builder --rebuild  # tokenizes everything again
+
+Files under `constants.FINE_TUNING_SHARDS_PATH`:
+    - manifest.json: build settings, shards and the last tokenized feedback id (written last, atomically)
+    - <shard>.input_ids.i32: int32 (rows, bucket_length) prompt token ids, padded with the pad token
+    - <shard>.labels.i32: int32 (rows, max_target_length) target token ids, padded with -100 (ignored by the loss)
+    - <shard>.lengths.i32: int32 (rows, 2) unpadded prompt and target lengths
+
+Prompt token ids are those `PromptBuilder.build` produces for serving, so shards hold prompts in the format and within
+the budget the served model sees. Prompts are bucketed by length (`constants.FINE_TUNING_SHARD_BUCKET_LENGTHS`), so a
+batch drawn from one shard carries little padding. Every build writes one shard per bucket with the new rows only. When
+the tokenizer, the prompt template, the prompt budget or the bucket settings change, the shards no longer match and the
+next build starts over.
+
+In training, `TokenizedShardDataset` works with `DataCollatorForSeq2Seq` / `Seq2SeqTrainer` like the tokenized
+`datasets.Dataset` of the notebooks, and `iter_batches` yields ready tensors for a plain PyTorch loop.
+'''
+import os
+import json
+import hashlib
+import argparse
+import numpy as np
+import torch
+
+import constants
+from llm.llm import LLM
+
+MANIFEST_FORMAT_VERSION = 1
+LABEL_PAD_TOKEN_ID = -100
+
+
+def load_manifest(dataset_dir: str) -> dict:
+    manifest_path = os.path.join(dataset_dir, 'manifest.json')
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def save_manifest(dataset_dir: str, manifest: dict):
+    manifest_path = os.path.join(dataset_dir, 'manifest.json')
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_path + '.tmp', manifest_path)  # Atomic, a crash mid-build leaves the previous manifest
+
+
+def shard_path(dataset_dir: str, shard_name: str, array_name: str) -> str:
+    return os.path.join(dataset_dir, f'{shard_name}.{array_name}.i32')
+
+
+class TokenizedDatasetBuilder:
+    '''
+    Writes the training pairs of `LLM.iter_fine_tuning_examples` as length-bucketed token shards.
+
+    Parameters:
+        - llm (LLM): source of the training pairs and of the tokenizer (`llm.tokenizer_loader`); its model is not loaded
+        - dataset_dir (str): default `constants.FINE_TUNING_SHARDS_PATH`
+        - bucket_lengths (tuple): default `constants.FINE_TUNING_SHARD_BUCKET_LENGTHS`
+        - max_target_length (int): default `constants.LLM_MAX_OUTPUT_LENGTH`
+    '''
+
+    def __init__(self, llm: LLM, dataset_dir: str = None, bucket_lengths: tuple = None, max_target_length: int = None):
+        self.llm = llm
+        self.dataset_dir = constants.FINE_TUNING_SHARDS_PATH if dataset_dir is None else dataset_dir
+        self.bucket_lengths = sorted(constants.FINE_TUNING_SHARD_BUCKET_LENGTHS if bucket_lengths is None else bucket_lengths)
+        self.max_target_length = constants.LLM_MAX_OUTPUT_LENGTH if max_target_length is None else max_target_length
+        self.tokenizer = llm.tokenizer_loader.get()  # The tokenizer of the prompt builder, for targets and padding
+
+    def build_settings(self) -> dict:
+        '''
+        Everything the stored token ids depend on; shards built with other settings are not appended to.
+        '''
+        prompt_builder = self.llm.prompt_builder
+        return {
+            'format_version': MANIFEST_FORMAT_VERSION,
+            'tokenizer_path': self.llm.tokenizer_path,
+            'vocab_size': len(self.tokenizer),
+            'pad_token_id': self.tokenizer.pad_token_id,
+            'prompt_template_sha1': hashlib.sha1(prompt_builder.template.encode('utf-8')).hexdigest(),
+            'prompt_budget': {
+                'max_input_tokens': prompt_builder.max_input_tokens,
+                'max_profile_tokens': prompt_builder.max_profile_tokens,
+                'max_history_queries': prompt_builder.max_history_queries,
+                'max_history_tokens': prompt_builder.max_history_tokens,
+                'max_candidates': prompt_builder.max_candidates,
+            },
+            'bucket_lengths': self.bucket_lengths,
+            'max_target_length': self.max_target_length,
+        }
+
+    def build(self, rebuild: bool = False, chunk_size: int = None) -> dict:
+        '''
+        Tokenizes the feedback newer than the last build (all feedback with `rebuild` or when the settings changed) and
+        appends it as new shards.
+
+        Returns:
+            - dict with the number of rows added, total rows and the last tokenized feedback id
+        '''
+        os.makedirs(self.dataset_dir, exist_ok=True)
+        settings = self.build_settings()
+        manifest = None if rebuild else load_manifest(self.dataset_dir)
+        if manifest is not None and manifest['settings'] != settings:
+            print("Tokenized dataset was built with other settings, rebuilding it.")
+            manifest = None
+        if manifest is None:
+            self.remove_shards()
+            manifest = {'settings': settings, 'last_feedback_id': None, 'next_shard_index': 0, 'shards': []}
+
+        build_index = manifest['next_shard_index']
+        shard_names = {bucket_length: f'shard-{build_index:05d}-len{bucket_length}' for bucket_length in self.bucket_lengths}
+        rows_by_bucket = dict.fromkeys(self.bucket_lengths, 0)
+        last_feedback_id = manifest['last_feedback_id']
+        added = 0
+
+        max_input_length = self.bucket_lengths[-1]
+        for prompts, outputs, last_feedback_id in self.llm.iter_fine_tuning_examples(chunk_size, last_feedback_id):
+            # Within the budget already; a last bucket below it cuts the prompt but keeps the final EOS, as tokenizer truncation does
+            input_ids = [
+                prompt['input_ids'] if len(prompt['input_ids']) <= max_input_length else prompt['input_ids'][:max_input_length - 1] + prompt['input_ids'][-1:]
+                for prompt in prompts
+            ]
+            labels = self.tokenizer(text_target=outputs, truncation=True, max_length=self.max_target_length)['input_ids']
+            buckets = np.searchsorted(self.bucket_lengths, [len(ids) for ids in input_ids])  # Smallest bucket >= length
+
+            for bucket_index, bucket_length in enumerate(self.bucket_lengths):
+                rows = np.flatnonzero(buckets == bucket_index)
+                if len(rows) == 0:
+                    continue
+                self.append_rows(
+                    shard_names[bucket_length], bucket_length,
+                    [input_ids[row] for row in rows], [labels[row] for row in rows],
+                    truncate=rows_by_bucket[bucket_length] == 0,
+                )
+                rows_by_bucket[bucket_length] += len(rows)
+
+            added += len(prompts)
+            print(f"Tokenized dataset: {added} rows added")
+
+        manifest['shards'].extend(
+            {'name': shard_names[bucket_length], 'bucket_length': bucket_length, 'rows': rows}
+            for bucket_length, rows in rows_by_bucket.items() if rows > 0
+        )
+        manifest['next_shard_index'] = build_index + 1
+        manifest['last_feedback_id'] = last_feedback_id
+        save_manifest(self.dataset_dir, manifest)
+        return {
+            'rows_added': added,
+            'rows': sum(shard['rows'] for shard in manifest['shards']),
+            'last_feedback_id': last_feedback_id,
+        }
+
+    def append_rows(self, shard_name: str, bucket_length: int, input_ids: list, labels: list, truncate: bool):
+        '''
+        Pads the rows to the shard's fixed widths and appends them to its files (`truncate` starts the files over, so
+        leftovers of an interrupted build are overwritten).
+        '''
+        input_matrix = np.full((len(input_ids), bucket_length), self.tokenizer.pad_token_id, dtype=np.int32)
+        label_matrix = np.full((len(labels), self.max_target_length), LABEL_PAD_TOKEN_ID, dtype=np.int32)
+        lengths = np.empty((len(input_ids), 2), dtype=np.int32)
+        for row, (ids, label_ids) in enumerate(zip(input_ids, labels)):
+            input_matrix[row, :len(ids)] = ids
+            label_matrix[row, :len(label_ids)] = label_ids
+            lengths[row] = len(ids), len(label_ids)
+
+        mode = 'wb' if truncate else 'ab'
+        for array_name, array in (('input_ids', input_matrix), ('labels', label_matrix), ('lengths', lengths)):
+            with open(shard_path(self.dataset_dir, shard_name, array_name), mode) as f:
+                array.tofile(f)
+
+    def remove_shards(self):
+        manifest_path = os.path.join(self.dataset_dir, 'manifest.json')
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)  # First, so an interrupted rebuild never leaves a manifest pointing at removed shards
+        for file_name in os.listdir(self.dataset_dir):
+            if file_name.startswith('shard-') and file_name.endswith('.i32'):
+                os.remove(os.path.join(self.dataset_dir, file_name))
+
+
+class TokenizedShardDataset(torch.utils.data.Dataset):
+    '''
+    Read-only view of the shards listed in the manifest, memory-mapped so only the rows used are read from disk.
+
+    Items are dicts with unpadded `input_ids`, `attention_mask` and `labels` lists, the format `DataCollatorForSeq2Seq`
+    pads per batch. Split with `torch.utils.data.random_split` for an eval set.
+    '''
+
+    def __init__(self, dataset_dir: str = None):
+        self.dataset_dir = constants.FINE_TUNING_SHARDS_PATH if dataset_dir is None else dataset_dir
+        manifest = load_manifest(self.dataset_dir)
+        if manifest is None:
+            raise FileNotFoundError(f"No tokenized dataset in {self.dataset_dir}, run `python -m llm.dataset_builder` first")
+        self.settings = manifest['settings']
+        max_target_length = self.settings['max_target_length']
+
+        self.shards = []
+        for shard in manifest['shards']:
+            rows = shard['rows']
+            self.shards.append((
+                np.memmap(shard_path(self.dataset_dir, shard['name'], 'input_ids'), dtype=np.int32, mode='r', shape=(rows, shard['bucket_length'])),
+                np.memmap(shard_path(self.dataset_dir, shard['name'], 'labels'), dtype=np.int32, mode='r', shape=(rows, max_target_length)),
+                np.memmap(shard_path(self.dataset_dir, shard['name'], 'lengths'), dtype=np.int32, mode='r', shape=(rows, 2)),
+            ))
+        self.shard_offsets = np.cumsum([0] + [len(lengths) for _, _, lengths in self.shards])
+
+    def __len__(self) -> int:
+        return int(self.shard_offsets[-1])
+
+    def __getitem__(self, index: int) -> dict:
+        shard_index = int(np.searchsorted(self.shard_offsets, index, side='right')) - 1
+        input_ids, labels, lengths = self.shards[shard_index]
+        row = index - self.shard_offsets[shard_index]
+        input_length, label_length = lengths[row]
+        return {
+            'input_ids': input_ids[row, :input_length].tolist(),
+            'attention_mask': [1] * int(input_length),
+            'labels': labels[row, :label_length].tolist(),
+        }
+
+    def iter_batches(self, batch_size: int, shuffle: bool = True, seed: int = None):
+        '''
+        Batches of rows from the same shard, padded only to the longest prompt / target of the batch.
+
+        Returns:
+            - generator of dicts with `input_ids`, `attention_mask` and `labels` int64 tensors
+        '''
+        rng = np.random.default_rng(seed)
+        batches = []
+        for shard_index, (_, _, lengths) in enumerate(self.shards):
+            rows = rng.permutation(len(lengths)) if shuffle else np.arange(len(lengths))
+            batches.extend((shard_index, rows[start:start + batch_size]) for start in range(0, len(rows), batch_size))
+        if shuffle:
+            batches = [batches[index] for index in rng.permutation(len(batches))]
+
+        for shard_index, rows in batches:
+            input_ids, labels, lengths = self.shards[shard_index]
+            rows = np.sort(rows)  # Ascending reads from the memory map
+            batch_lengths = lengths[rows]
+            max_input_length, max_label_length = batch_lengths.max(axis=0)
+            batch_input_ids = torch.from_numpy(input_ids[rows, :max_input_length].astype(np.int64))
+            yield {
+                'input_ids': batch_input_ids,
+                'attention_mask': (torch.arange(max_input_length) < torch.from_numpy(batch_lengths[:, :1].astype(np.int64))).long(),
+                'labels': torch.from_numpy(labels[rows, :max_label_length].astype(np.int64)),
+            }
+
+
+def main():
+    from db.sql_db import DB
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rebuild', action='store_true', help='tokenize all feedback again instead of appending new feedback')
+    parser.add_argument('--dataset-dir', default=None)
+    parser.add_argument('--chunk-size', type=int, default=None)
+    args = parser.parse_args()
+
+    db = DB()
+    llm = LLM(db, load_model_data_on_start=False)
+    result = TokenizedDatasetBuilder(llm, dataset_dir=args.dataset_dir).build(rebuild=args.rebuild, chunk_size=args.chunk_size)
+    print(f"Tokenized dataset: {result['rows_added']} rows added, {result['rows']} rows in total, last feedback id {result['last_feedback_id']}")
+    db.close()
+
+
+if __name__ == '__main__':
+    main()
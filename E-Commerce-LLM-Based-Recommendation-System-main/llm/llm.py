@@ -1,12 +1,39 @@
 import os
+import time
+import threading
+import numpy as np
 import pandas as pd
-import torch
 from sqlmodel import Session, select
-from transformers import T5ForConditionalGeneration, T5Tokenizer
 
 import constants
 from db.sql_db import DB
-from db.sql_models import User, Category, Product, SearchHistory, Recommendation, RecommendationFeedback
+from db.sql_models import Product
+from llm.batcher import InferenceBatcher
+from llm.backends import load_model, load_tokenizer, backend_device
+from llm.constrained import CandidateTrie, score_candidates
+from db.cache import LRUCache
+from db.ranking import top_k_by_similarity, blend_user_embedding, is_decisive
+from db.user_context import UserContext
+from db.lazy import LazyResource
+from llm.prompt_builder import PromptBuilder, CUSTOMER_INFO_TEMPLATE, render_prompt
+
+
+def next_parquet_part_path(file_path: str) -> str:
+    '''
+    Parquet files cannot be appended to, so incremental exports go to part files next to the first one:
+    `fine_tuning.parquet`, `fine_tuning.part-00001.parquet`, `fine_tuning.part-00002.parquet`, ...
+
+    Returns:
+        - `file_path` if it does not exist yet, else the first unused part path
+    '''
+    if not os.path.exists(file_path):
+        return file_path
+    stem = file_path[:-len('.parquet')]
+    part = 1
+    while os.path.exists(f"{stem}.part-{part:05d}.parquet"):
+        part += 1
+    return f"{stem}.part-{part:05d}.parquet"
+
 
 class LLM:
 
@@ -15,140 +42,575 @@ class LLM:
         self.engine = self.db.engine
 
         self.MODEL_NAME = constants.LLM_NAME
-        self.model = None
-        self.tokenizer = False
+        self._model = None
+        self._tokenizer = None
+        self.model_lock = threading.Lock()
+        self.inference_backend = constants.LLM_INFERENCE_BACKEND
+        self.device = None  # Resolved with the model, so constructing the LLM does not import torch
+        self.batcher = None
+        self.decoding_mode = constants.LLM_DECODING_MODE
+        self.candidate_token_ids_cache = LRUCache(max_size=constants.LLM_CANDIDATE_TOKEN_CACHE_SIZE)
+        if self.decoding_mode == "score" and self.inference_backend == "onnx":
+            raise ValueError('LLM_DECODING_MODE "score" needs a PyTorch inference backend ("torch" or "torch-int8")')
         self.model_output_max_length = constants.LLM_MAX_OUTPUT_LENGTH
         self.model_path = constants.LLM_FINE_TUNED_SAVE_PATH
         self.tokenizer_path = constants.LLM_FINE_TUNED_TOKENIZER_PATH
+        self.tokenizer_loader = LazyResource(self.load_tokenizer, name='LLM tokenizer')
+        self.prompt_builder = PromptBuilder(self.tokenizer_loader)  # Shares the tokenizer, loads it without the model
+        self.prompt_token_stats = {'prompts': 0, 'tokens': 0, 'static_tokens': 0, 'max_tokens': 0}
+        self.pre_rank_stats = {'requests': 0, 'llm_skipped': 0}
+        self.stats_lock = threading.Lock()
         if load_model_data_on_start:
             self.load_data_for_inferencing()
 
+    @property
+    def is_loaded(self) -> bool:
+        return self._model is not None and self._tokenizer is not None
+
+    @property
+    def model(self):
+        self.load_data_for_inferencing()  # Loaded on first use unless loaded on start or by warmup
+        return self._model
+
+    @property
+    def tokenizer(self):
+        self.load_data_for_inferencing()
+        return self._tokenizer
+
+    def load_tokenizer(self):
+        return load_tokenizer(self.tokenizer_path)
+
     def load_data_for_inferencing(self):
-        if self.model is None or self.tokenizer is None:
-            self.model = T5ForConditionalGeneration.from_pretrained(self.model_path)
-            self.tokenizer = T5Tokenizer.from_pretrained(self.tokenizer_path, legacy=False)   
-
-    def make_inference_on_model(self, query):
-        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        self.model.to(device)
-        inputs = self.tokenizer(query, return_tensors="pt").to(device)
-        
-        self.model.eval()
+        '''
+        Loads the model, tokenizer and batcher once. Thread safe: concurrent first requests wait for a single load.
+        '''
+        if self.is_loaded:
+            return
+        with self.model_lock:
+            if self.is_loaded:
+                return
+            print(f"Loading {self.inference_backend} model from {self.model_path}...")
+            tokenizer = self.tokenizer_loader.get()
+            self.device = backend_device(self.inference_backend)
+            model = load_model(self.inference_backend, self.model_path, self.device)
+
+            if self.batcher is None and constants.LLM_BATCHING_ENABLED:
+                self.batcher = InferenceBatcher(
+                    run_batch=self.make_inference_on_batch,
+                    max_batch_size=constants.LLM_BATCH_MAX_SIZE,
+                    max_wait_ms=constants.LLM_BATCH_MAX_WAIT_MS,
+                    max_queue_size=constants.LLM_BATCH_MAX_QUEUE_SIZE,
+                )
+            self._tokenizer = tokenizer
+            self._model = model  # Set last, is_loaded turns true only when everything is in place
+
+    def warmup(self):
+        '''
+        Loads the model and runs one short generation, so the first request does not pay for lazy initialization.
+        '''
+        self.load_data_for_inferencing()
+        self.prompt_builder.tokenized_template.get()
+        self.make_inference_on_batch([('warmup', None)])
+
+    def make_inference_on_model(self, query, candidate_trie: CandidateTrie = None):
+        '''
+        Generates the answer for one prompt (text, or token ids from `PromptBuilder`). With batching enabled the prompt is queued and generated together with
+        concurrent prompts; raises InferenceQueueFullError when too many prompts are waiting.
+
+        Returns:
+            - generated text, or with `candidate_trie` the product id of the candidate the constrained decoding picked
+        '''
+        item = (query, candidate_trie)
+        self.load_data_for_inferencing()  # The batcher is created with the model
+        if self.batcher is not None:
+            return self.batcher.infer(item)
+        return self.make_inference_on_batch([item])[0]
+
+    def make_inference_on_batch(self, items: list) -> list:
+        '''
+        Parameters:
+            - items (list): (prompt, CandidateTrie or None) pairs, prompts as text or token ids. A trie restricts that prompt's beams to its candidate names.
+
+        Returns:
+            - list with, per item, the product id decoded through its trie or the generated text when it has no trie
+        '''
+        queries = [query for query, _ in items]
+        candidate_tries = [candidate_trie for _, candidate_trie in items]
+        inputs = self.encode_prompts(queries)
+
+        generate_kwargs = {}
+        max_length = self.model_output_max_length
+        if any(candidate_tries):
+            all_token_ids = list(range(len(self.tokenizer)))
+
+            def prefix_allowed_tokens_fn(batch_id, decoder_input_ids):
+                candidate_trie = candidate_tries[batch_id]
+                if candidate_trie is None:
+                    return all_token_ids
+                return candidate_trie.allowed_next_tokens(decoder_input_ids[1:].tolist())  # Skip the decoder start token
+
+            generate_kwargs['prefix_allowed_tokens_fn'] = prefix_allowed_tokens_fn
+            if all(candidate_tries):
+                # Stop as soon as the longest candidate name (+ decoder start token) is complete
+                max_length = max(candidate_trie.max_length for candidate_trie in candidate_tries) + 1
+
+        import torch
         with torch.no_grad():
             outputs = self.model.generate(
                 inputs['input_ids'], 
-                max_length=self.model_output_max_length, 
+                attention_mask=inputs['attention_mask'],  # Ignore the padding of shorter prompts in the batch
+                max_length=max_length, 
                 num_beams=5,  # You can adjust this for more diverse text
-                early_stopping=True
+                early_stopping=True,
+                **generate_kwargs
             )
-        generated_text = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
-        return generated_text
 
-    def engineer_prompt(self, profile_description: str, user_search_history: str, candidates_for_recommendation, return_customer_info_only = False) -> str:
+        results = []
+        for output, candidate_trie in zip(outputs, candidate_tries):
+            if candidate_trie is None:
+                results.append(self.tokenizer.decode(output, skip_special_tokens=True))
+            else:
+                results.append(candidate_trie.match(output[1:].tolist()))
+        return results
+
+    def encode_prompts(self, queries: list):
+        '''
+        Pads prompts into one batch of tensors. Prompts given as token ids (built with the cached tokenized template) are
+        used as they are, only prompts given as text are tokenized.
+        '''
+        input_ids = list(queries)
+        text_positions = [position for position, query in enumerate(queries) if isinstance(query, str)]
+        if text_positions:
+            encoded = self.tokenizer([queries[position] for position in text_positions])['input_ids']
+            for position, ids in zip(text_positions, encoded):
+                input_ids[position] = ids
+        return self.tokenizer.pad({'input_ids': input_ids}, return_tensors="pt").to(self.device)
+
+    def get_candidate_token_ids(self, names: list) -> list:
+        '''
+        Token ids (without EOS) of each product name, cached across requests since candidate sets overlap heavily.
+        '''
+        token_ids = [self.candidate_token_ids_cache.get(name) for name in names]
+        missing_names = list({name for name, ids in zip(names, token_ids) if ids is None})
+        if missing_names:
+            encoded = self.tokenizer(missing_names, add_special_tokens=False)['input_ids']
+            for name, ids in zip(missing_names, encoded):
+                self.candidate_token_ids_cache.set(name, ids)
+            encoded_by_name = dict(zip(missing_names, encoded))
+            token_ids = [encoded_by_name[name] if ids is None else ids for name, ids in zip(names, token_ids)]
+        return token_ids
+
+    def pick_candidate(self, query: str, products_for_recommendation: list) -> int:
+        '''
+        Picks one of the candidate products for the prompt with the configured `constants.LLM_DECODING_MODE`:
+            - "trie": beam search restricted to the candidate names, stops after the longest name
+            - "score": ranks candidates by model log-likelihood in one forward pass, no beam search (PyTorch backends only)
+            - "free": unconstrained generation matched against candidate names
+
+        Candidates must be ordered best retrieval match first; when free text matches no name the first candidate is used,
+        so the result is always a valid product id.
+        '''
+        if self.decoding_mode == "score":
+            return self.pick_candidate_by_score(query, products_for_recommendation)
+
+        candidate_trie = self.build_candidate_trie(products_for_recommendation) if self.decoding_mode == "trie" else None
+        output = self.make_inference_on_model(query, candidate_trie)
+        return self.resolve_model_output(output, products_for_recommendation, candidate_trie)
+
+    def pick_candidates_batch(self, queries: list, candidate_lists: list) -> list:
+        '''
+        `pick_candidate` for many prompts at once, generating them as one batch (bypasses the request batcher; for offline jobs).
+        '''
+        if self.decoding_mode == "score":
+            return [self.pick_candidate_by_score(query, products) for query, products in zip(queries, candidate_lists)]
+
+        candidate_tries = [
+            self.build_candidate_trie(products) if self.decoding_mode == "trie" else None
+            for products in candidate_lists
+        ]
+        outputs = self.make_inference_on_batch(list(zip(queries, candidate_tries)))
+        return [
+            self.resolve_model_output(output, products, candidate_trie)
+            for output, products, candidate_trie in zip(outputs, candidate_lists, candidate_tries)
+        ]
+
+    def build_candidate_trie(self, products_for_recommendation: list) -> CandidateTrie:
+        candidate_token_ids = self.get_candidate_token_ids([product.name for product in products_for_recommendation])
+        return CandidateTrie(
+            {product.product_id: token_ids for product, token_ids in zip(products_for_recommendation, candidate_token_ids)},
+            eos_token_id=self.tokenizer.eos_token_id,
+        )
+
+    def pick_candidate_by_score(self, query: str, products_for_recommendation: list) -> int:
+        candidate_token_ids = self.get_candidate_token_ids([product.name for product in products_for_recommendation])
+        inputs = self.encode_prompts([query])
+        scores = score_candidates(
+            self.model, inputs['input_ids'], inputs['attention_mask'], candidate_token_ids,
+            eos_token_id=self.tokenizer.eos_token_id, pad_token_id=self.tokenizer.pad_token_id,
+        )
+        return products_for_recommendation[int(scores.argmax())].product_id
+
+    @staticmethod
+    def resolve_model_output(output, products_for_recommendation: list, candidate_trie: CandidateTrie = None) -> int:
+        if candidate_trie is not None:
+            if output is not None:
+                return output
+        else:
+            for product in products_for_recommendation:
+                if output.strip().lower() == product.name.strip().lower():
+                    return product.product_id
+        return products_for_recommendation[0].product_id
+
+    def record_prompt_tokens(self, prompt: dict):
+        '''
+        Adds a prompt built by `PromptBuilder` to the token counts reported by `inference_metrics`.
+        '''
+        with self.stats_lock:
+            self.prompt_token_stats['prompts'] += 1
+            self.prompt_token_stats['tokens'] += prompt['token_count']
+            self.prompt_token_stats['static_tokens'] += prompt['static_token_count']
+            self.prompt_token_stats['max_tokens'] = max(self.prompt_token_stats['max_tokens'], prompt['token_count'])
+
+    def record_pre_rank(self, llm_skipped: bool):
+        with self.stats_lock:
+            self.pre_rank_stats['requests'] += 1
+            self.pre_rank_stats['llm_skipped'] += int(llm_skipped)
+
+    def prompt_metrics(self) -> dict:
+        with self.stats_lock:
+            stats = dict(self.prompt_token_stats)
+            pre_rank_stats = dict(self.pre_rank_stats)
+        prompts = max(stats['prompts'], 1)
+        return {
+            'pre_ranked_requests': pre_rank_stats['requests'],
+            'llm_skipped_requests': pre_rank_stats['llm_skipped'],
+            'prompt_style': constants.LLM_PROMPT_STYLE,
+            'prompts': stats['prompts'],
+            'mean_prompt_tokens': stats['tokens'] / prompts,
+            'mean_template_tokens': stats['static_tokens'] / prompts,
+            'max_prompt_tokens': stats['max_tokens'],
+        }
+
+    def inference_metrics(self) -> dict:
+        if self.batcher is None:
+            return {'batching_enabled': False, **self.prompt_metrics()}
+        return {'batching_enabled': True, **self.batcher.metrics(), **self.prompt_metrics()}
+
+    def pre_rank_candidates(self, user_context: UserContext, candidates: list) -> list:
+        '''
+        Reorders retrieval candidates by cosine similarity to the user, so the LLM only sees the best `constants.PRE_RANK_TOP_K`.
+
+        The user embedding blends the profile embedding with the embeddings of the last `constants.PRE_RANK_HISTORY_QUERIES`
+        searches (see `blend_user_embedding`); query embeddings usually come from the embedder cache filled by the
+        searches themselves. Only the candidates' vectors are read from the vector store, by id, and scored with one
+        matrix-vector product.
+
+        Parameters:
+            - candidates (list): (Product, retrieval score) pairs
+
+        Returns:
+            - list of (Product, cosine similarity), best first. Candidates missing from the vector store are dropped; when
+              none is in it the candidates are returned as they are, cut to the top K.
+        '''
+        product_by_id = {product.product_id: product for product, _ in candidates}
+        found_ids, product_embeddings = self.db.get_product_embeddings(list(product_by_id))
+        if len(found_ids) == 0:
+            return candidates[:constants.PRE_RANK_TOP_K]
+
+        if user_context.profile_embedding is None:
+            user_context.profile_embedding = self.db.text_embedder.generate_embedding(user_context.profile_description or '')
+        history = list(user_context.recent_search_history)[-constants.PRE_RANK_HISTORY_QUERIES:] if constants.PRE_RANK_HISTORY_QUERIES > 0 else []
+        user_embedding = blend_user_embedding(
+            user_context.profile_embedding,
+            self.db.text_embedder.generate_embeddings(history),
+            history_weight=constants.PRE_RANK_HISTORY_WEIGHT,
+            history_decay=constants.PRE_RANK_HISTORY_DECAY,
+        )
+
+        similarities = product_embeddings @ user_embedding
+        scored_products = [product_by_id[int(product_id)] for product_id in found_ids]
+        order = np.argsort(-similarities, kind='stable')[:constants.PRE_RANK_TOP_K]
+        return [(scored_products[position], float(similarities[position])) for position in order]
+
+    def get_prompt_candidates(self, user_context: UserContext) -> list:
+        '''
+        Candidates a recommendation prompt is built from, online and in fine-tuning datasets alike: the hybrid search
+        candidates of the user, pre-ranked with `constants.PRE_RANK_ENABLED`.
+
+        Returns:
+            - list of (Product, score) pairs
+        '''
+        candidates = self.db.get_recommendation_candidates(user_context)
+        if candidates and constants.PRE_RANK_ENABLED:
+            candidates = self.pre_rank_candidates(user_context, candidates)
+        return candidates
+
+    @staticmethod
+    def engineer_prompt(profile_description: str, user_search_history: str, candidates_for_recommendation, return_customer_info_only = False) -> str:
         '''
         Parameters:
             - profile_description (str): example -> "I love gaming and books"
             - user_search_history (str): example -> "Laptop,Video Games,Gaming Mouse,Gaming Headset,Piano,Wireless Earbuds"
             - candidates_for_recommendation (dict) -> {1:"Laptop", 2:"PlayStation 5", 3:"Xbox Series X", 4:"Gaming Chair"}
+
+        The prompt has the style of `constants.LLM_PROMPT_STYLE` but no token budget; recommendations and fine-tuning
+        datasets build theirs with `self.prompt_builder`.
         '''
         if return_customer_info_only:  
-            return f'''Customer Profile: 
-{profile_description}
-
-Search History: 
-{user_search_history}'''
+            return CUSTOMER_INFO_TEMPLATE.format(profile_description=profile_description, user_search_history=user_search_history)
         
         else:
-            return f'''Given the following customer profile and search history, suggest the most relevant product from the provided list of candidates. Return only the name of the product that best matches the customer's needs based on their profile and search activity.
-Customer Profile: {profile_description}
-Search History: {user_search_history}
-Products for Recommendation: {candidates_for_recommendation}
-Your Task: Select the most suitable product from the list of "Products for Recommendation" based on the customer profile and search history.
-'''
+            return render_prompt(profile_description, user_search_history, candidates_for_recommendation)
     
     def make_recommendation_for_customer(self, user_id: int) -> int:
         '''
         Takes user id, obtains profile description of the user and their search history and based on it makes a recommendation from available products, stores the recommendation and returns recommendation id.
 
+        With `constants.PRE_RANK_ENABLED` the retrieval candidates are pre-ranked by embedding similarity and only the top
+        ones reach the LLM; with `constants.PRE_RANK_SKIP_LLM_ENABLED` a decisive top candidate is recommended without
+        generation.
+
         Returns:
-            - database recommendation id (int)
+            - dict with the recommended product id and the database recommendation id, both None when there is no product
+              to recommend, the number of prompt tokens and whether generation was skipped
         '''
-        profile_description = self.db.get_data("User", user_id)['profile_description']
+        user_context = self.db.get_user_context(user_id)
 
-        with Session(self.engine) as session:
-            statement = select(SearchHistory.query).where(SearchHistory.user_id == user_id)
-            all_user_search_history = session.exec(statement).all()
-            all_user_search_history_str = ','.join(all_user_search_history)
+        candidates = self.get_prompt_candidates(user_context)
+        if not candidates:
+            return {
+                'product_id': None,
+                'recommendation_id': None,
+                'prompt_token_count': 0,
+                'llm_skipped': False,
+            }
 
-        products_for_recommendation = self.db.search_product(user_id, profile_description, use_vectore_search=True, similarity_threshold=0.3, return_as_dict=False)
-        products_dict_for_recommendation = {product.product_id: product.name for product in products_for_recommendation}
-        
-        query = self.engineer_prompt(profile_description, all_user_search_history_str, products_dict_for_recommendation)
-        print(query)
+        score_by_product_id = {}
+        if constants.PRE_RANK_ENABLED:
+            score_by_product_id = {product.product_id: score for product, score in candidates}
+            llm_skipped = constants.PRE_RANK_SKIP_LLM_ENABLED and is_decisive(
+                [score for _, score in candidates],
+                min_score=constants.PRE_RANK_SKIP_LLM_MIN_SCORE,
+                min_margin=constants.PRE_RANK_SKIP_LLM_MIN_MARGIN,
+            )
+            self.record_pre_rank(llm_skipped)
+            if llm_skipped:
+                product, score = candidates[0]
+                return {
+                    'product_id': product.product_id,
+                    'recommendation_id': self.db.record_recommendation(user_id, product.product_id, score),
+                    'prompt_token_count': 0,
+                    'llm_skipped': True,
+                }
 
-        recommendation_str = self.make_inference_on_model(query)
-        # recommended_product_id = int(recommendation_str.split(',')[0])
-        # recommended_product_name = recommendation_str.replace(f'{recommended_product_id},', '').strip()
-        # print(recommended_product_id, recommended_product_name)
-        
-        for product in products_for_recommendation:
-            if recommendation_str.strip().lower() == product.name.strip().lower():
-                recommended_product_id = product.product_id
-                recommendation_id = self.db.record_recommendation(user_id, recommended_product_id)
-                break
+        # Bounded history and top candidates within the token budget, so encoder cost does not grow with user activity
+        prompt = self.prompt_builder.build(user_context.profile_description, list(user_context.recent_search_history), candidates)
+        products_for_recommendation = prompt['products']
+        self.record_prompt_tokens(prompt)
+        print(f"Prompt for user {user_id}: {prompt['token_count']} tokens ({prompt['static_token_count']} template, {len(products_for_recommendation)} candidates)")
+
+        recommended_product_id = self.pick_candidate(prompt['input_ids'], products_for_recommendation)
+        recommendation_id = self.db.record_recommendation(user_id, recommended_product_id, score_by_product_id.get(recommended_product_id, 1))
         
         return {
             'product_id': recommended_product_id,
             'recommendation_id': recommendation_id,
+            'prompt_token_count': prompt['token_count'],
+            'llm_skipped': False,
         }
-
-        return recommendation_str
     
+    def make_recommendations_for_all_users(self, chunk_size: int = None, top_k: int = None) -> dict:
+        '''
+        Offline batch job: recommends a product to every user and stores it as their precomputed recommendation, which
+        /recommend_product serves without inference.
+
+        Users are streamed in chunks. Per chunk the profiles are embedded in one batch, scored against the in-stock product
+        embedding matrix with one matrix product, the top `top_k` products become the candidates, the LLM picks from them in
+        batches of `constants.LLM_OFFLINE_BATCH_SIZE` and all Recommendation rows are bulk inserted. Prompts are built within the
+        token budget of `self.prompt_builder`, like online requests, and with `constants.PRE_RANK_SKIP_LLM_ENABLED` users whose
+        top candidate is decisive get it without generation.
+
+        Returns:
+            - dict with the number of users recommended for, elapsed seconds and users per second
+        '''
+        chunk_size = constants.BATCH_RECOMMENDATION_CHUNK_SIZE if chunk_size is None else chunk_size
+        top_k = constants.BATCH_RECOMMENDATION_TOP_K if top_k is None else top_k
+
+        product_ids, product_embeddings = self.db.get_product_embedding_index()
+        top_k = min(top_k, len(product_ids))
+
+        recommended = 0
+        started_at = time.perf_counter()
+        for users in self.db.iter_users(chunk_size) if top_k > 0 else []:
+            user_ids = [user_id for user_id, _ in users]
+            profile_descriptions = [profile_description for _, profile_description in users]
+            search_histories = self.db.get_recent_search_histories(user_ids)
+
+            profile_embeddings = self.db.text_embedder.generate_embeddings([profile_description or '' for profile_description in profile_descriptions], use_cache=False)
+            profile_embeddings /= np.maximum(np.linalg.norm(profile_embeddings, axis=1, keepdims=True), 1e-12)
+            top_indexes, top_similarities = top_k_by_similarity(profile_embeddings, product_embeddings, top_k)  # Cosine similarity
+
+            with Session(self.engine) as session:
+                statement = select(Product).where(Product.product_id.in_(np.unique(product_ids[top_indexes]).tolist()))
+                products_by_id = {product.product_id: product for product in session.exec(statement).all()}
+
+            decided_recommendations = []  # Decisive top candidates, recommended without generation
+            recommended_user_ids = []
+            queries = []
+            candidate_lists = []
+            similarities_by_user = []
+            for user_id, profile_description, indexes, similarities_row in zip(user_ids, profile_descriptions, top_indexes, top_similarities):
+                similarity_by_product_id = dict(zip(product_ids[indexes].tolist(), similarities_row.tolist()))
+                candidates = [(products_by_id[product_id], similarity) for product_id, similarity in similarity_by_product_id.items() if product_id in products_by_id]
+                if not candidates: # Every candidate was deleted since the index was loaded
+                    continue
+                if constants.PRE_RANK_SKIP_LLM_ENABLED and is_decisive(
+                    [similarity for _, similarity in candidates],
+                    min_score=constants.PRE_RANK_SKIP_LLM_MIN_SCORE,
+                    min_margin=constants.PRE_RANK_SKIP_LLM_MIN_MARGIN,
+                ):
+                    decided_recommendations.append((user_id, candidates[0][0].product_id, candidates[0][1]))
+                    continue
+                prompt = self.prompt_builder.build(profile_description, search_histories[user_id], candidates)
+                self.record_prompt_tokens(prompt)
+                recommended_user_ids.append(user_id)
+                queries.append(prompt['input_ids'])
+                candidate_lists.append(prompt['products'])
+                similarities_by_user.append(similarity_by_product_id)
+
+            recommended_product_ids = []
+            for start in range(0, len(queries), constants.LLM_OFFLINE_BATCH_SIZE):
+                end = start + constants.LLM_OFFLINE_BATCH_SIZE
+                recommended_product_ids.extend(self.pick_candidates_batch(queries[start:end], candidate_lists[start:end]))
+
+            recommendations = decided_recommendations + [
+                (user_id, product_id, similarity_by_product_id[product_id])
+                for user_id, product_id, similarity_by_product_id in zip(recommended_user_ids, recommended_product_ids, similarities_by_user)
+            ]
+            recommendation_ids = self.db.record_recommendations_batch(recommendations)
+            self.db.save_precomputed_recommendations([
+                (user_id, recommendation_id, product_id)
+                for (user_id, product_id, _), recommendation_id in zip(recommendations, recommendation_ids)
+            ])
+
+            recommended += len(recommendations)
+            elapsed = time.perf_counter() - started_at
+            print(f"Batch recommendation: {recommended} users done ({recommended / elapsed:.1f} users/s, {len(decided_recommendations)} of the chunk without generation)")
+
+        elapsed = time.perf_counter() - started_at
+        return {
+            'recommended_users': recommended,
+            'elapsed_seconds': elapsed,
+            'users_per_second': recommended / elapsed if elapsed > 0 else 0.0,
+        }
+
     def get_user_profile(self, user_id):
-        profile_description = self.db.get_data("User", user_id)['profile_description']
+        user_context = self.db.get_user_context(user_id)
+        all_user_search_history_str = ','.join(user_context.recent_search_history)
 
-        with Session(self.engine) as session:
-            statement = select(SearchHistory.query).where(SearchHistory.user_id ==  user_id)
-            all_user_search_history = session.exec(statement).all()
-            all_user_search_history_str = ','.join(all_user_search_history)
+        return self.engineer_prompt(user_context.profile_description, all_user_search_history_str, None, return_customer_info_only=True)
 
-        return self.engineer_prompt(profile_description, all_user_search_history_str, None, return_customer_info_only=True)
+    def iter_fine_tuning_examples(self, chunk_size: int = None, since_feedback_id: int = None):
+        '''
+        Streams (prompt, output product name) training pairs from positively rated recommendations.
 
-    def generate_dataset_for_llm_fine_tuning(self, csv_file_path: str):
-        os.makedirs(os.path.dirname(csv_file_path), exist_ok=True)
+        Prompts are built like those of `make_recommendation_for_customer`: candidates from `get_prompt_candidates` and
+        the token budget of `self.prompt_builder`, so the model is trained on the prompt format and length it is served.
+        When the recommended product is not among the candidates that fit, it replaces the last of them at a position
+        derived from the feedback id, so its place in the list says nothing about the answer; examples whose answer still
+        does not fit are skipped. The search history is the user's current one.
 
-        df = pd.DataFrame(columns=['input', 'output'])
+        Feedbacks are read in chunks of `chunk_size` with one join per chunk and the chunk's profiles are embedded in one batch.
 
-        with Session(self.engine) as session:
-            statement = select(RecommendationFeedback).where(RecommendationFeedback.rating >= 3)
-            recommendation_feedbacks = session.exec(statement).all()
-            if len(recommendation_feedbacks) == 0:
-                return
-        
-        for feedback in recommendation_feedbacks:
-            recommendation = self.db.get_data("Recommendation", feedback.recommendation_id, return_as_dict=False)
-            answer: Product = self.db.get_data("Product", recommendation.product_id, return_as_dict=False)
-            answer_text = answer.name
-            answer_id = answer.product_id
+        Parameters:
+            - chunk_size (int): default `constants.FINE_TUNING_DATASET_CHUNK_SIZE`
+            - since_feedback_id (int): only feedbacks with a greater id
 
-            profile_description = self.db.get_data("User", feedback.user_id)['profile_description']
+        Returns:
+            - generator of (prompts, outputs, last_feedback_id) per chunk, prompts as returned by `PromptBuilder.build`
+        '''
+        chunk_size = constants.FINE_TUNING_DATASET_CHUNK_SIZE if chunk_size is None else chunk_size
 
+        for examples in self.db.iter_positive_feedback_examples(chunk_size, since_feedback_id):
+            user_ids = list({user_id for _, user_id, _, _, _ in examples})
+            search_histories = self.db.get_recent_search_histories(user_ids)
+            profile_embeddings = self.db.text_embedder.generate_embeddings([profile_description or '' for _, _, profile_description, _, _ in examples], use_cache=False)
             with Session(self.engine) as session:
-                statement = select(SearchHistory.query).where(SearchHistory.user_id == feedback.user_id)
-                all_user_search_history = session.exec(statement).all()
-                all_user_search_history_str = ','.join(all_user_search_history)
-
-            products_for_recommendation = self.db.search_product(profile_description, use_vectore_search=True, similarity_threshold=0.3, return_as_dict=False)
-            # products_dict_for_recommendation = {product.product_id: product.name for product in products_for_recommendation}
-            # if answer_text not in products_dict_for_recommendation.values():
-            #     products_dict_for_recommendation[answer_id] = answer_text
-            
-            products_dict_for_recommendation = [product.name for product in products_for_recommendation]
-            if answer_text not in products_dict_for_recommendation:
-                products_dict_for_recommendation.append(answer_text)
-            
-            query = self.engineer_prompt(profile_description, all_user_search_history_str, products_dict_for_recommendation)
-
-            df.loc[len(df)] = [query, f'{answer_text}']  # Add to the DataFrame
-        
-        df.to_csv(csv_file_path, index=False)
+                statement = select(Product).where(Product.product_id.in_(list({answer_id for _, _, _, answer_id, _ in examples})))
+                answers_by_id = {product.product_id: product for product in session.exec(statement).all()}
+
+            prompts = []
+            outputs = []
+            for (feedback_id, user_id, profile_description, answer_id, answer_text), profile_embedding in zip(examples, profile_embeddings):
+                user_context = UserContext(user_id, profile_description, search_histories[user_id], history_window=constants.USER_HISTORY_WINDOW)
+                user_context.profile_embedding = profile_embedding
+                candidates = self.get_prompt_candidates(user_context)
+                prompt = self.prompt_builder.build(profile_description, search_histories[user_id], candidates)
+
+                if all(product.product_id != answer_id for product in prompt['products']):
+                    if answer_id not in answers_by_id:  # Deleted since the feedback was read
+                        continue
+                    score_by_product_id = {product.product_id: score for product, score in candidates}
+                    kept_candidates = [(product, score_by_product_id[product.product_id]) for product in prompt['products'][:-1]]
+                    position = feedback_id % (len(kept_candidates) + 1)
+                    answer_score = kept_candidates[max(position - 1, 0)][1] if kept_candidates else 1.0  # Ties keep list order
+                    kept_candidates.insert(position, (answers_by_id[answer_id], answer_score))
+                    prompt = self.prompt_builder.build(profile_description, search_histories[user_id], kept_candidates)
+                    if all(product.product_id != answer_id for product in prompt['products']):
+                        print(f"Fine-tuning example of feedback {feedback_id} skipped: its answer does not fit the prompt budget")
+                        continue
+
+                prompts.append(prompt)
+                outputs.append(answer_text)
+
+            yield prompts, outputs, examples[-1][0]
+
+    def generate_dataset_for_llm_fine_tuning(self, file_path: str = None, chunk_size: int = None, since_feedback_id: int = None) -> dict:
+        '''
+        Exports the training pairs of `iter_fine_tuning_examples` to a file, appending chunk by chunk so memory stays
+        bounded by the chunk size. For training on tokenized shards instead of text see `llm/dataset_builder.py`.
+
+        Parameters:
+            - file_path (str): .csv or .parquet (default `constants.FINE_TUNING_DATASET_PATH`)
+            - chunk_size (int): default `constants.FINE_TUNING_DATASET_CHUNK_SIZE`
+            - since_feedback_id (int): only export newer feedbacks, appended to an existing CSV or written to a new Parquet
+              part file (see `next_parquet_part_path`; read the parts with `pd.read_parquet` one by one or as a pyarrow dataset)
+
+        Returns:
+            - dict with the number of exported rows, the last exported feedback id (pass it as `since_feedback_id` next
+              time) and the path written to
+        '''
+        file_path = constants.FINE_TUNING_DATASET_PATH if file_path is None else file_path
+        os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+
+        is_parquet = file_path.endswith('.parquet')
+        if is_parquet and since_feedback_id is not None:
+            file_path = next_parquet_part_path(file_path)
+        append_to_csv = since_feedback_id is not None and os.path.exists(file_path)
+        parquet_writer = None
+        exported = 0
+        last_feedback_id = since_feedback_id
+
+        for prompts, outputs, last_feedback_id in self.iter_fine_tuning_examples(chunk_size, since_feedback_id):
+            frame = pd.DataFrame({'input': [prompt['prompt'] for prompt in prompts], 'output': outputs})
+            if is_parquet:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+                table = pa.Table.from_pandas(frame, preserve_index=False)
+                if parquet_writer is None:
+                    parquet_writer = pq.ParquetWriter(file_path, table.schema)
+                parquet_writer.write_table(table)
+            else:
+                header = exported == 0 and not append_to_csv
+                frame.to_csv(file_path, mode='w' if header else 'a', header=header, index=False)
+
+            exported += len(frame)
+            print(f"Fine-tuning dataset: {exported} rows written")
+
+        if parquet_writer is not None:
+            parquet_writer.close()
+        return {
+            'rows': exported,
+            'last_feedback_id': last_feedback_id,
+            'file_path': file_path,
+        }
@@ -0,0 +1,230 @@
+import string
+
+import constants
+from db.cache import LRUCache
+from db.lazy import LazyResource
+
+# Static parts of the prompt, built once at import instead of per row / request
+PROMPT_INSTRUCTION = "Given the following customer profile and search history, suggest the most relevant product from the provided list of candidates. Return only the name of the product that best matches the customer's needs based on their profile and search activity."
+PROMPT_TASK = 'Your Task: Select the most suitable product from the list of "Products for Recommendation" based on the customer profile and search history.'
+PROMPT_TEMPLATE = (
+    PROMPT_INSTRUCTION + "\n"
+    "Customer Profile: {profile_description}\n"
+    "Search History: {user_search_history}\n"
+    "Products for Recommendation: {candidates_for_recommendation}\n"
+    + PROMPT_TASK + "\n"
+)
+# Short task prefix in place of the instruction paragraph, for a model fine-tuned on prompts of this style
+COMPACT_PROMPT_TEMPLATE = (
+    "recommend product: profile: {profile_description}\n"
+    "history: {user_search_history}\n"
+    "candidates: {candidates_for_recommendation}\n"
+)
+PROMPT_TEMPLATES = {
+    'full': PROMPT_TEMPLATE,
+    'compact': COMPACT_PROMPT_TEMPLATE,
+}
+CUSTOMER_INFO_TEMPLATE = "Customer Profile: \n{profile_description}\n\nSearch History: \n{user_search_history}"
+
+
+def get_prompt_template(style: str = None) -> str:
+    '''
+    Template of the prompt style (default `constants.LLM_PROMPT_STYLE`). Inference and fine-tuning dataset generation
+    both use it, so the model sees prompts of the style it was trained on.
+    '''
+    style = constants.LLM_PROMPT_STYLE if style is None else style
+    if style not in PROMPT_TEMPLATES:
+        raise ValueError(f"Unknown prompt style '{style}', expected one of {list(PROMPT_TEMPLATES)}")
+    return PROMPT_TEMPLATES[style]
+
+
+def render_prompt(profile_description: str, user_search_history: str, candidates_for_recommendation, style: str = None) -> str:
+    return get_prompt_template(style).format(
+        profile_description=profile_description,
+        user_search_history=user_search_history,
+        candidates_for_recommendation=candidates_for_recommendation,
+    )
+
+
+def select_recent_history(search_history: list, max_queries: int) -> list:
+    '''
+    The `max_queries` most recent distinct queries (case and surrounding whitespace ignored), oldest first.
+    '''
+    seen = set()
+    selected = []
+    for query in reversed(search_history):
+        key = query.strip().lower()
+        if not key or key in seen:
+            continue
+        seen.add(key)
+        selected.append(query.strip())
+        if len(selected) == max_queries:
+            break
+    return selected[::-1]
+
+
+class TokenizedTemplate:
+    '''
+    Prompt template tokenized once: the static text between the fields is encoded at construction, so encoding a
+    prompt only tokenizes its field values.
+
+    Every field of the templates follows a space or a newline, and SentencePiece treats both as a word boundary, so
+    the concatenated ids equal those of tokenizing the whole rendered prompt.
+
+    Parameters:
+        - template (str): format string with named fields
+        - tokenizer: tokenizer of the model
+    '''
+
+    def __init__(self, template: str, tokenizer):
+        parsed = list(string.Formatter().parse(template))
+        literal_ids = tokenizer([literal_text for literal_text, _, _, _ in parsed], add_special_tokens=False)['input_ids']
+        self.segments = [(ids, field_name) for ids, (_, field_name, _, _) in zip(literal_ids, parsed)]
+        self.eos_token_id = tokenizer.eos_token_id
+        self.static_token_count = sum(len(ids) for ids in literal_ids) + 1  # + EOS
+
+    def encode(self, field_ids: dict) -> list:
+        '''
+        Parameters:
+            - field_ids (dict): field name -> token ids (without special tokens) of its value
+
+        Returns:
+            - token ids of the prompt, ending with EOS
+        '''
+        input_ids = []
+        for literal_ids, field_name in self.segments:
+            input_ids.extend(literal_ids)
+            if field_name is not None:
+                input_ids.extend(field_ids[field_name])
+        input_ids.append(self.eos_token_id)
+        return input_ids
+
+
+class PromptBuilder:
+    '''
+    Builds recommendation prompts that fit a token budget, so encoder cost per request stays flat however long a
+    user's search history or candidate list is.
+
+    Sections are cut in this order of priority:
+        - profile description: truncated to `max_profile_tokens`
+        - search history: distinct queries, most recent first, at most `max_history_queries` and `max_history_tokens`
+        - candidates: highest retrieval score first, at most `max_candidates`, as many as fit the remaining budget
+
+    The template is tokenized once (`TokenizedTemplate`) and token counts of profiles, queries and candidate entries
+    are cached, so building a prompt tokenizes only its history and candidate sections. The budget sums counts per
+    query / candidate entry, which can differ from tokenizing the joined section by a token at the joins;
+    `max_input_tokens` keeps a few tokens of margin below the model limit.
+
+    Parameters:
+        - tokenizer (LazyResource): tokenizer of the model the prompts are for
+        - style (str): prompt style, default `constants.LLM_PROMPT_STYLE` (see `get_prompt_template`)
+        - max_input_tokens (int): default `constants.PROMPT_MAX_INPUT_TOKENS`
+        - max_profile_tokens (int): default `constants.PROMPT_MAX_PROFILE_TOKENS`
+        - max_history_queries (int): default `constants.PROMPT_MAX_HISTORY_QUERIES`
+        - max_history_tokens (int): default `constants.PROMPT_MAX_HISTORY_TOKENS`
+        - max_candidates (int): default `constants.PROMPT_MAX_CANDIDATES`
+    '''
+
+    def __init__(self, tokenizer: LazyResource, style: str = None, max_input_tokens: int = None, max_profile_tokens: int = None, max_history_queries: int = None, max_history_tokens: int = None, max_candidates: int = None):
+        self.tokenizer = tokenizer
+        self.template = get_prompt_template(style)
+        self.max_input_tokens = constants.PROMPT_MAX_INPUT_TOKENS if max_input_tokens is None else max_input_tokens
+        self.max_profile_tokens = constants.PROMPT_MAX_PROFILE_TOKENS if max_profile_tokens is None else max_profile_tokens
+        self.max_history_queries = constants.PROMPT_MAX_HISTORY_QUERIES if max_history_queries is None else max_history_queries
+        self.max_history_tokens = constants.PROMPT_MAX_HISTORY_TOKENS if max_history_tokens is None else max_history_tokens
+        self.max_candidates = constants.PROMPT_MAX_CANDIDATES if max_candidates is None else max_candidates
+        self.token_count_cache = LRUCache(max_size=constants.PROMPT_TOKEN_COUNT_CACHE_SIZE)
+        self.profile_cache = LRUCache(max_size=constants.PROMPT_TOKEN_COUNT_CACHE_SIZE)
+        self.tokenized_template = LazyResource(lambda: TokenizedTemplate(self.template, self.tokenizer.get()), name='tokenized prompt template')
+
+    def count_tokens(self, texts: list) -> list:
+        '''
+        Token counts (without special tokens) of each text, tokenizing the ones not in the cache in one call.
+        '''
+        counts = [self.token_count_cache.get(text) for text in texts]
+        missing_texts = list({text for text, count in zip(texts, counts) if count is None})
+        if missing_texts:
+            encoded = self.tokenizer.get()(missing_texts, add_special_tokens=False)['input_ids']
+            counts_by_text = {text: len(ids) for text, ids in zip(missing_texts, encoded)}
+            for text, count in counts_by_text.items():
+                self.token_count_cache.set(text, count)
+            counts = [counts_by_text[text] if count is None else count for text, count in zip(texts, counts)]
+        return counts
+
+    def truncate_profile(self, profile_description: str) -> tuple:
+        '''
+        Returns:
+            - (profile text cut to `max_profile_tokens`, its token ids)
+        '''
+        profile_description = profile_description or ''
+        cached = self.profile_cache.get(profile_description)
+        if cached is not None:
+            return cached
+        tokenizer = self.tokenizer.get()
+        token_ids = tokenizer(profile_description, add_special_tokens=False)['input_ids']
+        if len(token_ids) > self.max_profile_tokens:
+            token_ids = token_ids[:self.max_profile_tokens]
+            truncated = (tokenizer.decode(token_ids, skip_special_tokens=True), token_ids)
+        else:
+            truncated = (profile_description, token_ids)
+        self.profile_cache.set(profile_description, truncated)
+        return truncated
+
+    def build(self, profile_description: str, search_history: list, candidates: list) -> dict:
+        '''
+        Parameters:
+            - profile_description (str)
+            - search_history (list[str]): queries, oldest first
+            - candidates (list): (Product, retrieval score) pairs in any order
+
+        Returns:
+            - dict with:
+                - prompt: rendered text
+                - input_ids: token ids of the prompt, for `LLM.pick_candidate` without tokenizing it again
+                - products: the kept candidates, best score first (the order `LLM.pick_candidate` expects)
+                - token_count: length of `input_ids`
+                - static_token_count: tokens of the template, the same for every prompt
+        '''
+        tokenized_template: TokenizedTemplate = self.tokenized_template.get()
+        profile_text, profile_ids = self.truncate_profile(profile_description)
+        token_count = tokenized_template.static_token_count + len(profile_ids)
+
+        queries = select_recent_history(search_history, self.max_history_queries)
+        history_budget = self.max_history_tokens
+        kept_queries = []
+        for query, query_tokens in zip(reversed(queries), reversed(self.count_tokens(queries))):
+            query_tokens += 1  # Separating comma
+            if query_tokens > history_budget:
+                break
+            history_budget -= query_tokens
+            kept_queries.append(query)
+        token_count += self.max_history_tokens - history_budget
+
+        ranked = sorted(candidates, key=lambda candidate: candidate[1], reverse=True)[:self.max_candidates]
+        entries = [f"{product.product_id}: {product.name!r}, " for product, _ in ranked]
+        kept_products = []
+        for (product, _), entry_tokens in zip(ranked, self.count_tokens(entries)):
+            if kept_products and token_count + entry_tokens > self.max_input_tokens:
+                break  # The best candidate is always kept
+            token_count += entry_tokens
+            kept_products.append(product)
+
+        user_search_history = ','.join(reversed(kept_queries))
+        candidates_for_recommendation = {product.product_id: product.name for product in kept_products}
+        history_ids, candidate_ids = self.tokenizer.get()([user_search_history, str(candidates_for_recommendation)], add_special_tokens=False)['input_ids']
+        input_ids = tokenized_template.encode({
+            'profile_description': profile_ids,
+            'user_search_history': history_ids,
+            'candidates_for_recommendation': candidate_ids,
+        })
+        return {
+            'prompt': self.template.format(
+                profile_description=profile_text,
+                user_search_history=user_search_history,
+                candidates_for_recommendation=candidates_for_recommendation,
+            ),
+            'input_ids': input_ids,
+            'products': kept_products,
+            'token_count': len(input_ids),
+            'static_token_count': tokenized_template.static_token_count,
+        }
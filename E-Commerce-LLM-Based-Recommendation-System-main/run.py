@@ -1,25 +1,86 @@
+import time
+import threading
 import uvicorn
 from pathlib import Path
+from datetime import datetime
+from typing import Literal, Optional
 from fastapi import FastAPI, HTTPException, Query
 from fastapi.responses import JSONResponse
 
 from llm.llm import LLM
+from llm.batcher import InferenceQueueFullError
 from db.sql_db import DB
+from db.async_db import AsyncDB
+from db.model_executor import ModelExecutor
+import constants
 
+# Models and the vector store load lazily, so importing this module is fast; the warmup thread loads them after startup
 db = DB()
-llm = LLM(db, load_model_data_on_start=True)
+llm = LLM(db, load_model_data_on_start=False)
+model_executor = ModelExecutor()  # Blocking model work runs here, never on the event loop
+async_db = AsyncDB(db, model_executor)
 
 server_host = "127.0.0.1"
 server_port = 8000
 app = FastAPI()
 
+warmup_state = {"ready": False, "attempts": 0, "last_error": None}
+
+def warm_up():
+    '''
+    Loads stopwords, the embedding model, the vector store and the LLM, retrying until all of them succeed.
+    '''
+    while True:
+        warmup_state["attempts"] += 1
+        try:
+            started = time.perf_counter()
+            db.warmup()
+            llm.warmup()
+            warmup_state["ready"] = True
+            warmup_state["last_error"] = None
+            print(f"Warmup finished in {time.perf_counter() - started:.1f}s.")
+            return
+        except Exception as e:
+            warmup_state["last_error"] = str(e)
+            print(f"Warmup attempt {warmup_state['attempts']} failed: {e}")
+            time.sleep(constants.WARMUP_RETRY_INTERVAL_SECONDS)
+
+@app.on_event("startup")
+async def startup():
+    threading.Thread(target=warm_up, name="warmup", daemon=True).start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await async_db.dispose()
+    model_executor.shutdown()
+    db.close()  # Flush buffered search history
+
 @app.get("/")
 async def read_root():
     return {"message": f"Try ot APIs: http://{server_host}:{server_port}/docs"}
 
+@app.get("/healthz")
+async def healthz():
+    """
+    Liveness probe: the process is up and serving. Does not wait for the models.
+    """
+    return {"status": "alive"}
+
+@app.get("/readyz")
+async def readyz():
+    """
+    Readiness probe: 200 once warmup has loaded every model and connection, 503 before, so a replica only takes traffic when warm.
+    """
+    if warmup_state["ready"]:
+        return {"status": "ready"}
+    return JSONResponse(
+        content={"status": "warming_up", "attempts": warmup_state["attempts"], "last_error": warmup_state["last_error"]},
+        status_code=503,
+    )
+
 @app.get("/get_customer_profile/{user_id}")
 async def get_customer_profile(user_id: int):
-    return llm.get_user_profile(user_id)
+    return await model_executor.run(llm.get_user_profile, user_id)
 
 @app.get("/recommend_product/{user_id}")
 async def recommend_product(user_id: int):
@@ -32,12 +93,28 @@ async def recommend_product(user_id: int):
     Returns:
         dict: dictionary containing given user id, generated recommended id, and recommended product data.
     """
-    if db.get_data(table="User", id=user_id):
-        recommendation_data = llm.make_recommendation_for_customer(user_id=user_id)
+    if await async_db.get_data(table="User", id=user_id):
+        # Served from the offline batch job when it has a fresh recommendation for an in-stock product
+        precomputed_recommendation = await async_db.get_precomputed_recommendation(user_id)
+        if precomputed_recommendation:
+            product_dict = await async_db.get_data(table="Product", id=precomputed_recommendation['product_id'], return_as_dict=True)
+            if product_dict and product_dict['stock'] > 0:
+                return {
+                    'user_id': user_id,
+                    'recommendation_id': precomputed_recommendation['recommendation_id'],
+                    'product_data': product_dict
+                }
+
+        try:
+            recommendation_data = await model_executor.run(llm.make_recommendation_for_customer, user_id=user_id)
+        except InferenceQueueFullError:
+            raise HTTPException(status_code=503, detail="Recommendation service is overloaded, retry later.")
         recommendation_id = recommendation_data['recommendation_id']
         product_id = recommendation_data['product_id']
+        if product_id is None:
+            raise HTTPException(status_code=404, detail="No products available for recommendation")
 
-        product_dict = db.get_data(table="Product", id=product_id, return_as_dict=True)
+        product_dict = await async_db.get_data(table="Product", id=product_id, return_as_dict=True)
         
         return {
             'user_id': user_id,
@@ -55,6 +132,8 @@ async def search_products(
     min_price: float = Query(None, ge=0),
     max_price: float = Query(None, ge=0),
     min_stock: int = Query(None, ge=1),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0, le=1000),
 ):
     """
     Search for products by a query string with optional price filters.
@@ -64,19 +143,25 @@ async def search_products(
         min_price (float): Minimum price for filtering (optional).
         max_price (float): Maximum price for filtering (optional).
         min_stock (float): Minimum stock for filtering (optional).
+        limit (int): Maximum number of products returned (page size).
+        offset (int): Number of best matches to skip (for paging).
 
     Returns:
-        dict: A list of matching products.
+        dict: A list of matching products, best match first, each with its hybrid relevance `score`.
     """
-    if db.get_data(table="User", id=user_id):
-        return db.search_product(
+    if await async_db.get_data(table="User", id=user_id):
+        search_results = await async_db.search_product(
             user_id=user_id,
             search_keyword=query,
             min_price=min_price,
             max_price=max_price,
             min_stock=min_stock,
-            return_as_dict=True
+            return_as_dict=True,
+            limit=limit,
+            offset=offset,
+            return_scores=True,
         )
+        return [{**product, 'score': score} for product, score in search_results]
     
     else:
         raise HTTPException(status_code=404, detail="User ID not found")
@@ -94,8 +179,8 @@ async def set_recommendation_feedback(
         recommendation_id (int): ID of the recommendation.
         rating_score (int): Rating score (0 to 5).
     """
-    if user_id == db.get_data(table="Recommendation", id=recommendation_id, return_as_dict=False).user_id:
-        recommendation_feedback_id = db.record_recommendation_feedback(
+    if user_id == (await async_db.get_data(table="Recommendation", id=recommendation_id, return_as_dict=False)).user_id:
+        recommendation_feedback_id = await async_db.record_recommendation_feedback(
             recommendation_id=recommendation_id,
             user_id=user_id,
             rating=rating_score
@@ -111,15 +196,35 @@ async def set_recommendation_feedback(
     else:
         raise HTTPException(status_code=403, detail="Given user is not authorized to access or interact with this recommendation.")
 
+@app.get("/get_inference_metrics")
+async def get_inference_metrics():
+    """
+    Returns LLM micro-batching metrics: queue depth, batch sizes and queue/inference times.
+    """
+    return llm.inference_metrics()
+
 @app.get("/get_recommendation_performance")
-async def get_recommendation_performance():
+async def get_recommendation_performance(
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    granularity: Optional[Literal["hour", "day"]] = None,
+):
     """
     Returns a dictionary of the number of recommendations per rating score (0 to 5). Can be used for visualization like barplot for real time monitoring of recommendation performance from user feedbacks.
+    Served from incrementally maintained counters, so polling does not scan the feedback table.
+
+    Args:
+        since (datetime): Optional start of the window, rounded down to the hour (or to the granularity).
+        until (datetime): Optional end of the window (exclusive, bucket aligned).
+        granularity (str): "hour" or "day" to get one summary per time bucket, e.g. for a time series chart.
 
     Returns:
         dict: Key-value pairs where keys are rating scores and values are the count of recommendations for each score.
+            With a granularity, keys are bucket start times and values are such dictionaries.
     """
-    return db.summarize_recommendation_feedback_rating()
+    if since is not None and until is not None and since >= until:
+        raise HTTPException(status_code=422, detail="'since' must be earlier than 'until'.")
+    return await async_db.summarize_recommendation_feedback_rating(since=since, until=until, granularity=granularity)
 
 if __name__ == "__main__":
     uvicorn.run(f"{Path(__file__).stem}:app", host=server_host, port=server_port, reload=True)
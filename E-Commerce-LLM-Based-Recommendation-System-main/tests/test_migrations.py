@@ -0,0 +1,43 @@
+import pytest
+
+pytest.importorskip('sqlmodel')
+
+from sqlalchemy import text
+from sqlmodel import SQLModel, create_engine
+
+from db.migrations import MIGRATIONS, SchemaMigrator, build_hot_query_statements, check_query_plans
+
+
+@pytest.fixture
+def engine(tmp_path):
+    '''
+    SQLite database with the current tables but without the migration indexes, like a database created before them.
+    '''
+    engine = create_engine(f"sqlite:///{tmp_path / 'main.db'}")
+    SQLModel.metadata.create_all(engine)
+    with engine.begin() as connection:
+        for _, index_name in build_hot_query_statements().values():
+            connection.execute(text(f'DROP INDEX IF EXISTS {index_name}'))
+    yield engine
+    engine.dispose()
+
+
+def test_hot_queries_do_not_use_indexes_before_migrating(engine):
+    for name, (uses_index, plan) in check_query_plans(engine).items():
+        assert not uses_index, f"{name} already uses its index before migrating:\n{plan}"
+
+
+def test_hot_queries_use_indexes_after_migrating(engine):
+    assert SchemaMigrator(engine).migrate() == [migration.version for migration in MIGRATIONS]
+
+    for name, (uses_index, plan) in check_query_plans(engine).items():
+        assert uses_index, f"{name} does not use its index:\n{plan}"
+
+
+def test_migrations_are_applied_once(engine):
+    migrator = SchemaMigrator(engine)
+    migrator.migrate()
+
+    assert migrator.pending_migrations() == []
+    assert migrator.migrate() == []
+    assert migrator.current_version() == MIGRATIONS[-1].version